@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+连接准入控制
+限制同时存在的隧道数、同时进行中的上游握手数和每个来源IP的并发连接数。
+超过上限时按策略排队等待(queue)或立即返回503拒绝(reject)，
+上游节点卡住时连接不会无限堆积，过载时服务逐渐变慢而不是进程崩溃。
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+# 拒绝连接时返回给客户端的响应
+REJECT_RESPONSE = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+
+class Overloaded(Exception):
+    """超过并发上限且排队超时"""
+
+
+class AdmissionControl:
+    """并发上限，0表示不限制"""
+
+    def __init__(self, max_tunnels=0, max_handshakes=0, max_per_ip=0, policy="queue", queue_timeout=5):
+        """
+        参数:
+            max_tunnels: 最大并发隧道数
+            max_handshakes: 最大同时进行的上游握手数
+            max_per_ip: 每个来源IP的最大并发连接数，超过时总是立即拒绝
+            policy: 超过上限时的处理方式，queue(排队等待) / reject(立即拒绝)
+            queue_timeout: 排队等待的最长时间(秒)
+        """
+        self.max_tunnels = max_tunnels
+        self.max_handshakes = max_handshakes
+        self.max_per_ip = max_per_ip
+        self.policy = policy
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self.tunnels = 0
+        self.handshakes = 0
+        self._per_ip = {}
+        self.rejected = 0
+        self.queued = 0
+
+    @property
+    def enabled(self):
+        return bool(self.max_tunnels or self.max_handshakes or self.max_per_ip)
+
+    @property
+    def wait_timeout(self):
+        """超过上限时最多等待的时间，reject策略下为0"""
+        return self.queue_timeout if self.policy == "queue" else 0
+
+    def try_admit(self, ip):
+        """尝试占用一个隧道名额，返回 True / False(需要等待) / None(来源IP超限，直接拒绝)"""
+        with self._cond:
+            if self.max_per_ip and self._per_ip.get(ip, 0) >= self.max_per_ip:
+                self.rejected += 1
+                return None
+            if self.max_tunnels and self.tunnels >= self.max_tunnels:
+                return False
+            self.tunnels += 1
+            self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+            return True
+
+    def admit(self, ip):
+        """占用一个隧道名额，按策略等待，返回是否成功"""
+        deadline = time.time() + self.wait_timeout
+        waited = False
+        with self._cond:  # Condition使用可重入锁，检查和等待之间不会漏掉通知
+            while True:
+                result = self.try_admit(ip)
+                if result is not False:
+                    return bool(result)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.reject()
+                    return False
+                if not waited:
+                    waited = True
+                    self.queued += 1
+                self._cond.wait(remaining)
+
+    def release(self, ip):
+        """释放隧道名额"""
+        with self._cond:
+            self.tunnels -= 1
+            count = self._per_ip.get(ip, 0) - 1
+            if count > 0:
+                self._per_ip[ip] = count
+            else:
+                self._per_ip.pop(ip, None)
+            self._cond.notify_all()
+
+    def try_begin_handshake(self):
+        """尝试占用一个握手名额"""
+        with self._cond:
+            if self.max_handshakes and self.handshakes >= self.max_handshakes:
+                return False
+            self.handshakes += 1
+            return True
+
+    def end_handshake(self):
+        """释放握手名额"""
+        with self._cond:
+            self.handshakes -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def handshake(self):
+        """在握手名额内执行上游握手，排队超时时抛出Overloaded"""
+        deadline = time.time() + self.wait_timeout
+        with self._cond:
+            while not self.try_begin_handshake():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.reject()
+                    raise Overloaded("同时进行的上游握手过多")
+                self._cond.wait(remaining)
+        try:
+            yield
+        finally:
+            self.end_handshake()
+
+    def reject(self):
+        """记录一次拒绝"""
+        with self._cond:
+            self.rejected += 1
+
+    def get_stats(self):
+        """获取准入控制统计信息"""
+        return {
+            "tunnels": self.tunnels,
+            "handshakes": self.handshakes,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shadowsocks AEAD加密(aes-128/192/256-gcm, chacha20-ietf-poly1305)
+每个方向以随机salt开头，salt和主密钥经HKDF-SHA1派生出该方向的子密钥；
+之后的数据分为若干块，每块为 加密的2字节长度+tag 和 加密的数据+tag，
+nonce是从0开始的12字节小端计数器，每次加密/解密后加1。
+
+AeadCipher与流加密器的encrypt/decrypt接口相同，salt的收发沿用流加密IV的处理方式；
+加密时每块的长度、数据和tag作为独立的缓冲区返回，由调用方用一次sendmsg发出，不需要拼接。
+AES-GCM/ChaCha20-Poly1305本身由cipher_backends中选用的实现提供。
+"""
+
+import hmac
+import struct
+import hashlib
+
+# 加密方式 -> (密钥长度, salt长度)
+AEAD_METHODS = {
+    'aes-128-gcm': (16, 16),
+    'aes-192-gcm': (24, 24),
+    'aes-256-gcm': (32, 32),
+    'chacha20-ietf-poly1305': (32, 32),
+}
+
+TAG_SIZE = 16
+NONCE_SIZE = 12
+# 每块数据的最大长度
+MAX_PAYLOAD = 0x3FFF
+# 一个完整数据块(长度+tag+数据+tag)的最大字节数，接收缓冲区必须比它大
+MAX_CHUNK = 2 + TAG_SIZE + MAX_PAYLOAD + TAG_SIZE
+
+SUBKEY_INFO = b"ss-subkey"
+
+
+def hkdf_sha1(key, salt, info, length):
+    """RFC 5869 HKDF，哈希函数为SHA1"""
+    prk = hmac.new(salt, key, hashlib.sha1).digest()
+    okm = b""
+    block = b""
+    counter = 1
+    while len(okm) < length:
+        block = hmac.new(prk, block + info + bytes([counter]), hashlib.sha1).digest()
+        okm += block
+        counter += 1
+    return okm[:length]
+
+
+class AeadCipher:
+    """一个方向的AEAD加密/解密状态"""
+
+    def __init__(self, key, salt, new_aead):
+        """
+        参数:
+            key: 主密钥
+            salt: 该方向的salt
+            new_aead: 按子密钥创建AEAD实现的函数，实现提供seal/open/open_into
+        """
+        self.subkey = hkdf_sha1(key, salt, SUBKEY_INFO, len(key))
+        self.aead = new_aead(self.subkey)
+        self.counter = 0
+        self._buffer = bytearray()  # 还不是完整数据块的密文
+        self._payload_length = None  # 已解出长度、等待数据部分的块长度
+
+    @property
+    def pending(self):
+        """已接收但还没有解密的字节数"""
+        return len(self._buffer)
+
+    def _nonce(self):
+        nonce = self.counter.to_bytes(NONCE_SIZE, "little")
+        self.counter += 1
+        return nonce
+
+    def seal(self, data):
+        """加密单个数据报(UDP)，返回 密文+tag"""
+        return b"".join(self.aead.seal(self._nonce(), data))
+
+    def open(self, data):
+        """解密单个数据报(UDP)，认证失败时抛出ValueError"""
+        if len(data) < TAG_SIZE:
+            raise ValueError("AEAD数据报过短")
+        return self.aead.open(self._nonce(), data)
+
+    def encrypt_segments(self, data):
+        """把数据分块加密，返回依次发送的缓冲区列表"""
+        segments = []
+        view = memoryview(data)
+        for start in range(0, len(view), MAX_PAYLOAD):
+            payload = view[start:start + MAX_PAYLOAD]
+            segments.extend(self.aead.seal(self._nonce(), struct.pack(">H", len(payload))))
+            segments.extend(self.aead.seal(self._nonce(), payload))
+        return segments
+
+    def encrypt(self, data):
+        return b"".join(self.encrypt_segments(data))
+
+    def _open_chunks(self, write):
+        """解密缓冲区中所有完整的数据块，每块的nonce和 密文+tag 交给write，返回明文字节数"""
+        buffer = self._buffer
+        view = memoryview(buffer)
+        pos = 0
+        total = 0
+        try:
+            while True:
+                if self._payload_length is None:
+                    if len(buffer) - pos < 2 + TAG_SIZE:
+                        break
+                    length = self.aead.open(self._nonce(), view[pos:pos + 2 + TAG_SIZE])
+                    pos += 2 + TAG_SIZE
+                    self._payload_length = struct.unpack(">H", length)[0] & MAX_PAYLOAD
+                n = self._payload_length
+                if len(buffer) - pos < n + TAG_SIZE:
+                    break
+                write(self._nonce(), view[pos:pos + n + TAG_SIZE], total)
+                pos += n + TAG_SIZE
+                total += n
+                self._payload_length = None
+        finally:
+            view.release()
+            del buffer[:pos]
+        return total
+
+    def decrypt(self, data):
+        """解密收到的数据，只返回完整数据块的明文，认证失败时抛出ValueError"""
+        self._buffer += data
+        out = []
+        self._open_chunks(lambda nonce, chunk, _: out.append(self.aead.open(nonce, chunk)))
+        return b"".join(out)
+
+    def decrypt_into(self, view, size):
+        """解密view开头size字节的新数据，明文写回view开头，返回明文字节数
+
+        明文不会超过 pending + size，调用方读取时需保证 pending + size <= len(view)。
+        """
+        self._buffer += view[:size]
+
+        def write(nonce, chunk, offset):
+            self.aead.open_into(nonce, chunk, view[offset:offset + len(chunk) - TAG_SIZE])
+        return self._open_chunks(write)
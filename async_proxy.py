@@ -0,0 +1,766 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+asyncio代理数据面
+在单个事件循环中处理所有客户端连接，CONNECT解析、上游连接、
+SSR握手和双向转发都以协程方式运行，不再为每个连接创建线程
+"""
+
+import asyncio
+import logging
+import socket
+import threading
+import time
+
+from logging_setup import connection_logger as conn_logger, begin_connection
+from admission import REJECT_RESPONSE
+import sockopts
+import dns_cache
+from reaper import current as current_connection
+from happy_eyeballs import order_addresses
+from http_parser import (HeaderParser, BodyFramer, parse_target, build_connect_request,
+                         connect_reply_length, is_forward_request, split_absolute_uri, rewrite_request,
+                         CONNECT_OK, CONNECT_FAILED)
+from http_proxy import TunnelPool, UpstreamClosed, RESPONSE_TIMEOUT
+from socks5 import (Socks5Parser, Socks5Error, UdpRelay, build_reply, CMD_UDP_ASSOCIATE, REP_SUCCEEDED,
+                    REP_GENERAL_FAILURE, REP_HOST_UNREACHABLE, REP_COMMAND_NOT_SUPPORTED, REJECT_GREETING)
+
+logger = logging.getLogger("async_proxy")
+
+# 单次读取的最大字节数
+READ_SIZE = 65536
+# 排队等待准入名额时的检查间隔(秒)
+ADMISSION_POLL = 0.05
+
+
+class AsyncProxyServer:
+    """基于asyncio的代理服务器"""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.http_pool = TunnelPool(  # 普通HTTP代理请求复用的隧道: (reader, writer, session)
+            size=manager.options.get("http_pool_size", 4),
+            idle_timeout=manager.options.get("http_pool_idle_timeout", 30),
+            is_alive=lambda tunnel: not tunnel[0].at_eof() and not tunnel[1].is_closing(),
+            close=lambda tunnel: tunnel[1].close()
+        )
+
+    def start(self, host, port, reuse_port=False, backlog=128, socks5_port=0):
+        """在后台线程中启动事件循环"""
+        self.thread = threading.Thread(
+            target=self._run, args=(host, port, reuse_port, backlog, socks5_port), daemon=True
+        )
+        self.thread.start()
+
+    def _run(self, host, port, reuse_port, backlog, socks5_port):
+        """事件循环线程入口"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve(host, port, reuse_port, backlog, socks5_port))
+        except Exception as e:
+            logger.error(f"代理服务器启动失败: {str(e)}")
+            print(f"代理服务器启动失败: {str(e)}")
+
+    async def _serve(self, host, port, reuse_port=False, backlog=128, socks5_port=0):
+        """监听端口并处理连接"""
+        self.server = await self._listen(self.handle_client, host, port, reuse_port, backlog)
+        logger.info(f"代理服务器已启动(asyncio)，监听端口: {port}")
+        servers = [self.server]
+        if socks5_port:
+            servers.append(await self._listen(self.handle_socks5, host, socks5_port, reuse_port, backlog))
+            logger.info(f"SOCKS5代理服务器已启动(asyncio)，监听端口: {socks5_port}")
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+    async def _listen(self, handler, host, port, reuse_port, backlog):
+        server = await asyncio.start_server(
+            handler, host, port, backlog=backlog, reuse_address=True,
+            reuse_port=reuse_port or None
+        )
+        for sock in server.sockets:
+            sockopts.apply_listener(sock)
+        return server
+
+    async def handle_client(self, reader, writer):
+        """处理新的HTTP代理连接"""
+        await self._serve_client(reader, writer, self._handle, REJECT_RESPONSE)
+
+    async def handle_socks5(self, reader, writer):
+        """处理新的SOCKS5连接"""
+        await self._serve_client(reader, writer, self._handle_socks5, REJECT_GREETING)
+
+    async def _serve_client(self, reader, writer, handler, reject_response):
+        """准入控制和连接统计，handler处理具体的协议"""
+        addr = writer.get_extra_info("peername") or ("未知", 0)
+        begin_connection()
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sockopts.apply_client(sock)
+        admission = self.manager.admission
+        if not await self._wait_admission(lambda: admission.try_admit(addr[0])):
+            self._reject(writer, addr, "并发连接数超过上限", reject_response)
+            return
+
+        conn_logger.info("新的连接: %s:%d", addr[0], addr[1])
+        self.manager.update_stats(connection_change=1)
+        try:
+            with self.manager.reaper.track(self._aborter(writer)):
+                await handler(reader, writer, addr)
+        except Exception as e:
+            logger.error(f"处理连接 {addr[0]}:{addr[1]} 失败: {str(e)}")
+        finally:
+            writer.close()
+            admission.release(addr[0])
+            self.manager.update_stats(connection_change=-1)
+
+    async def _wait_admission(self, attempt):
+        """按准入策略获取名额
+
+        事件循环中不能阻塞在Condition上，排队时定期重新尝试。
+        attempt返回 True(成功) / False(需要等待) / None(直接拒绝)。
+        """
+        result = attempt()
+        if result is not False:
+            return bool(result)
+
+        admission = self.manager.admission
+        deadline = time.time() + admission.wait_timeout
+        if deadline > time.time():
+            admission.queued += 1
+        while time.time() < deadline:
+            await asyncio.sleep(ADMISSION_POLL)
+            result = attempt()
+            if result is not False:
+                return bool(result)
+        admission.reject()
+        return False
+
+    def _aborter(self, writer):
+        """回收线程用来中止连接的回调，transport只能在事件循环线程中操作"""
+        return lambda: self.loop.call_soon_threadsafe(writer.transport.abort)
+
+    def _reject(self, writer, addr, reason, response=REJECT_RESPONSE):
+        """过载时返回503(或指定的应答)并关闭连接"""
+        conn_logger.warning("拒绝连接 %s:%d: %s", addr[0], addr[1], reason)
+        writer.write(response)
+        writer.close()
+
+    async def _handle(self, reader, writer, addr):
+        """解析请求并建立隧道"""
+        admission = self.manager.admission
+        node = self.manager.get_current_node()
+        if not node:
+            logger.error("没有可用节点，拒绝连接")
+            return
+
+        conn_logger.info("使用节点: %s", node.name)
+
+        data = b""
+        try:
+            data = await asyncio.wait_for(reader.read(4096), 5)
+
+            # 检查是否是HTTP CONNECT请求
+            if data.startswith(b"CONNECT"):
+                # 读取完整的请求头，之后的数据作为早期数据随首包发出
+                parser = HeaderParser()
+                request = parser.feed(data)
+                while request is None:
+                    chunk = await asyncio.wait_for(reader.read(4096), 5)
+                    if not chunk:
+                        raise ConnectionError("客户端在请求头完成前关闭了连接")
+                    request = parser.feed(chunk)
+                early_data = parser.leftover
+                conn_logger.info("收到HTTP CONNECT请求: %s (早期数据%d字节)", request.target, len(early_data))
+
+                host, port = parse_target(request.target)
+                defer_reply = self.manager.options.get("defer_connect_reply", False)
+
+                if not await self._wait_admission(admission.try_begin_handshake):
+                    self._reject(writer, addr, "同时进行的上游握手过多")
+                    return
+                upstream = None
+                try:
+                    if not defer_reply:
+                        # 发送连接成功响应
+                        writer.write(CONNECT_OK)
+                        await writer.drain()
+                    upstream = await self._open_upstream(node, host, port, early_data)
+                finally:
+                    admission.end_handshake()
+                    if defer_reply:
+                        # 上游连接成功后才告诉客户端隧道已建立
+                        writer.write(CONNECT_OK if upstream else CONNECT_FAILED)
+                if not upstream:
+                    return
+
+                up_reader, up_writer, session = upstream
+                await self._relay(reader, writer, up_reader, up_writer, session)
+                return
+
+            # 绝对URI形式的HTTP代理请求：逐个转发请求，复用到目标的隧道
+            if self.manager.options.get("http_proxy", True) and is_forward_request(data):
+                await self._forward_http(reader, writer, node, data, addr)
+                return
+
+            conn_logger.info("非HTTP CONNECT请求，使用普通代理模式")
+        except asyncio.TimeoutError:
+            conn_logger.info("接收数据超时，使用普通代理模式")
+        except Exception as e:
+            logger.warning(f"解析HTTP请求失败: {str(e)}，使用普通代理模式")
+
+        # 握手超时已被回收的连接不再回退
+        conn = current_connection()
+        if conn and conn.reaped:
+            return
+
+        # 普通代理模式：直接连接节点并转发
+        if not await self._wait_admission(admission.try_begin_handshake):
+            self._reject(writer, addr, "同时进行的上游握手过多")
+            return
+        try:
+            upstream = await self._open_node(node)
+            if not upstream:
+                # 尝试重新选择节点，节点检查是阻塞操作，放到线程池中执行
+                if await self.loop.run_in_executor(None, self.manager.select_node, "auto"):
+                    node = self.manager.get_current_node()
+                    logger.info(f"尝试使用备用节点: {node.name} ({node.address}:{node.port})")
+                    upstream = await self._open_node(node)
+        finally:
+            admission.end_handshake()
+        if not upstream:
+            logger.error("没有可用的备用节点")
+            return
+
+        up_reader, up_writer = upstream
+        if data:
+            up_writer.write(data)
+        conn_logger.info("开始在本地连接 %s:%d 和远程节点 %s:%d 之间转发数据",
+                         addr[0], addr[1], node.address, node.port)
+        await self._relay(reader, writer, up_reader, up_writer, None)
+
+    async def _handle_socks5(self, reader, writer, addr):
+        """SOCKS5协商并建立隧道"""
+        parser = Socks5Parser()
+        request = None
+        try:
+            while request is None:
+                data = await asyncio.wait_for(reader.read(4096), 5)
+                if not data:
+                    return
+                reply, request = parser.feed(data)
+                if reply:
+                    writer.write(reply)
+        except Socks5Error as e:
+            logger.warning(f"SOCKS5协商失败: {str(e)}")
+            writer.write(e.reply)
+            return
+        except asyncio.TimeoutError:
+            conn_logger.info("SOCKS5协商超时")
+            return
+        command, host, port = request
+
+        node = self.manager.get_current_node()
+        if not node:
+            logger.error("没有可用节点，拒绝连接")
+            writer.write(build_reply(REP_GENERAL_FAILURE))
+            return
+        conn_logger.info("使用节点: %s", node.name)
+
+        if command == CMD_UDP_ASSOCIATE:
+            await self._socks5_udp(reader, writer, addr, node)
+            return
+
+        # 请求之后客户端提前发送的数据作为早期数据随首包发出
+        early_data = parser.leftover
+        conn_logger.info("收到SOCKS5 CONNECT请求: %s:%d (早期数据%d字节)", host, port, len(early_data))
+        admission = self.manager.admission
+        if not await self._wait_admission(admission.try_begin_handshake):
+            self._reject(writer, addr, "同时进行的上游握手过多", build_reply(REP_GENERAL_FAILURE))
+            return
+        try:
+            upstream = await self._open_upstream(node, host, port, early_data)
+        finally:
+            admission.end_handshake()
+        if not upstream:
+            writer.write(build_reply(REP_HOST_UNREACHABLE))
+            return
+
+        writer.write(build_reply(REP_SUCCEEDED))
+        await self._relay(reader, writer, *upstream)
+
+    async def _socks5_udp(self, reader, writer, addr, node):
+        """UDP ASSOCIATE：在客户端和SSR节点之间转发数据报，直到控制连接关闭"""
+        client = self.manager._get_ssr_client(node) if node.password else None
+        if not client or not client.udp_supported:
+            logger.warning(f"节点 {node.name} 不支持UDP转发")
+            writer.write(build_reply(REP_COMMAND_NOT_SUPPORTED))
+            return
+
+        relay = UdpRelay(client, addr[0], lambda n: self.manager.update_stats(traffic=n))
+        endpoints = []
+
+        def from_client(packet, source):
+            out = relay.from_client(packet, source)
+            if out:
+                endpoints[1].sendto(out)
+
+        def from_node(packet, source):
+            out = relay.from_node(packet)
+            if out:
+                endpoints[0].sendto(out, relay.client_addr)
+
+        bind_host = writer.get_extra_info("sockname")[0]
+        try:
+            transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: _DatagramEndpoint(from_client), local_addr=(bind_host, 0)
+            )
+            endpoints.append(transport)
+            infos = await self._resolve(node.address, node.port, socket.SOCK_DGRAM)
+            transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: _DatagramEndpoint(from_node), remote_addr=infos[0][4]
+            )
+            endpoints.append(transport)
+
+            bound_host, bound_port = endpoints[0].get_extra_info("sockname")[:2]
+            conn_logger.info("UDP关联已建立: %s:%d <-> 节点 %s", bound_host, bound_port, node.name)
+            writer.write(build_reply(REP_SUCCEEDED, bound_host, bound_port))
+            conn = current_connection()
+            if conn:
+                # UDP关联有自己的空闲超时
+                conn.established(track_idle=False)
+
+            # 控制连接关闭或空闲超时后结束关联
+            idle_timeout = self.manager.options.get("socks5_udp_timeout", 60)
+            while True:
+                remaining = relay.last_active + idle_timeout - time.time()
+                if remaining <= 0:
+                    conn_logger.info("UDP关联空闲超时")
+                    return
+                try:
+                    if not await asyncio.wait_for(reader.read(1024), remaining):
+                        return
+                except asyncio.TimeoutError:
+                    continue
+        finally:
+            for transport in endpoints:
+                transport.close()
+
+    async def _open_upstream(self, node, host, port, early_data=b""):
+        """按connect_mode建立到目标的隧道"""
+        if self.manager.options.get("connect_mode", "single") != "race":
+            conn_logger.info("通过节点 %s 连接到目标: %s:%d", node.name, host, port)
+            return await self._open_tunnel(node, host, port, early_data)
+        return await self._race_tunnel(host, port, early_data)
+
+    async def _race_tunnel(self, host, port, early_data=b""):
+        """在延迟最低的几个节点之间错开时间发起连接，第一个完成握手的胜出"""
+        options = self.manager.options
+        queue = self.manager.get_ranked_nodes(options.get("race_nodes", 3))
+        stagger = options.get("race_stagger_ms", 250) / 1000.0
+        conn_logger.info("竞速连接到 %s:%d，候选节点: %s", host, port, ", ".join(node.name for node in queue))
+
+        pending = set()
+        winner = None
+        try:
+            while (queue or pending) and not winner:
+                if queue:
+                    node = queue.pop(0)
+                    pending.add(asyncio.ensure_future(self._race_attempt(node, host, port, early_data)))
+                # 前一个尝试失败时立即启动下一个
+                done, pending = await asyncio.wait(
+                    pending, timeout=stagger if queue else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    result = task.result()
+                    if result and not winner:
+                        winner = result
+                        conn_logger.info("竞速连接胜出: %s", result[3].name)
+                    elif result:
+                        result[1].close()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if not winner:
+            logger.error(f"所有节点都无法连接到 {host}:{port}")
+            return None
+        return winner[:3]
+
+    async def _race_attempt(self, node, host, port, early_data):
+        """竞速中的单个尝试，返回(reader, writer, session, node)，失败返回None"""
+        upstream = None
+        try:
+            upstream = await self._open_tunnel(node, host, port, early_data)
+            return upstream + (node,) if upstream else None
+        except asyncio.CancelledError:
+            if upstream:
+                upstream[1].close()
+            raise
+        except Exception as e:
+            logger.info(f"节点 {node.name} 连接失败: {str(e)}")
+            return None
+
+    async def _open_node(self, node):
+        """建立到节点的TCP连接，优先使用连接池中已建立的连接"""
+        sock = self.manager.upstream_pool.acquire(node)
+        if sock:
+            return await asyncio.open_connection(sock=sock)
+        try:
+            infos = await self._resolve(node.address, node.port)
+            if self.manager.options.get("connect_mode", "single") == "race":
+                # 节点的IPv6/IPv4地址之间同样错开竞速
+                delay = self.manager.options.get("race_stagger_ms", 250) / 1000.0
+                addresses = order_addresses(infos)
+            else:
+                delay = None
+                addresses = [(info[0], info[4]) for info in infos]
+            reader, writer = await asyncio.wait_for(self._connect_addresses(addresses, delay), 15)
+            # asyncio自己创建socket，只能在连接建立后设置选项，不支持TFO
+            sockopts.apply_upstream(writer.get_extra_info("socket"), fastopen=False)
+            return reader, writer
+        except Exception as e:
+            logger.error(f"连接到远程节点 {node.name} ({node.address}:{node.port}) 失败: {str(e)}")
+            return None
+
+    async def _resolve(self, host, port, socktype=socket.SOCK_STREAM):
+        """解析节点地址，缓存中没有时在线程池中解析，不阻塞事件循环"""
+        infos = dns_cache.lookup(host, port, socktype)
+        if infos is None:
+            infos = await self.loop.run_in_executor(None, dns_cache.getaddrinfo, host, port, socktype)
+        return infos
+
+    async def _connect_addresses(self, addresses, delay):
+        """依次连接各地址，delay不为None时每隔delay秒发起下一个，第一个成功的胜出"""
+        queue = list(addresses)
+        pending = set()
+        winner = None
+        error = None
+        try:
+            while (queue or pending) and not winner:
+                if queue:
+                    _, sockaddr = queue.pop(0)
+                    pending.add(asyncio.ensure_future(asyncio.open_connection(sockaddr[0], sockaddr[1])))
+                # 前一个尝试失败时立即启动下一个
+                done, pending = await asyncio.wait(
+                    pending, timeout=delay if queue else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception():
+                        error = task.exception()
+                    elif winner:
+                        task.result()[1].close()
+                    else:
+                        winner = task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        if not winner:
+            raise error or OSError("没有可连接的地址")
+        return winner
+
+    async def _open_tunnel(self, node, host, port, early_data=b""):
+        """通过节点建立到目标的隧道，返回(reader, writer, session)
+
+        early_data为客户端在CONNECT请求头之后已经发送的数据，随首包一起发出。
+        """
+        if node.password:
+            client = self.manager._get_ssr_client(node)
+            if not client:
+                logger.error("无法创建到远程节点的连接")
+                return None
+
+            mux = self.manager.mux
+            if mux.enabled:
+                # 建立多路复用连接时会阻塞，在线程池中打开流
+                try:
+                    sock = await self.loop.run_in_executor(None, mux.open_stream, client, host, port, early_data)
+                except ConnectionError as e:
+                    logger.error(f"SSR多路复用流连接到目标 {host}:{port} 失败: {str(e)}")
+                    return None
+                if sock:
+                    up_reader, up_writer = await asyncio.open_connection(sock=sock)
+                    conn_logger.info("SSR多路复用流已打开到目标: %s:%d", host, port)
+                    return up_reader, up_writer, None
+
+            upstream = await self._open_node(node)
+            if not upstream:
+                return None
+            up_reader, up_writer = upstream
+
+            session = client.new_session()
+            first_packet = session.handshake(host, port, early_data)
+            if first_packet is None:
+                logger.error("加密器创建失败，放弃连接")
+                up_writer.close()
+                return None
+            up_writer.write(first_packet)
+            await up_writer.drain()
+            conn_logger.info("SSR连接已建立到目标: %s:%d", host, port)
+            return up_reader, up_writer, session
+
+        upstream = await self._open_node(node)
+        if not upstream:
+            return None
+        up_reader, up_writer = upstream
+
+        # 普通TCP连接：需要手动发送CONNECT请求，早期数据紧跟在请求头之后
+        up_writer.write(build_connect_request(host, port) + early_data)
+        # 只读取应答头，之后的数据留在reader中交给转发
+        try:
+            response = await asyncio.wait_for(up_reader.readuntil(b"\r\n\r\n"), 15)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            response = b""
+        if not connect_reply_length(response):
+            logger.error(f"代理服务器拒绝连接到 {host}:{port}")
+            up_writer.close()
+            return None
+
+        conn_logger.info("普通代理连接已建立到目标: %s:%d", host, port)
+        return up_reader, up_writer, None
+
+    async def _forward_http(self, reader, writer, node, buffered, addr):
+        """处理普通HTTP代理请求，直到客户端连接关闭"""
+        keepalive_timeout = self.manager.options.get("http_keepalive_timeout", 60)
+        conn = current_connection()
+        if conn:
+            # 请求之间的空闲由http_keepalive_timeout控制
+            conn.established(track_idle=False)
+        while True:
+            # 读取请求头
+            parser = HeaderParser()
+            request = parser.feed(buffered) if buffered else None
+            while request is None:
+                try:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), keepalive_timeout)
+                except asyncio.TimeoutError:
+                    return
+                if not data:
+                    return
+                request = parser.feed(data)
+            buffered = parser.leftover
+
+            host, port, path = split_absolute_uri(request.target)
+            conn_logger.info("HTTP代理请求: %s %s:%d%s", request.method, host, port, path)
+            head = rewrite_request(request, path, host, port)
+            body = BodyFramer.for_request(request)
+            key = (host, port)
+
+            # 复用的隧道可能已被目标服务器关闭，没有请求体的请求可以换新隧道重试一次
+            tunnel = self.http_pool.acquire(key)
+            reused = tunnel is not None
+            while True:
+                if tunnel is None:
+                    tunnel = await self._open_http_tunnel(writer, addr, node, host, port)
+                    if tunnel is None:
+                        return
+                try:
+                    buffered = await self._send_http_request(reader, tunnel, head, body, buffered)
+                    response, reusable, keep_client = await self._forward_http_response(writer, tunnel, request)
+                    break
+                except (UpstreamClosed, ConnectionError):
+                    self.http_pool.close(tunnel)
+                    if not reused or body.mode != "none":
+                        raise
+                    tunnel = None
+                    reused = False
+                except BaseException:
+                    self.http_pool.close(tunnel)
+                    raise
+
+            if response.status == 101:
+                # 协议升级(例如WebSocket)之后按隧道转发，升级请求之后已读取的数据先发给目标
+                conn_logger.info("HTTP连接已升级: %s:%d", host, port)
+                _, up_writer, session = tunnel
+                if buffered:
+                    up_writer.write(session.encode(buffered) if session else buffered)
+                await self._relay(reader, writer, *tunnel)
+                return
+
+            if reusable:
+                self.http_pool.release(key, tunnel)
+            else:
+                self.http_pool.close(tunnel)
+
+            if not keep_client or not request.keep_alive():
+                return
+
+    async def _open_http_tunnel(self, writer, addr, node, host, port):
+        """为HTTP代理请求建立到目标的新隧道，失败时已向客户端返回错误"""
+        admission = self.manager.admission
+        if not await self._wait_admission(admission.try_begin_handshake):
+            self._reject(writer, addr, "同时进行的上游握手过多")
+            return None
+        try:
+            tunnel = await self._open_upstream(node, host, port)
+        finally:
+            admission.end_handshake()
+        if tunnel is None:
+            writer.write(CONNECT_FAILED)
+        return tunnel
+
+    async def _send_http_request(self, reader, tunnel, head, body, buffered):
+        """发送请求头和请求体，返回之后多读到的数据(下一个请求)"""
+        _, up_writer, session = tunnel
+        encode = session.encode if session else (lambda data: data)
+        n = body.feed(buffered)
+        up_writer.write(encode(head + buffered[:n]))
+        buffered = buffered[n:]
+        while not body.done:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionError("客户端在请求体结束前关闭了连接")
+            n = body.feed(data)
+            up_writer.write(encode(data[:n]))
+            await up_writer.drain()
+            self.manager.update_stats(traffic=n)
+            buffered = data[n:]
+        await up_writer.drain()
+        return buffered
+
+    async def _forward_http_response(self, writer, tunnel, request):
+        """把目标服务器的应答转发给客户端
+
+        每次读取目标服务器的数据最多等待RESPONSE_TIMEOUT，应答体的总时长不受限制。
+        返回(应答头, 隧道是否可以复用, 客户端连接是否可以保持)
+        """
+        up_reader, up_writer, session = tunnel
+        decode = _decoder(session, up_writer) if session else (lambda data: data)
+        received = False
+        leftover = b""
+        while True:
+            parser = HeaderParser(response=True)
+            response = parser.feed(leftover) if leftover else None
+            while response is None:
+                data = await asyncio.wait_for(up_reader.read(READ_SIZE), RESPONSE_TIMEOUT)
+                if not data:
+                    if received:
+                        raise ConnectionError("目标服务器在应答头结束前关闭了连接")
+                    raise UpstreamClosed()
+                received = True
+                response = parser.feed(decode(data))
+            leftover = parser.leftover
+
+            # 1xx中间应答(101除外)之后还有最终应答
+            if 100 <= response.status < 200 and response.status != 101:
+                writer.write(response.raw)
+                continue
+            break
+
+        body = BodyFramer.for_response(response, request.method)
+        n = body.feed(leftover)
+        writer.write(response.raw + leftover[:n])
+        extra = len(leftover) - n
+        traffic = len(response.raw) + n
+        if response.status == 101:
+            if extra:
+                writer.write(leftover[n:])
+            self.manager.update_stats(traffic=traffic + extra)
+            return response, False, False
+
+        while not body.done:
+            data = await asyncio.wait_for(up_reader.read(READ_SIZE), RESPONSE_TIMEOUT)
+            if not data:
+                if body.mode == "close":
+                    break
+                raise ConnectionError("目标服务器在应答体结束前关闭了连接")
+            data = decode(data)
+            n = body.feed(data)
+            writer.write(data[:n])
+            await writer.drain()
+            traffic += n
+            extra += len(data) - n
+        await writer.drain()
+        self.manager.update_stats(traffic=traffic)
+
+        # 应答体以连接关闭为结束或目标要求关闭时，客户端连接也要关闭；
+        # 应答之后还有多余数据时隧道不能复用
+        keep_client = body.mode != "close" and response.keep_alive()
+        reusable = keep_client and body.done and not extra
+        return response, reusable, keep_client
+
+    async def _relay(self, reader, writer, up_reader, up_writer, session):
+        """在客户端和上游之间双向转发数据"""
+        encode = session.encode_segments if session else None
+        decode = _decoder(session, up_writer) if session else None
+
+        # 握手完成，之后按空闲时间回收；上游连接也需要在回收时中止
+        conn = current_connection()
+        if conn:
+            conn.add(self._aborter(up_writer))
+            conn.established()
+
+        totals = [0, 0]
+        tasks = [
+            asyncio.ensure_future(self._pump(reader, up_writer, encode, totals, 0, conn)),
+            asyncio.ensure_future(self._pump(up_reader, writer, decode, totals, 1, conn)),
+        ]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception() is not None:
+                    logger.error(f"数据转发错误: {str(task.exception())}")
+            if conn and conn.reaped:
+                conn_logger.info("连接已回收(%s), 总流量: 发送=%d字节, 接收=%d字节",
+                                 conn.reaped, totals[0], totals[1])
+            else:
+                conn_logger.info("连接关闭, 总流量: 发送=%d字节, 接收=%d字节", totals[0], totals[1])
+        finally:
+            up_writer.close()
+
+    async def _pump(self, reader, writer, transform, totals, index, conn=None):
+        """单向转发，字节数累计到totals[index]"""
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                totals[index] += len(data)
+                if conn:
+                    conn.touch()
+                self.manager.update_stats(traffic=len(data))
+                if transform:
+                    data = transform(data)
+                if isinstance(data, list):
+                    # 编码后的多个缓冲区(例如AEAD数据块)交给传输层一起写出
+                    writer.writelines(data)
+                else:
+                    writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError) as e:
+            logger.debug("数据转发结束: %s", e)
+        except ValueError as e:
+            # AEAD标签、协议层MAC或混淆记录校验失败
+            logger.error(f"数据解码或校验失败: {str(e)}")
+
+
+def _decoder(session, up_writer):
+    """返回解码上游数据的函数，混淆层在接收时产生的数据(TLS混淆握手)随即写给上游"""
+    if not session.obfs:
+        return session.decode
+
+    def decode(data):
+        data = session.decode(data)
+        sendback = session.drain_sendback()
+        if sendback:
+            up_writer.write(sendback)
+        return data
+    return decode
+
+
+class _DatagramEndpoint(asyncio.DatagramProtocol):
+    """把收到的数据报交给回调处理"""
+
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        # 节点的UDP端口暂时不可达(ICMP)，之后的数据报仍可能成功
+        logger.debug("UDP数据报发送失败: %s", exc)
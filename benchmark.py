@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能基准测试
+用法:
+    python3 benchmark.py relay [--size 512]    # 本地回环转发吞吐量对比
+    python3 benchmark.py setup [--count 20000] # SSR连接建立(密钥派生+首包)的开销
+    python3 benchmark.py ciphers [--size 16]   # 各加密方式在各实现(pycryptodome/cryptography/RC4)下的加密吞吐量
+    python3 benchmark.py mux [--count 200]     # 多路复用：隧道建立耗时，以及大流量下载时交互流的延迟(使用mux_server.py)
+"""
+
+import argparse
+import socket
+import threading
+import statistics
+import time
+
+import relay
+import ssr_client
+import legacy_ciphers
+import cipher_backends
+from mux import MuxPool
+from mux_server import MuxServer
+
+
+def _tcp_pair():
+    """创建一对已连接的本地回环TCP socket"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+def _run_relay(src, dst, mode):
+    """转发直到src关闭"""
+    tunnel = relay.Tunnel(src, dst, mode)
+    try:
+        relay.run_tunnel(tunnel)
+    finally:
+        tunnel.close()
+
+
+def bench_relay(mode, size_mb):
+    """测量一种转发模式的吞吐量，返回MB/s"""
+    total = size_mb * 1024 * 1024
+    source, relay_in = _tcp_pair()
+    relay_out, sink = _tcp_pair()
+
+    relay_thread = threading.Thread(target=_run_relay, args=(relay_in, relay_out, mode))
+    relay_thread.start()
+
+    def produce():
+        chunk = b"\x00" * 65536
+        sent = 0
+        while sent < total:
+            source.sendall(chunk)
+            sent += len(chunk)
+        source.shutdown(socket.SHUT_WR)
+
+    start = time.perf_counter()
+    producer = threading.Thread(target=produce)
+    producer.start()
+
+    buf = bytearray(262144)
+    received = 0
+    while True:
+        n = sink.recv_into(buf)
+        if not n:
+            break
+        received += n
+    elapsed = time.perf_counter() - start
+
+    producer.join()
+    relay_thread.join()
+    for s in (source, sink):
+        s.close()
+
+    if received != total:
+        raise RuntimeError(f"数据不完整: {received}/{total}")
+    return size_mb / elapsed
+
+
+def cmd_relay(args):
+    modes = ["copy"]
+    if relay.SPLICE_AVAILABLE:
+        modes.append("splice")
+    else:
+        print("当前系统不支持splice，仅测试copy模式")
+
+    print(f"本地回环转发吞吐量 ({args.size} MB, 取 {args.rounds} 轮最好成绩):")
+    for mode in modes:
+        best = max(bench_relay(mode, args.size) for _ in range(args.rounds))
+        print(f"  {mode:<8} {best:10.1f} MB/s")
+
+
+def bench_setup(method, protocol, count, cached):
+    """测量每个连接生成首包的耗时，返回微秒
+
+    cached为True时所有连接共用一个SSRClient(与ClientRegistry相同，密钥和认证头加密器只准备一次)；
+    为False时每个连接清空密钥缓存并重新创建SSRClient。
+    """
+    def new_client():
+        return ssr_client.SSRClient("127.0.0.1", 8388, "benchmark-password", method, protocol,
+                                    protocol_param="12345:benchmark")
+
+    client = new_client()
+    start = time.perf_counter()
+    for _ in range(count):
+        if not cached:
+            ssr_client.derive_key.cache_clear()
+            client = new_client()
+        client.new_session().handshake("example.com", 443)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def cmd_setup(args):
+    if not ssr_client.CRYPTO_AVAILABLE:
+        print("未安装cryptography，无法测试")
+        return
+
+    print(f"SSR连接建立开销 ({args.count} 次, 取 {args.rounds} 轮最好成绩):")
+    for method, protocol in (("aes-256-cfb", "origin"), ("aes-256-cfb", "auth_aes128_md5"),
+                             ("chacha20-ietf", "auth_aes128_md5")):
+        uncached = min(bench_setup(method, protocol, args.count, False) for _ in range(args.rounds))
+        cached = min(bench_setup(method, protocol, args.count, True) for _ in range(args.rounds))
+        print(f"  {method:<14} {protocol:<16} 每次派生 {uncached:7.1f} us  缓存 {cached:7.1f} us")
+
+
+CIPHER_METHODS = ("aes-128-cfb", "aes-256-cfb", "aes-256-ctr", "chacha20-ietf",
+                  "aes-128-gcm", "aes-256-gcm", "chacha20-ietf-poly1305", "rc4-md5", "table")
+
+
+def bench_cipher(new_cipher, size_mb, chunk=16384):
+    """测量加密吞吐量，返回MB/s"""
+    data = bytes(chunk)
+    count = size_mb * 1024 * 1024 // chunk
+    cipher = new_cipher()
+    start = time.perf_counter()
+    for _ in range(count):
+        cipher.encrypt(data)
+    return size_mb / (time.perf_counter() - start)
+
+
+def cmd_ciphers(args):
+    print("旧式加密自检:", ", ".join(f"{name} {'通过' if ok else '失败'}"
+                                 for name, ok in legacy_ciphers.self_test().items()))
+
+    print(f"加密吞吐量 ({args.size} MB, 每次 16 KB, 取 {args.rounds} 轮最好成绩):")
+    results = []
+    for method in CIPHER_METHODS:
+        if method in cipher_backends.KNOWN_ANSWERS:
+            # 每个通过自检的实现
+            key = ssr_client.derive_key("benchmark-password", method)
+            for name, backend in cipher_backends.BACKENDS.items():
+                if not cipher_backends.check(backend, method):
+                    print(f"  {method} ({name}) 未通过自检")
+                    continue
+                iv = bytes(cipher_backends._iv_length(method))
+                results.append((f"{method} ({name})", lambda backend=backend, method=method, key=key, iv=iv:
+                                cipher_backends.new_cipher(backend, method, key, iv)))
+            continue
+        client = ssr_client.SSRClient("127.0.0.1", 8388, "benchmark-password", method)
+        if not client.cipher_supported:
+            print(f"  {method:<24} 不可用")
+            continue
+        iv = client._random_iv()
+        results.append((method, lambda client=client, iv=iv: client._create_cipher(client.key, iv)))
+
+    # rc4-md5的每个可用实现
+    key = ssr_client.derive_key("benchmark-password", "rc4-md5")
+    for name, new in legacy_ciphers.RC4_BACKENDS:
+        if legacy_ciphers.rc4_usable(new):
+            results.append((f"rc4-md5 ({name})",
+                            lambda name=name: legacy_ciphers.new_rc4_md5(key, bytes(16), name)))
+
+    for label, new_cipher in results:
+        # 纯Python实现很慢，只测试较少的数据量
+        size = 1 if label.endswith("(python)") else args.size
+        best = max(bench_cipher(new_cipher, size) for _ in range(args.rounds))
+        print(f"  {label:<38} {best:10.1f} MB/s")
+
+
+def _mux_target():
+    """多路复用测试的目标服务器：首字节E为回显，B为持续发送数据，返回端口"""
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve(conn):
+        command = conn.recv(1)
+        try:
+            if command == b"E":
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    conn.sendall(data)
+            elif command == b"B":
+                chunk = bytes(65536)
+                while True:
+                    conn.sendall(chunk)
+        except OSError:
+            pass
+        conn.close()
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def _echo_latency(sock, count):
+    """一个字节回显的往返时间，返回(中位数, P99)，单位毫秒"""
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        sock.sendall(b"p")
+        if not sock.recv(16):
+            raise RuntimeError("回显连接已关闭")
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+def cmd_mux(args):
+    target = _mux_target()
+    server = MuxServer("127.0.0.1", 0, "benchmark-password", args.method)
+    server.start()
+    client = ssr_client.SSRClient("127.0.0.1", server.address[1], "benchmark-password", args.method)
+    pool = MuxPool(connections=1, max_streams=args.count)
+
+    def ssr_tunnel():
+        return client.create_connection("127.0.0.1", target, early_data=b"E")
+
+    def mux_tunnel():
+        return pool.open_stream(client, "127.0.0.1", target, b"E")
+
+    print(f"隧道建立到首个回显 ({args.method}, {args.count} 次，本地回环没有握手往返的延迟):")
+    for label, open_tunnel in (("单独SSR连接", ssr_tunnel), ("多路复用流", mux_tunnel)):
+        accepted = server.accepted
+        start = time.perf_counter()
+        for _ in range(args.count):
+            tunnel = open_tunnel()
+            tunnel.sendall(b"p")
+            tunnel.recv(16)
+            tunnel.close()
+        elapsed = (time.perf_counter() - start) / args.count * 1e3
+        print(f"  {label:<12} {elapsed:8.2f} ms  到节点的TCP连接 {server.accepted - accepted} 个")
+
+    echo = mux_tunnel()
+    idle = _echo_latency(echo, args.samples)
+    # 一个下载流正常读取，一个下载流的本地端完全不读取
+    bulk = pool.open_stream(client, "127.0.0.1", target, b"B")
+    stalled = pool.open_stream(client, "127.0.0.1", target, b"B")
+    received = [0]
+
+    def drain():
+        buf = bytearray(262144)
+        try:
+            while True:
+                n = bulk.recv_into(buf)
+                if not n:
+                    break
+                received[0] += n
+        except OSError:
+            pass
+
+    threading.Thread(target=drain, daemon=True).start()
+    time.sleep(0.5)
+    start = time.perf_counter()
+    start_bytes = received[0]
+    busy = _echo_latency(echo, args.samples)
+    rate = (received[0] - start_bytes) / (time.perf_counter() - start) / 1024 / 1024
+    print(f"同一连接上交互流的回显延迟 ({args.samples} 次):")
+    print(f"  空闲时               中位数 {idle[0]:6.2f} ms  P99 {idle[1]:6.2f} ms")
+    print(f"  两个下载流进行中     中位数 {busy[0]:6.2f} ms  P99 {busy[1]:6.2f} ms  (下载 {rate:.1f} MB/s，另一个下载流不读取)")
+    for sock in (echo, bulk, stalled):
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Symi Proxy 性能基准测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("relay", help="本地回环转发吞吐量对比")
+    p.add_argument("--size", type=int, default=512, help="每轮传输的数据量(MB)")
+    p.add_argument("--rounds", type=int, default=3, help="测试轮数")
+    p.set_defaults(func=cmd_relay)
+
+    p = sub.add_parser("setup", help="SSR连接建立(密钥派生+首包)的开销")
+    p.add_argument("--count", type=int, default=20000, help="每轮建立的连接数")
+    p.add_argument("--rounds", type=int, default=3, help="测试轮数")
+    p.set_defaults(func=cmd_setup)
+
+    p = sub.add_parser("ciphers", help="各加密方式的加密吞吐量")
+    p.add_argument("--size", type=int, default=16, help="每轮加密的数据量(MB)")
+    p.add_argument("--rounds", type=int, default=3, help="测试轮数")
+    p.set_defaults(func=cmd_ciphers)
+
+    p = sub.add_parser("mux", help="多路复用的隧道建立耗时和交互流延迟")
+    p.add_argument("--count", type=int, default=200, help="建立的隧道数")
+    p.add_argument("--samples", type=int, default=500, help="回显延迟的采样次数")
+    p.add_argument("--method", default="aes-256-gcm", help="加密方式")
+    p.set_defaults(func=cmd_mux)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
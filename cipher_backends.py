@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+加密实现(后端)的选择
+aes-cfb/ctr、chacha20流加密和AEAD加密各有pycryptodome和cryptography(OpenSSL)两种实现。
+启动时每种加密方式先用已知答案(KAT)检查各实现，再在内存中测量加密吞吐量，
+选用当前CPU上最快的实现：例如没有AES指令的ARM上ChaCha20远快于AES，两个库的相对速度也不同。
+未经过选择(例如benchmark.py或测试脚本)时，按STATIC_ORDER使用第一个可用的实现。
+
+rc4-md5和table由legacy_ciphers处理。
+"""
+
+import time
+import hashlib
+import logging
+import functools
+import threading
+
+from aead import AeadCipher, AEAD_METHODS, TAG_SIZE
+from legacy_ciphers import StreamCipher, rc4_backend
+
+logger = logging.getLogger("cipher_backends")
+
+# 流加密方式 -> (密钥长度, IV长度)
+STREAM_METHODS = {
+    'aes-128-cfb': (16, 16), 'aes-192-cfb': (24, 16), 'aes-256-cfb': (32, 16),
+    'aes-128-ctr': (16, 16), 'aes-192-ctr': (24, 16), 'aes-256-ctr': (32, 16),
+    'chacha20': (32, 8), 'chacha20-ietf': (32, 12),
+}
+
+# 未经过选择时的实现顺序：多数平台上OpenSSL更快(benchmark.py ciphers)
+STATIC_ORDER = ("cryptography", "pycryptodome")
+
+# 每种加密方式、每个实现的测量时间(秒)和每次加密的数据量
+BENCHMARK_SECONDS = 0.01
+BENCHMARK_CHUNK = 16384
+
+# 已知答案: 加密方式 -> SHA256(密文)
+# 密钥为 bytes(range(密钥长度))，IV/salt为 bytes(range(IV长度))，明文为64个0字节；
+# 流加密分10字节和54字节两次加密，同时检查实现能正确保持状态；AEAD为首个数据块(长度+数据)的密文
+KNOWN_ANSWERS = {
+    'aes-128-cfb': "99ca27e3ada5c5458655eb4e61d0c5545beb7e63a2761c689da739345e48c52f",
+    'aes-192-cfb': "9754d09db32712ad4e663231a2c5509bb6f58743ecc8543e3b2cd16c1c1a225e",
+    'aes-256-cfb': "7ab9bd895ad720e54509ae0d72a1ade3810009917e162f52506c9f618bb186f7",
+    'aes-128-ctr': "ed98a95e455803b2af524837ec1c4608a2c499a99b3382c69837fc20f6f941f9",
+    'aes-192-ctr': "384e2c8c761a1b3ea799d2e0fd6aed55fe60fd75ed157bdc1f800568120f6b14",
+    'aes-256-ctr': "df12d1e763997ac26033bebc2a2f13bce5df956421d4df5d547c55eaa7154cbe",
+    'chacha20': "beab36121eac533ca04aafc03efb6b6b61d35a47342ecb698a75f1b9685395f2",
+    'chacha20-ietf': "baefa48c91d97867eb92378b263471410d9057eac5472137f9e6115c14e17610",
+    'aes-128-gcm': "1aaa3ccd92ebd36feb451bcf80f9f28dab95aef7992f261f3da1daa3021e1a50",
+    'aes-192-gcm': "fe165c37c080b755a6bd60a4741af0bae647246a668d6be10f57bf4d76f32f20",
+    'aes-256-gcm': "39577db1dcf0853edb330ecc98d3a52d6ebdb311ea058c6e520a44b991fc7dfb",
+    'chacha20-ietf-poly1305': "bda533413ef6f367a481ddb5291cf56a360458bd80b317699c4f757d21f7dfed",
+}
+
+
+class PycryptodomeBackend:
+    """pycryptodome实现"""
+
+    name = "pycryptodome"
+
+    def __init__(self):
+        from Crypto.Cipher import AES, ChaCha20, ChaCha20_Poly1305
+        self.AES = AES
+        self.ChaCha20 = ChaCha20
+        self.ChaCha20_Poly1305 = ChaCha20_Poly1305
+
+    def stream(self, method, key, iv, encrypt):
+        """创建流加密器，encrypt/decrypt(data, output=None)"""
+        AES = self.AES
+        if method.endswith('-ctr'):
+            # 整个IV作为128位计数器，与OpenSSL一致
+            return AES.new(key, AES.MODE_CTR, nonce=b"", initial_value=iv)
+        if method.endswith('-cfb'):
+            # SS/SSR的AES-CFB为CFB128，pycryptodome默认的segment_size是8
+            return AES.new(key, AES.MODE_CFB, iv, segment_size=128)
+        return self.ChaCha20.new(key=key, nonce=iv)
+
+    def aead(self, method, key):
+        return _PycryptodomeAead(self, method, key)
+
+    def ecb_encryptor(self, key):
+        return self.AES.new(key, self.AES.MODE_ECB).encrypt
+
+
+class _PycryptodomeAead:
+    """pycryptodome的AEAD对象只能用于一个nonce，每次加密/解密新建"""
+
+    def __init__(self, backend, method, key):
+        self.key = key
+        if method == 'chacha20-ietf-poly1305':
+            self._new = lambda nonce: backend.ChaCha20_Poly1305.new(key=key, nonce=nonce)
+        else:
+            AES = backend.AES
+            self._new = lambda nonce: AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+
+    def seal(self, nonce, data):
+        """加密，返回依次排列的缓冲区(密文, tag)"""
+        return self._new(nonce).encrypt_and_digest(data)
+
+    def open(self, nonce, data):
+        """解密 密文+tag，认证失败时抛出ValueError"""
+        return self._new(nonce).decrypt_and_verify(data[:-TAG_SIZE], data[-TAG_SIZE:])
+
+    def open_into(self, nonce, data, output):
+        """解密 密文+tag 到output"""
+        cipher = self._new(nonce)
+        # ChaCha20_Poly1305的decrypt_and_verify不支持output，分两步解密和校验
+        cipher.decrypt(data[:-TAG_SIZE], output=output)
+        cipher.verify(data[-TAG_SIZE:])
+
+
+class CryptographyBackend:
+    """cryptography(OpenSSL)实现"""
+
+    name = "cryptography"
+
+    def __init__(self):
+        from cryptography.exceptions import InvalidTag
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+        try:
+            from cryptography.hazmat.decrepit.ciphers.modes import CFB
+        except ImportError:
+            CFB = modes.CFB
+        self.CFB = CFB
+        self.InvalidTag = InvalidTag
+        self.Cipher = Cipher
+        self.algorithms = algorithms
+        self.modes = modes
+        self.AESGCM = AESGCM
+        self.ChaCha20Poly1305 = ChaCha20Poly1305
+
+    def stream(self, method, key, iv, encrypt):
+        algorithms, modes = self.algorithms, self.modes
+        if method.endswith('-ctr'):
+            cipher = self.Cipher(algorithms.AES(key), modes.CTR(iv))
+        elif method.endswith('-cfb'):
+            cipher = self.Cipher(algorithms.AES(key), self.CFB(iv))
+        else:
+            # OpenSSL的ChaCha20使用16字节IV(计数器 + nonce)，计数器从0开始
+            cipher = self.Cipher(algorithms.ChaCha20(key, bytes(16 - len(iv)) + iv), mode=None)
+        # CFB的加密和解密不同，其他模式相同
+        context = cipher.encryptor() if encrypt else cipher.decryptor()
+        return StreamCipher(context.update)
+
+    def aead(self, method, key):
+        return _CryptographyAead(self, method, key)
+
+    def ecb_encryptor(self, key):
+        # ECB没有状态，同一个加密上下文可以一直使用
+        return self.Cipher(self.algorithms.AES(key), self.modes.ECB()).encryptor().update
+
+
+class _CryptographyAead:
+    """cryptography的AEAD对象可以重复使用，密钥扩展只做一次"""
+
+    def __init__(self, backend, method, key):
+        if method == 'chacha20-ietf-poly1305':
+            self.aead = backend.ChaCha20Poly1305(key)
+        else:
+            self.aead = backend.AESGCM(key)
+        self.InvalidTag = backend.InvalidTag
+
+    def seal(self, nonce, data):
+        # 密文和tag在一个缓冲区中
+        return (self.aead.encrypt(nonce, data, None),)
+
+    def open(self, nonce, data):
+        try:
+            return self.aead.decrypt(nonce, data, None)
+        except self.InvalidTag:
+            raise ValueError("AEAD数据认证失败")
+
+    def open_into(self, nonce, data, output):
+        output[:] = self.open(nonce, data)
+
+
+def _load_backends():
+    backends = {}
+    for backend_class in (PycryptodomeBackend, CryptographyBackend):
+        try:
+            backends[backend_class.name] = backend_class()
+        except ImportError:
+            logger.debug("加密库 %s 不可用", backend_class.name)
+    return backends
+
+
+# 已安装的实现: 名称 -> 后端
+BACKENDS = _load_backends()
+
+# 加密方式 -> 选用的实现名称
+SELECTED = {}
+# 加密方式 -> {"backend": 选用的实现, "throughput": {实现: MB/s}}，启动时测量
+REPORT = {}
+# 是否已经选择过实现；未选择时(如benchmark.py)按STATIC_ORDER使用第一个已安装的实现
+_selection_done = False
+
+
+def methods():
+    """本模块处理的所有加密方式"""
+    return list(STREAM_METHODS) + list(AEAD_METHODS)
+
+
+def _iv_length(method):
+    return STREAM_METHODS[method][1] if method in STREAM_METHODS else AEAD_METHODS[method][1]
+
+
+def _key_length(method):
+    return STREAM_METHODS[method][0] if method in STREAM_METHODS else AEAD_METHODS[method][0]
+
+
+def new_cipher(backend, method, key, iv, encrypt=True):
+    """用指定实现创建加密器(AEAD为AeadCipher)"""
+    if method in AEAD_METHODS:
+        return AeadCipher(key, iv, lambda subkey: backend.aead(method, subkey))
+    return backend.stream(method, key, iv, encrypt)
+
+
+def _known_answer(backend, method):
+    """用已知答案检查实现，返回SHA256(密文)，实现出错时返回None"""
+    key = bytes(range(_key_length(method)))
+    iv = bytes(range(_iv_length(method)))
+    data = bytes(64)
+    try:
+        cipher = new_cipher(backend, method, key, iv)
+        if method in AEAD_METHODS:
+            ciphertext = cipher.encrypt(data)
+        else:
+            ciphertext = cipher.encrypt(data[:10]) + cipher.encrypt(data[10:])
+        if new_cipher(backend, method, key, iv, encrypt=False).decrypt(ciphertext) != data:
+            return None
+        return hashlib.sha256(ciphertext).hexdigest()
+    except Exception as e:
+        logger.debug("加密实现 %s 的 %s 自检出错: %s", backend.name, method, e)
+        return None
+
+
+def check(backend, method):
+    """实现通过已知答案检查时返回True"""
+    return _known_answer(backend, method) == KNOWN_ANSWERS[method]
+
+
+def measure(backend, method, seconds=BENCHMARK_SECONDS, chunk=BENCHMARK_CHUNK):
+    """在内存中测量加密吞吐量，返回MB/s"""
+    cipher = new_cipher(backend, method, bytes(_key_length(method)), bytes(_iv_length(method)))
+    data = bytes(chunk)
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        cipher.encrypt(data)
+        count += 1
+        now = time.perf_counter()
+        if now >= deadline and count >= 3:
+            break
+    return count * chunk / (now - start) / (1024 * 1024)
+
+
+def select(forced=None):
+    """为每种加密方式选择实现，forced为实现名称时只要可用就使用该实现"""
+    global _selection_done
+    _selection_done = True
+    SELECTED.clear()
+    REPORT.clear()
+    for method in methods():
+        usable = [backend for backend in BACKENDS.values() if check(backend, method)]
+        failed = [name for name in BACKENDS if name not in {backend.name for backend in usable}]
+        if failed:
+            logger.warning(f"加密实现 {', '.join(failed)} 的 {method} 未通过自检，不使用")
+        if not usable:
+            continue
+        throughput = {}
+        chosen = next((backend.name for backend in usable if backend.name == forced), None)
+        if chosen is None:
+            throughput = {backend.name: round(measure(backend, method), 1) for backend in usable}
+            chosen = max(throughput, key=throughput.get)
+        SELECTED[method] = chosen
+        REPORT[method] = {"backend": chosen, "throughput": throughput}
+    logger.info("加密实现: " + ", ".join(
+        f"{method}={info['backend']}" + (f"({info['throughput'][info['backend']]:.0f}MB/s)" if info["throughput"] else "")
+        for method, info in REPORT.items()))
+    return REPORT
+
+
+def configure(options):
+    """按配置选择各加密方式的实现
+
+    cipher_backend: auto时测量吞吐量选用最快的实现；也可以指定pycryptodome或cryptography
+    """
+    forced = options.get("cipher_backend", "auto")
+    if forced != "auto" and forced not in BACKENDS:
+        logger.warning(f"加密实现 {forced} 不可用，改为自动选择")
+        forced = None
+    return select(None if forced == "auto" else forced)
+
+
+def backend_for(method):
+    """加密方式选用的实现，没有可用的实现时返回None
+
+    选择过实现后，所有实现都未通过自检的加密方式不在SELECTED中，返回None
+    """
+    name = SELECTED.get(method)
+    if name is None and not _selection_done:
+        name = next((name for name in STATIC_ORDER if name in BACKENDS), None)
+    return BACKENDS.get(name)
+
+
+def factory(method):
+    """返回创建加密器的函数 factory(key, iv, encrypt)，加密方式不支持或没有可用实现时返回None"""
+    if method not in STREAM_METHODS and method not in AEAD_METHODS:
+        return None
+    backend = backend_for(method)
+    if backend is None:
+        return None
+    if method in AEAD_METHODS:
+        # AEAD的iv即salt，每个方向派生各自的子密钥
+        new_aead = functools.partial(backend.aead, method)
+        return lambda key, salt, encrypt: AeadCipher(key, salt, new_aead)
+    stream = backend.stream
+    return lambda key, iv, encrypt: stream(method, key, iv, encrypt)
+
+
+def ecb_encryptor(key):
+    """返回AES-ECB加密函数 encrypt(block)(协议层认证头)，密钥扩展只做一次，可以在多个线程中使用"""
+    backend = backend_for('aes-128-cfb') or next(
+        (BACKENDS[name] for method, name in SELECTED.items() if method.startswith("aes-")), None)
+    if backend is None:
+        raise RuntimeError("没有通过自检的AES实现")
+    encrypt = backend.ecb_encryptor(key)
+    lock = threading.Lock()
+
+    def locked(block):
+        with lock:
+            return encrypt(block)
+    return locked
+
+
+def get_report():
+    """选用的实现和吞吐量，供Web API显示"""
+    try:
+        rc4 = rc4_backend()[0]
+    except RuntimeError:
+        rc4 = None
+    return {
+        "available": list(BACKENDS),
+        "selected": dict(SELECTED),
+        "methods": dict(REPORT),
+        "rc4": rc4,
+    }
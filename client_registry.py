@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSR客户端注册表
+节点表变化时为每个SSR节点预先构造一个SSRClient(密钥、IV长度和加密器构造函数都已确定)，
+建立隧道时按节点直接取用，不再为每个连接重新构造客户端。
+SSRClient构造后不再修改，连接各自的状态保存在SSRSession中，多个线程/协程可以共用。
+节点的配置(地址、密码、加密方式、协议、混淆等)变化时，该节点的客户端随节点表一起重建。
+"""
+
+import logging
+import threading
+
+try:
+    from ssr_client import SSRClient
+except ImportError:
+    SSRClient = None
+
+logger = logging.getLogger("client_registry")
+
+
+def node_fingerprint(node):
+    """决定SSRClient内容的节点配置"""
+    return (node.address, node.port, node.password, node.method, node.protocol, node.obfs,
+            node.protocol_param, node.obfs_param)
+
+
+class ClientRegistry:
+    """按节点保存构造好的SSRClient"""
+
+    def __init__(self):
+        self._clients = {}  # Node -> (节点配置, SSRClient或None)
+        self._lock = threading.Lock()
+        self.builds = 0
+
+    def _build(self, node):
+        """构造节点的SSRClient，加密方式、协议或混淆不可用时返回None"""
+        if SSRClient is None:
+            return None
+        self.builds += 1
+        client = SSRClient(
+            server=node.address,
+            port=node.port,
+            password=node.password,
+            method=node.method or 'rc4-md5',
+            protocol=node.protocol or 'origin',
+            obfs=node.obfs or 'plain',
+            protocol_param=node.protocol_param or '',
+            obfs_param=node.obfs_param or ''
+        )
+        if not client.cipher_supported:
+            logger.error(f"节点 {node.name} 的加密方式 {client.method} 不受支持或缺少加密库，无法使用")
+            return None
+        if not client.protocol_supported:
+            logger.error(f"节点 {node.name} 的协议 {client.protocol} 不受支持，无法使用")
+            return None
+        if not client.obfs_supported:
+            logger.error(f"节点 {node.name} 的混淆 {client.obfs} 不受支持，无法使用")
+            return None
+        return client
+
+    def update(self, nodes):
+        """节点表变化后重建注册表，配置没有变化的节点沿用原来的客户端"""
+        with self._lock:
+            previous = {fingerprint: client for fingerprint, client in self._clients.values()}
+            clients = {}
+            for node in nodes:
+                if not node.password:
+                    continue
+                fingerprint = node_fingerprint(node)
+                if fingerprint in previous:
+                    client = previous[fingerprint]
+                else:
+                    client = self._build(node)
+                clients[node] = (fingerprint, client)
+            # 整体替换，查询不需要加锁
+            self._clients = clients
+
+    def get(self, node):
+        """返回节点的SSRClient，加密方式、协议或混淆不可用时返回None"""
+        entry = self._clients.get(node)
+        if entry is not None:
+            return entry[1]
+
+        # 不在节点表中的节点(例如节点表刚刚更新)，构造后加入注册表
+        with self._lock:
+            entry = self._clients.get(node)
+            if entry is None:
+                entry = (node_fingerprint(node), self._build(node))
+                self._clients[node] = entry
+        return entry[1]
+
+    def get_stats(self):
+        """获取注册表统计信息"""
+        return {"clients": len(self._clients), "builds": self.builds}
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DNS解析缓存
+节点地址的解析结果按主机名缓存，建立连接和节点检查不再每次阻塞调用getaddrinfo。
+getaddrinfo不返回TTL，缓存时间由配置决定；条目快过期时在后台提前刷新，
+解析失败时在一段时间内继续使用过期的结果。
+"""
+
+import time
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger("dns_cache")
+
+# 条目存活时间超过TTL的此比例后，访问时在后台提前刷新
+REFRESH_AHEAD = 0.8
+# 解析失败后在此时间(秒)内直接使用过期结果，不再重复阻塞解析
+FAILURE_BACKOFF = 10
+# 后台并发解析的线程数
+RESOLVE_WORKERS = 8
+
+
+class _Entry:
+    """一个主机名的解析结果"""
+
+    __slots__ = ("addresses", "resolved_at", "failed_at", "refreshing")
+
+    def __init__(self, addresses):
+        self.addresses = addresses  # [(family, 不含端口的sockaddr)]
+        self.resolved_at = time.time()
+        self.failed_at = 0
+        self.refreshing = False
+
+
+def _is_ip(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except OSError:
+            continue
+    return False
+
+
+class DnsCache:
+    """按主机名缓存解析结果"""
+
+    def __init__(self, ttl=300, stale_ttl=3600):
+        """
+        参数:
+            ttl: 解析结果的缓存时间(秒)，0表示不缓存
+            stale_ttl: 过期后解析失败时，过期结果还可以继续使用的时间(秒)
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _submit(self, func, *args):
+        """在后台解析线程中执行"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=RESOLVE_WORKERS, thread_name_prefix="dns")
+        return self._executor.submit(func, *args)
+
+    def _resolve(self, host):
+        """调用getaddrinfo，返回去重后的[(family, 不含端口的sockaddr)]"""
+        addresses = []
+        for family, _, _, _, sockaddr in socket.getaddrinfo(host, 0, 0, socket.SOCK_STREAM):
+            address = (family, (sockaddr[0],) + tuple(sockaddr[2:]))
+            if address not in addresses:
+                addresses.append(address)
+        return addresses
+
+    def _update(self, host):
+        """重新解析并更新缓存，失败时保留原有条目"""
+        try:
+            addresses = self._resolve(host)
+        except OSError:
+            with self._lock:
+                self.failures += 1
+                entry = self._entries.get(host)
+                if entry:
+                    entry.failed_at = time.time()
+                    entry.refreshing = False
+            raise
+        with self._lock:
+            self._entries[host] = _Entry(addresses)
+        return addresses
+
+    def _refresh(self, host):
+        try:
+            self._update(host)
+            self.refreshes += 1
+        except OSError as e:
+            logger.warning(f"后台刷新 {host} 的解析结果失败: {str(e)}")
+
+    def _cached(self, host):
+        """返回可以直接使用的缓存结果，需要阻塞解析时返回None"""
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is None:
+                return None
+            now = time.time()
+            age = now - entry.resolved_at
+            if age < self.ttl:
+                self.hits += 1
+                if age > self.ttl * REFRESH_AHEAD and not entry.refreshing:
+                    entry.refreshing = True
+                    refresh = True
+                else:
+                    refresh = False
+            elif now - entry.failed_at < FAILURE_BACKOFF and age < self.ttl + self.stale_ttl:
+                # 刚刚解析失败过，直接使用过期结果
+                self.stale += 1
+                return entry.addresses
+            else:
+                return None
+        if refresh:
+            self._submit(self._refresh, host)
+        return entry.addresses
+
+    def lookup(self, host):
+        """只查询缓存，不会阻塞；需要解析时返回None"""
+        if not self.enabled or _is_ip(host):
+            return None
+        return self._cached(host)
+
+    def resolve(self, host):
+        """返回主机名的[(family, 不含端口的sockaddr)]，缓存不可用时阻塞解析"""
+        if not self.enabled or _is_ip(host):
+            return self._resolve(host)
+        addresses = self._cached(host)
+        if addresses is not None:
+            return addresses
+
+        self.misses += 1
+        try:
+            return self._update(host)
+        except OSError:
+            with self._lock:
+                entry = self._entries.get(host)
+            if entry and time.time() - entry.resolved_at < self.ttl + self.stale_ttl:
+                self.stale += 1
+                logger.warning(f"解析 {host} 失败，继续使用过期的解析结果")
+                return entry.addresses
+            raise
+
+    def prefetch(self, hosts, timeout=None):
+        """并发解析缓存中没有或即将过期的主机名，等待完成或超时"""
+        if not self.enabled:
+            return
+        now = time.time()
+        pending = []
+        with self._lock:
+            for host in set(hosts):
+                if not host or _is_ip(host):
+                    continue
+                entry = self._entries.get(host)
+                if entry and now - entry.resolved_at < self.ttl * REFRESH_AHEAD:
+                    continue
+                pending.append(host)
+        futures = [self._submit(self._refresh, host) for host in pending]
+        if futures:
+            wait(futures, timeout)
+
+    def get_stats(self):
+        """获取缓存统计信息"""
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+
+def _with_port(addresses, port, socktype):
+    """把缓存的地址转换为getaddrinfo格式"""
+    return [(family, socktype, 0, "", (sockaddr[0], port) + sockaddr[1:]) for family, sockaddr in addresses]
+
+
+# 全局解析缓存
+DNS_CACHE = DnsCache()
+
+
+def configure(options):
+    """按配置重建全局解析缓存"""
+    global DNS_CACHE
+    DNS_CACHE = DnsCache(options.get("dns_cache_ttl", 300), options.get("dns_stale_ttl", 3600))
+    return DNS_CACHE
+
+
+def getaddrinfo(host, port, socktype=socket.SOCK_STREAM):
+    """与socket.getaddrinfo相同，主机名的解析结果来自缓存"""
+    return _with_port(DNS_CACHE.resolve(host), port, socktype)
+
+
+def lookup(host, port, socktype=socket.SOCK_STREAM):
+    """只查询缓存，需要阻塞解析时返回None"""
+    addresses = DNS_CACHE.lookup(host)
+    if addresses is None:
+        return None
+    return _with_port(addresses, port, socktype)
+
+
+def prefetch(hosts, timeout=None):
+    DNS_CACHE.prefetch(hosts, timeout)
+
+
+def get_stats():
+    return DNS_CACHE.get_stats()
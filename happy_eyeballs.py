@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+并行竞速连接 (Happy Eyeballs)
+对多个节点及其IPv4/IPv6地址错开时间发起连接，第一个完成上游握手的连接胜出，
+其余连接立即取消。所有尝试在同一个selector中以非阻塞方式进行，不额外创建线程。
+"""
+
+import errno
+import socket
+import time
+import logging
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+
+import sockopts
+import dns_cache
+
+logger = logging.getLogger("happy_eyeballs")
+
+# 每个节点最多尝试的地址数（IPv6和IPv4各一个）
+ADDRESSES_PER_NODE = 2
+
+
+def resolve_addresses(host, port, limit=ADDRESSES_PER_NODE):
+    """解析地址并按IPv6/IPv4交替排列"""
+    return order_addresses(dns_cache.getaddrinfo(host, port), limit)
+
+
+def order_addresses(infos, limit=ADDRESSES_PER_NODE):
+    """把getaddrinfo的结果按IPv6/IPv4交替排列，返回[(family, sockaddr)]"""
+    v6 = [(info[0], info[4]) for info in infos if info[0] == socket.AF_INET6]
+    v4 = [(info[0], info[4]) for info in infos if info[0] == socket.AF_INET]
+    ordered = []
+    for i in range(max(len(v6), len(v4))):
+        if i < len(v6):
+            ordered.append(v6[i])
+        if i < len(v4):
+            ordered.append(v4[i])
+    return ordered[:limit]
+
+
+class ConnectAttempt:
+    """一次非阻塞的连接+握手尝试
+
+    payload: 连接建立后立即发送的握手数据
+    check_reply: 需要等待上游应答时提供，参数为已收到的数据，返回应答的长度表示握手成功，
+                 False表示失败，None表示还需要更多数据。
+                 只从socket中取走应答本身，之后的数据留给转发。
+    """
+
+    def __init__(self, node, family, sockaddr, payload=b"", check_reply=None, context=None):
+        self.node = node
+        self.family = family
+        self.sockaddr = sockaddr
+        self.payload = payload
+        self.check_reply = check_reply
+        self.context = context  # 调用方附带的数据，例如SSR会话
+        self.sock = None
+        self.state = "connecting"
+        self.reply = b""
+
+    def __repr__(self):
+        return f"{self.node.name}@{self.sockaddr[0]}:{self.sockaddr[1]}"
+
+    def start(self, sel):
+        """发起非阻塞连接"""
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sockopts.apply_upstream(self.sock)
+        self.sock.setblocking(False)
+        err = self.sock.connect_ex(self.sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise OSError(err, errno.errorcode.get(err, "connect失败"))
+        sel.register(self.sock, EVENT_WRITE, self)
+
+    def on_event(self, sel, mask):
+        """处理事件，返回True表示握手完成"""
+        if self.state == "connecting":
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, errno.errorcode.get(err, "connect失败"))
+            self.state = "sending"
+
+        if self.state == "sending":
+            if self.payload:
+                try:
+                    sent = self.sock.send(self.payload)
+                except BlockingIOError:
+                    # 启用TFO时握手在第一次发送时才进行
+                    return False
+                self.payload = self.payload[sent:]
+                if self.payload:
+                    return False
+            if self.check_reply is None:
+                return True
+            self.state = "waiting"
+            sel.modify(self.sock, EVENT_READ, self)
+            return False
+
+        data = self.sock.recv(4096, socket.MSG_PEEK)
+        if not data:
+            raise ConnectionError("上游关闭了连接")
+        reply = self.reply + data
+        result = self.check_reply(reply)
+        if result is None:
+            # 应答还不完整，已查看的数据都属于应答
+            self.reply += self.sock.recv(len(data))
+            return False
+        if not result:
+            raise ConnectionError(f"上游拒绝握手: {reply[:64]!r}")
+        self.sock.recv(result - len(self.reply))
+        return True
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+def race(attempts, stagger=0.25, timeout=15):
+    """按顺序错开启动各个尝试，返回第一个成功的尝试，全部失败时返回None
+
+    前一个尝试失败时立即启动下一个，不必等待错开间隔。
+    胜出尝试的socket会被切换回阻塞模式，其他尝试全部关闭。
+    """
+    sel = DefaultSelector()
+    waiting = list(attempts)
+    active = []
+    deadline = time.time() + timeout
+    next_start = time.time()
+    winner = None
+
+    try:
+        while waiting or active:
+            now = time.time()
+            if now >= deadline:
+                logger.warning("竞速连接超时")
+                break
+
+            # 启动下一个尝试
+            if waiting and (now >= next_start or not active):
+                attempt = waiting.pop(0)
+                try:
+                    attempt.start(sel)
+                    active.append(attempt)
+                    logger.debug("发起连接尝试: %s", attempt)
+                except OSError as e:
+                    logger.info("连接尝试 %s 失败: %s", attempt, e)
+                    attempt.close()
+                next_start = now + stagger
+                continue
+
+            wait = deadline - now
+            if waiting:
+                wait = min(wait, max(0, next_start - now))
+
+            for key, mask in sel.select(timeout=wait):
+                attempt = key.data
+                try:
+                    done = attempt.on_event(sel, mask)
+                except (OSError, ConnectionError) as e:
+                    logger.info("连接尝试 %s 失败: %s", attempt, e)
+                    sel.unregister(attempt.sock)
+                    attempt.close()
+                    active.remove(attempt)
+                    next_start = time.time()
+                    continue
+                if done:
+                    winner = attempt
+                    break
+
+            if winner:
+                break
+    finally:
+        for attempt in active:
+            if attempt is not winner:
+                attempt.close()
+        if winner:
+            sel.unregister(winner.sock)
+            winner.sock.setblocking(True)
+        sel.close()
+
+    return winner
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP消息解析
+增量接收请求头/应答头，直到遇到空行为止；空行之后已经收到的数据
+(例如CONNECT之后紧跟的TLS ClientHello，或者消息体)保留在leftover中，不会丢失。
+消息体按Content-Length / chunked / 连接关闭三种方式划分边界，
+只负责计算边界，不涉及socket读写，线程模式和asyncio模式共用。
+"""
+
+import socket
+
+# 请求头的最大长度
+MAX_HEADER_SIZE = 16384
+
+CONNECT_OK = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+CONNECT_FAILED = b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+# 只在相邻两跳之间有效、转发时需要去掉的请求头
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "proxy-authorization",
+              "proxy-authenticate", "te", "trailer", "upgrade"}
+
+# chunked消息体中单行的最大长度
+MAX_CHUNK_LINE = 4096
+
+
+class MessageHead:
+    """请求头/应答头的公共部分"""
+
+    __slots__ = ("version", "headers", "raw")
+
+    def get_header(self, name, default=None):
+        """按名称(不区分大小写)获取请求头"""
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def connection_tokens(self):
+        """Connection(以及Proxy-Connection)头中的选项，小写"""
+        tokens = set()
+        for key, value in self.headers:
+            if key.lower() in ("connection", "proxy-connection"):
+                tokens.update(token.strip().lower() for token in value.split(","))
+        return tokens
+
+    def keep_alive(self):
+        """按HTTP版本和Connection头判断连接是否保持"""
+        tokens = self.connection_tokens()
+        if self.version == "HTTP/1.1":
+            return "close" not in tokens
+        return "keep-alive" in tokens
+
+
+class RequestHead(MessageHead):
+    """解析后的请求行和请求头"""
+
+    __slots__ = ("method", "target")
+
+    def __init__(self, method, target, version, headers, raw):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # [(名称, 值)]，保留原始顺序和大小写
+        self.raw = raw
+
+
+class ResponseHead(MessageHead):
+    """解析后的状态行和应答头"""
+
+    __slots__ = ("status", "reason")
+
+    def __init__(self, version, status, reason, headers, raw):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.raw = raw
+
+
+class HeaderParser:
+    """增量请求头/应答头解析器"""
+
+    def __init__(self, max_size=MAX_HEADER_SIZE, response=False):
+        self.max_size = max_size
+        self.response = response
+        self.buffer = bytearray()
+        self.leftover = b""
+
+    def feed(self, data):
+        """追加数据，头部完整时返回RequestHead/ResponseHead，否则返回None
+
+        头部过长或格式错误时抛出ValueError。
+        """
+        # 空行可能跨两次读取，只从上次末尾往前3个字节开始查找
+        start = max(len(self.buffer) - 3, 0)
+        self.buffer += data
+        end = self.buffer.find(b"\r\n\r\n", start)
+        if end < 0:
+            if len(self.buffer) > self.max_size:
+                raise ValueError("请求头过长")
+            return None
+
+        raw = bytes(self.buffer[:end + 4])
+        self.leftover = bytes(self.buffer[end + 4:])
+        self.buffer = bytearray()
+        if self.response:
+            return parse_response_head(raw)
+        return parse_request_head(raw)
+
+
+def _parse_headers(lines):
+    headers = []
+    for line in lines:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise ValueError(f"无效的请求头: {line[:100]}")
+        headers.append((name.strip(), value.strip()))
+    return headers
+
+
+def parse_request_head(raw):
+    """解析完整的请求头"""
+    lines = raw.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ")
+    if len(parts) != 3:
+        raise ValueError(f"无效的请求行: {lines[0][:100]}")
+    method, target, version = parts
+    return RequestHead(method, target, version, _parse_headers(lines[1:]), raw)
+
+
+def parse_response_head(raw):
+    """解析完整的应答头"""
+    lines = raw.decode("latin-1").split("\r\n")
+    parts = lines[0].split(" ", 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise ValueError(f"无效的状态行: {lines[0][:100]}")
+    reason = parts[2] if len(parts) > 2 else ""
+    return ResponseHead(parts[0], int(parts[1]), reason, _parse_headers(lines[1:]), raw)
+
+
+def parse_target(target, default_port=443):
+    """解析 host:port，支持 [IPv6]:port，返回(host, port)"""
+    if target.startswith("["):
+        host, _, rest = target[1:].partition("]")
+        port = rest[1:] if rest.startswith(":") else ""
+    else:
+        host, _, port = target.rpartition(":")
+        if not host:
+            host, port = target, ""
+    if not host:
+        raise ValueError(f"无效的目标地址: {target}")
+    return host, int(port) if port else default_port
+
+
+def build_connect_request(host, port):
+    """构造发往上游HTTP代理的CONNECT请求"""
+    target = f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+    return f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode()
+
+
+def connect_reply_length(reply):
+    """检查上游代理对CONNECT的应答
+
+    返回None表示应答头还不完整，False表示上游拒绝，
+    否则返回应答头的长度，之后的数据已经属于隧道。
+    """
+    end = reply.find(b"\r\n\r\n")
+    if end < 0:
+        if len(reply) > MAX_HEADER_SIZE:
+            return False
+        return None
+    status = reply.split(b"\r\n", 1)[0].split(b" ")
+    if len(status) < 2 or status[1] != b"200":
+        return False
+    return end + 4
+
+
+def recv_connect_reply(sock):
+    """从阻塞socket读取CONNECT应答头，返回是否成功
+
+    先用MSG_PEEK查看数据，只取走应答头本身，目标服务器随后发来的数据
+    (例如SSH/SMTP的欢迎信息或对早期数据的回复)留在socket中交给转发。
+    """
+    reply = b""
+    while True:
+        data = sock.recv(4096, socket.MSG_PEEK)
+        if not data:
+            return False
+        length = connect_reply_length(reply + data)
+        if length is None:
+            # 应答头还不完整，已查看的数据都属于应答头
+            reply += sock.recv(len(data))
+            continue
+        if not length:
+            return False
+        sock.recv(length - len(reply))
+        return True
+
+
+def is_forward_request(data):
+    """数据是否以绝对URI形式的HTTP代理请求开头，例如 GET http://host/path HTTP/1.1"""
+    line = data.split(b"\r\n", 1)[0]
+    parts = line.split(b" ")
+    return len(parts) == 3 and parts[0].isalpha() and parts[1][:7].lower() == b"http://"
+
+
+def split_absolute_uri(target):
+    """把 http://host[:port]/path 拆分为(host, port, path)"""
+    if target[:7].lower() != "http://":
+        raise ValueError(f"不支持的请求地址: {target[:100]}")
+    authority, slash, path = target[7:].partition("/")
+    authority = authority.rpartition("@")[2]  # 去掉用户信息
+    host, port = parse_target(authority, default_port=80)
+    return host, port, slash + path if slash else "/"
+
+
+def rewrite_request(request, path, host, port):
+    """把代理请求改写为发给目标服务器的请求
+
+    请求行改为 origin-form，去掉逐跳请求头，补充Host头，
+    Connection设为keep-alive以便复用到目标的隧道；升级请求(例如WebSocket)保留Upgrade。
+    """
+    upgrade = request.get_header("upgrade")
+    drop = HOP_BY_HOP | request.connection_tokens()
+    lines = [f"{request.method} {path} {request.version}"]
+    has_host = False
+    for name, value in request.headers:
+        lower = name.lower()
+        if lower in drop:
+            continue
+        if lower == "host":
+            has_host = True
+        lines.append(f"{name}: {value}")
+    if not has_host:
+        lines.append(f"Host: {host}" if port == 80 else f"Host: {host}:{port}")
+    if upgrade:
+        lines.append(f"Upgrade: {upgrade}")
+        lines.append("Connection: Upgrade")
+    else:
+        lines.append("Connection: keep-alive")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+class BodyFramer:
+    """计算消息体的边界
+
+    mode: length(按Content-Length) / chunked / close(读到连接关闭为止) / none(没有消息体)
+    """
+
+    SIZE, DATA, DATA_END, TRAILER = range(4)
+
+    def __init__(self, mode, length=0):
+        self.mode = mode
+        self.remaining = length
+        self.state = self.SIZE
+        self.line = b""
+        self.done = mode == "none" or (mode == "length" and length == 0)
+
+    @classmethod
+    def for_request(cls, request):
+        return cls._from_headers(request, default="none")
+
+    @classmethod
+    def for_response(cls, response, method):
+        """HEAD请求和1xx/204/304应答没有消息体"""
+        if method == "HEAD" or response.status < 200 or response.status in (204, 304):
+            return cls("none")
+        return cls._from_headers(response, default="close")
+
+    @classmethod
+    def _from_headers(cls, head, default):
+        encoding = head.get_header("transfer-encoding")
+        if encoding and encoding.lower().rsplit(",", 1)[-1].strip() == "chunked":
+            return cls("chunked")
+        length = head.get_header("content-length")
+        if length is not None:
+            if not length.strip().isdigit():
+                raise ValueError(f"无效的Content-Length: {length[:50]}")
+            return cls("length", int(length))
+        return cls(default)
+
+    def feed(self, data):
+        """返回data中属于消息体的字节数，消息体结束后done为True"""
+        if self.done:
+            return 0
+        if self.mode == "close":
+            return len(data)
+        if self.mode == "length":
+            n = min(len(data), self.remaining)
+            self.remaining -= n
+            self.done = self.remaining == 0
+            return n
+        return self._feed_chunked(data)
+
+    def _feed_chunked(self, data):
+        pos = 0
+        size = len(data)
+        while pos < size and not self.done:
+            if self.state == self.DATA:
+                n = min(size - pos, self.remaining)
+                pos += n
+                self.remaining -= n
+                if not self.remaining:
+                    self.state = self.DATA_END
+                continue
+
+            # 其余状态按行处理，行可能跨两次读取
+            end = data.find(b"\n", pos)
+            if end < 0:
+                self.line += data[pos:]
+                if len(self.line) > MAX_CHUNK_LINE:
+                    raise ValueError("chunked行过长")
+                return size
+            line = (self.line + data[pos:end]).rstrip(b"\r")
+            self.line = b""
+            pos = end + 1
+
+            if self.state == self.SIZE:
+                try:
+                    self.remaining = int(line.split(b";", 1)[0].strip(), 16)
+                except ValueError:
+                    raise ValueError(f"无效的chunk长度: {line[:50]!r}")
+                self.state = self.DATA if self.remaining else self.TRAILER
+            elif self.state == self.DATA_END:
+                self.state = self.SIZE
+            elif not line:
+                # 空行结束trailer
+                self.done = True
+        return pos
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP正向代理
+处理 GET http://host/path 形式的普通HTTP代理请求：逐个解析请求，
+改写为发给目标服务器的请求后通过节点隧道转发，并保持客户端连接。
+到同一目标(host, port)的隧道在请求结束后放回空闲池，下一个请求直接复用，
+不必每次重新建立到节点的连接和SSR握手。
+"""
+
+import time
+import select
+import socket
+import threading
+
+from http_parser import (HeaderParser, BodyFramer, split_absolute_uri, rewrite_request,
+                         CONNECT_FAILED)
+from logging_setup import connection_logger as conn_logger
+
+# 单次读取的最大字节数
+RECV_SIZE = 65536
+# 等待目标服务器应答的超时(秒)
+RESPONSE_TIMEOUT = 60
+
+
+class TunnelPool:
+    """按(host, port)保存空闲的上游隧道"""
+
+    def __init__(self, size=4, idle_timeout=30, is_alive=None, close=None):
+        """
+        参数:
+            size: 每个目标最多保存的空闲隧道数，0表示不复用
+            idle_timeout: 空闲隧道的最长保存时间(秒)
+            is_alive: 检查空闲隧道是否仍可用的函数
+            close: 关闭隧道的函数
+        """
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.is_alive = is_alive or _socket_alive
+        self.close = close or (lambda tunnel: tunnel.close())
+        self._idle = {}  # (host, port) -> [(隧道, 放入时间)]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, key):
+        """取出一个空闲隧道，没有时返回None"""
+        now = time.time()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                entry = idle.pop() if idle else None
+            if entry is None:
+                self.misses += 1
+                return None
+            tunnel, released = entry
+            if now - released <= self.idle_timeout and self.is_alive(tunnel):
+                self.hits += 1
+                return tunnel
+            self.close(tunnel)
+
+    def release(self, key, tunnel):
+        """请求完成后放回隧道"""
+        expired = []
+        now = time.time()
+        with self._lock:
+            # 顺便清理所有目标中过期的隧道
+            for idle_key in list(self._idle):
+                idle = self._idle[idle_key]
+                while idle and now - idle[0][1] > self.idle_timeout:
+                    expired.append(idle.pop(0)[0])
+                if not idle:
+                    del self._idle[idle_key]
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append((tunnel, now))
+                tunnel = None
+        for old in expired:
+            self.close(old)
+        if tunnel is not None:
+            self.close(tunnel)
+
+    def get_stats(self):
+        """获取隧道复用统计信息"""
+        with self._lock:
+            idle = sum(len(entries) for entries in self._idle.values())
+        return {"idle": idle, "hits": self.hits, "misses": self.misses}
+
+
+def _socket_alive(tunnel):
+    """空闲隧道应当没有任何可读数据：可读意味着对端已关闭或发来了多余的数据"""
+    try:
+        readable, _, _ = select.select([tunnel], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+class UpstreamClosed(Exception):
+    """目标服务器在应答之前关闭了连接"""
+
+
+class HttpForwarder:
+    """线程模式下的HTTP正向代理"""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.keepalive_timeout = manager.options.get("http_keepalive_timeout", 60)
+        self.pool = TunnelPool(
+            size=manager.options.get("http_pool_size", 4),
+            idle_timeout=manager.options.get("http_pool_idle_timeout", 30)
+        )
+
+    def serve(self, client, node, initial):
+        """处理客户端连接上的所有请求
+
+        initial为已经从客户端读取的数据。
+        请求升级协议(101)时返回(到目标的隧道, 已从客户端读取、尚未转发的数据)，由调用方继续双向转发；
+        否则返回None。
+        """
+        buffered = initial
+        client.settimeout(self.keepalive_timeout)
+        while True:
+            # 读取请求头
+            parser = HeaderParser()
+            request = parser.feed(buffered) if buffered else None
+            while request is None:
+                try:
+                    data = client.recv(RECV_SIZE)
+                except socket.timeout:
+                    return None
+                if not data:
+                    return None
+                request = parser.feed(data)
+            buffered = parser.leftover
+
+            host, port, path = split_absolute_uri(request.target)
+            conn_logger.info("HTTP代理请求: %s %s:%d%s", request.method, host, port, path)
+            head = rewrite_request(request, path, host, port)
+            body = BodyFramer.for_request(request)
+            key = (host, port)
+
+            # 复用的隧道可能已被目标服务器关闭，没有请求体的请求可以换新隧道重试一次
+            tunnel = self.pool.acquire(key)
+            reused = tunnel is not None
+            while True:
+                if tunnel is None:
+                    tunnel = self._open(node, host, port)
+                    if tunnel is None:
+                        client.sendall(CONNECT_FAILED)
+                        return None
+                try:
+                    buffered = self._send_request(client, tunnel, head, body, buffered)
+                    response, reusable, keep_client = self._forward_response(client, tunnel, request)
+                    break
+                except (UpstreamClosed, ConnectionError):
+                    self.pool.close(tunnel)
+                    if not reused or body.mode != "none":
+                        raise
+                    tunnel = None
+                    reused = False
+                except Exception:
+                    self.pool.close(tunnel)
+                    raise
+
+            if response.status == 101:
+                conn_logger.info("HTTP连接已升级: %s:%d", host, port)
+                tunnel.settimeout(None)
+                return tunnel, buffered
+
+            if reusable:
+                self.pool.release(key, tunnel)
+            else:
+                self.pool.close(tunnel)
+
+            if not keep_client or not request.keep_alive():
+                return None
+
+    def _open(self, node, host, port):
+        """建立到目标的新隧道"""
+        with self.manager.admission.handshake():
+            node, tunnel = self.manager.open_tunnel(node, host, port)
+        if tunnel is not None:
+            tunnel.settimeout(RESPONSE_TIMEOUT)
+        return tunnel
+
+    def _send_request(self, client, tunnel, head, body, buffered):
+        """发送请求头和请求体，返回之后多读到的数据(下一个请求)"""
+        n = body.feed(buffered)
+        tunnel.sendall(head + buffered[:n])
+        buffered = buffered[n:]
+        while not body.done:
+            data = client.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionError("客户端在请求体结束前关闭了连接")
+            n = body.feed(data)
+            tunnel.sendall(data[:n])
+            self.manager.update_stats(traffic=n)
+            buffered = data[n:]
+        return buffered
+
+    def _forward_response(self, client, tunnel, request):
+        """把目标服务器的应答转发给客户端
+
+        返回(应答头, 隧道是否可以复用, 客户端连接是否可以保持)
+        """
+        received = False
+        leftover = b""
+        while True:
+            parser = HeaderParser(response=True)
+            response = parser.feed(leftover) if leftover else None
+            while response is None:
+                data = tunnel.recv(RECV_SIZE)
+                if not data:
+                    if received:
+                        raise ConnectionError("目标服务器在应答头结束前关闭了连接")
+                    raise UpstreamClosed()
+                received = True
+                response = parser.feed(data)
+            leftover = parser.leftover
+
+            # 1xx中间应答(101除外)之后还有最终应答
+            if 100 <= response.status < 200 and response.status != 101:
+                client.sendall(response.raw)
+                continue
+            break
+
+        body = BodyFramer.for_response(response, request.method)
+        n = body.feed(leftover)
+        client.sendall(response.raw + leftover[:n])
+        extra = len(leftover) - n
+        traffic = len(response.raw) + n
+        if response.status == 101:
+            if extra:
+                client.sendall(leftover[n:])
+            self.manager.update_stats(traffic=traffic + extra)
+            return response, False, False
+
+        while not body.done:
+            data = tunnel.recv(RECV_SIZE)
+            if not data:
+                if body.mode == "close":
+                    break
+                raise ConnectionError("目标服务器在应答体结束前关闭了连接")
+            n = body.feed(data)
+            client.sendall(data[:n])
+            traffic += n
+            extra += len(data) - n
+        self.manager.update_stats(traffic=traffic)
+
+        # 应答体以连接关闭为结束或目标要求关闭时，客户端连接也要关闭；
+        # 应答之后还有多余数据时隧道不能复用
+        keep_client = body.mode != "close" and response.keep_alive()
+        reusable = keep_client and body.done and not extra
+        return response, reusable, keep_client
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+旧式加密方式: rc4-md5 和 table
+rc4-md5以MD5(密钥 + IV)为RC4密钥；table没有IV，按密码生成的置换表逐字节替换。
+
+RC4按速度依次尝试cryptography(OpenSSL)、pycryptodome和纯Python实现，
+第一个能创建加密器的作为当前实现，避免OpenSSL 3未加载legacy provider等情况下使用不可用的实现。
+各实现的RFC 6229已知答案检查在tests/test_legacy_ciphers.py中。
+"""
+
+import struct
+import hashlib
+import logging
+import functools
+
+logger = logging.getLogger("legacy_ciphers")
+
+
+class _PythonRc4:
+    """纯Python实现：逐字节生成密钥流，按大整数一次完成异或"""
+
+    def __init__(self, key):
+        state = list(range(256))
+        j = 0
+        key_len = len(key)
+        for i in range(256):
+            j = (j + state[i] + key[i % key_len]) & 0xFF
+            state[i], state[j] = state[j], state[i]
+        self.state = state
+        self.i = 0
+        self.j = 0
+
+    def _keystream(self, n):
+        state = self.state
+        i, j = self.i, self.j
+        out = bytearray(n)
+        for k in range(n):
+            i = (i + 1) & 0xFF
+            si = state[i]
+            j = (j + si) & 0xFF
+            sj = state[j]
+            state[i] = sj
+            state[j] = si
+            out[k] = state[(si + sj) & 0xFF]
+        self.i, self.j = i, j
+        return out
+
+    def update(self, data):
+        n = len(data)
+        stream = int.from_bytes(self._keystream(n), "little")
+        return (int.from_bytes(data, "little") ^ stream).to_bytes(n, "little")
+
+
+def _new_pycryptodome(key):
+    from Crypto.Cipher import ARC4
+    cipher = ARC4.new(key)
+    return cipher.encrypt
+
+
+def _new_cryptography(key):
+    from cryptography.hazmat.primitives.ciphers import Cipher
+    try:
+        from cryptography.hazmat.decrepit.ciphers.algorithms import ARC4
+    except ImportError:
+        from cryptography.hazmat.primitives.ciphers.algorithms import ARC4
+    return Cipher(ARC4(key), mode=None).encryptor().update
+
+
+def _new_python(key):
+    return _PythonRc4(key).update
+
+
+# 按速度排列的RC4实现(benchmark.py ciphers)：OpenSSL的RC4比pycryptodome快
+RC4_BACKENDS = (
+    ("cryptography", _new_cryptography),
+    ("pycryptodome", _new_pycryptodome),
+    ("python", _new_python),
+)
+
+
+class StreamCipher:
+    """把 update(data) 形式的实现包装为与pycryptodome流加密器相同的接口"""
+
+    def __init__(self, update):
+        self.update = update
+
+    def encrypt(self, data, output=None):
+        result = self.update(data)
+        if output is None:
+            return result
+        output[:len(result)] = result
+        return None
+
+    decrypt = encrypt
+
+
+def rc4_usable(new):
+    """RC4实现能创建加密器并加密时返回True(库未安装、OpenSSL未加载legacy provider时不可用)"""
+    try:
+        return len(new(bytes(16))(bytes(16))) == 16
+    except Exception:
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def rc4_backend():
+    """返回(名称, 构造函数)：可用的最快RC4实现"""
+    for name, new in RC4_BACKENDS:
+        if rc4_usable(new):
+            if name == "python":
+                logger.warning("RC4使用纯Python实现，rc4-md5节点的吞吐量很低，建议安装cryptography或pycryptodome")
+            else:
+                logger.info(f"RC4使用 {name} 实现")
+            return name, new
+        logger.debug("RC4实现 %s 不可用", name)
+    raise RuntimeError("没有可用的RC4实现")
+
+
+def new_rc4(key, backend=None):
+    """创建RC4加密器，backend为None时使用可用的最快实现"""
+    new = dict(RC4_BACKENDS)[backend] if backend else rc4_backend()[1]
+    return StreamCipher(new(key))
+
+
+def new_rc4_md5(key, iv, backend=None):
+    """rc4-md5: RC4密钥为MD5(密钥 + IV)"""
+    return new_rc4(hashlib.md5(key + iv).digest(), backend)
+
+
+@functools.lru_cache(maxsize=32)
+def _tables(password):
+    """生成table加密的置换表(加密表, 解密表)，计算较慢，按密码缓存"""
+    a = struct.unpack("<Q", hashlib.md5(password).digest()[:8])[0]
+    table = list(range(256))
+    for i in range(1, 1024):
+        table.sort(key=lambda x: a % (x + i))
+    encrypt_table = bytes(table)
+    decrypt_table = bytes.maketrans(encrypt_table, bytes(range(256)))
+    return encrypt_table, decrypt_table
+
+
+class TableCipher:
+    """table加密：按置换表逐字节替换，没有IV和状态"""
+
+    def __init__(self, password):
+        self.encrypt_table, self.decrypt_table = _tables(password)
+
+    @staticmethod
+    def _translate(data, table, output):
+        result = bytes(data).translate(table)
+        if output is None:
+            return result
+        output[:len(result)] = result
+        return None
+
+    def encrypt(self, data, output=None):
+        return self._translate(data, self.encrypt_table, output)
+
+    def decrypt(self, data, output=None):
+        return self._translate(data, self.decrypt_table, output)
+
+
+def self_test():
+    """检查各RC4实现是否可用和table加密，返回 {名称: 是否通过}"""
+    results = {name: rc4_usable(new) for name, new in RC4_BACKENDS}
+    encrypt_table, decrypt_table = _tables(b"self-test")
+    data = bytes(range(256))
+    results["table"] = (sorted(encrypt_table) == list(range(256))
+                        and data.translate(encrypt_table).translate(decrypt_table) == data)
+    return results
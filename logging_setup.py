@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日志配置
+所有日志先放入内存队列，由单独的输出线程格式化并写入stderr，
+转发线程不再同步格式化和写日志。
+
+每个连接的事件(新连接、使用节点、连接建立/关闭、流量统计)记录到独立的
+"connection"日志器，可以单独设置级别，并按连接采样：
+连接开始时决定一次是否记录，未被采样的连接的所有事件都不记录。
+"""
+
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import queue
+import random
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+
+# 连接事件日志器
+connection_logger = logging.getLogger("connection")
+
+# 当前连接是否被采样；线程和asyncio任务各自持有独立的值
+_sampled = contextvars.ContextVar("connection_log_sampled", default=True)
+_sample_rate = 1.0
+_listener = None
+
+
+class _SampleFilter(logging.Filter):
+    """丢弃未被采样的连接的事件"""
+
+    def filter(self, record):
+        return _sampled.get()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """入队时不格式化消息，格式化全部在输出线程中完成
+
+    日志参数在输出之前不能再被修改，热路径上只传入数字和字符串。
+    """
+
+    def prepare(self, record):
+        return record
+
+
+connection_logger.addFilter(_SampleFilter())
+
+
+def setup_logging(level=logging.INFO):
+    """把根日志器的输出切换为队列 + 后台输出线程，重复调用无效"""
+    global _listener
+    if _listener:
+        return
+
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener.start()
+    # 退出时写出队列中剩余的日志
+    atexit.register(_listener.stop)
+
+
+def configure_logging(options):
+    """按配置设置日志级别和连接日志采样率"""
+    global _sample_rate
+    logging.getLogger().setLevel(LEVELS.get(options.get("log_level", "info"), logging.INFO))
+    connection_logger.setLevel(LEVELS.get(options.get("connection_log_level", "info"), logging.INFO))
+    _sample_rate = min(max(float(options.get("connection_log_sample_rate", 1.0)), 0.0), 1.0)
+
+
+def begin_connection():
+    """新连接开始处理时调用，决定该连接的事件是否记录"""
+    _sampled.set(_sample_rate >= 1.0 or random.random() < _sample_rate)
@@ -5,14 +5,14 @@ import json
 import logging
 import threading
 import socket
+import time
 from proxy_manager import ProxyManager
 from web_interface import start_web_server
+from workers import WorkerSupervisor, REUSE_PORT_AVAILABLE
+from logging_setup import setup_logging, configure_logging
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# 配置日志：通过队列由后台线程输出
+setup_logging()
 logger = logging.getLogger("main")
 
 def load_options():
@@ -62,7 +62,17 @@ def start_proxy_server(manager):
             print("警告: 没有可用节点，代理服务器未启动。请检查网络连接或配置文件中的节点信息。")
             print("您仍然可以通过Web界面(端口: " + str(manager.options.get("web_port", 8123)) + ")管理节点。")
             return
-        manager.start_proxy_server()
+
+        workers = manager.options.get("workers", 1)
+        if workers > 1 and not REUSE_PORT_AVAILABLE:
+            logger.warning("当前系统不支持SO_REUSEPORT，使用单进程模式")
+            manager.options["workers"] = workers = 1
+
+        if workers > 1:
+            # 多进程模式：工作进程共享监听端口，主进程只负责节点管理和Web界面
+            WorkerSupervisor(manager, workers).start()
+        else:
+            manager.start_proxy_server()
     except Exception as e:
         logger.error(f"启动代理服务器失败: {str(e)}")
 
@@ -73,6 +83,7 @@ def main():
 
         # 加载配置
         options = load_options()
+        configure_logging(options)
 
         # 创建代理管理器
         manager = ProxyManager(options)
@@ -86,13 +97,16 @@ def main():
         # 启动代理服务器
         start_proxy_server(manager)
 
+        # 服务都运行在后台线程中，保持主线程运行
+        while True:
+            time.sleep(60)
+
     except KeyboardInterrupt:
         logger.info("收到中断信号，正在关闭...")
     except Exception as e:
         logger.error(f"程序运行出错: {str(e)}")
         logger.error("程序将保持运行状态，避免重启循环")
         # 保持程序运行，避免重启循环
-        import time
         while True:
             time.sleep(60)
 
@@ -0,0 +1,767 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSR连接多路复用
+多个客户端连接作为流(stream)共用到节点的少数几个长连接，新连接不再需要TCP握手和SSR首包往返。
+长连接的目标地址为 sp.mux.sing-box.arpa:444，之后是sing-mux会话请求(版本0，yamux协议)，
+服务端需要支持sing-mux(例如开启multiplex的sing-box)，本地测试可以使用mux_server.py。
+
+流的分帧和流量控制使用yamux：每个流有独立的窗口(256KB)，本地连接写不下时不再给服务器增加窗口，
+一个大流量下载最多占用一个窗口的在途数据，不会阻塞同一连接上其他流的数据；
+连接本身始终在读取，某个流的本地端阻塞时数据缓存在该流的窗口内。
+发往服务器时控制帧优先，各流每轮最多一个数据帧，按轮转顺序发出，已编码未写出的数据有上限。
+
+打开流时等待服务端确认目标已连接(一个往返)，目标连接失败时调用方可以如实应答客户端。
+流在本地以socketpair的一端交给调用方，调用方像普通上游socket一样转发；
+所有长连接和流由一个线程用同一个selector驱动(MuxLoop)。
+"""
+
+import time
+import socket
+import struct
+import logging
+import threading
+import contextvars
+from collections import deque
+from selectors import EVENT_READ, EVENT_WRITE
+
+import sockopts
+from relay import SelectorThread
+from socks5 import encode_address
+
+logger = logging.getLogger("mux")
+
+# 多路复用长连接的约定目标地址
+MUX_HOST = "sp.mux.sing-box.arpa"
+MUX_PORT = 444
+# sing-mux会话请求：版本0(无填充) + 协议(0=h2mux, 1=smux, 2=yamux)
+PROTOCOL_YAMUX = 2
+SESSION_REQUEST = bytes([0, PROTOCOL_YAMUX])
+
+# yamux帧头：版本、类型、标志、流ID、长度(数据帧为数据长度，窗口更新为增量，ping为标识)
+HEADER = struct.Struct(">BBHII")
+YAMUX_VERSION = 0
+TYPE_DATA = 0
+TYPE_WINDOW_UPDATE = 1
+TYPE_PING = 2
+TYPE_GO_AWAY = 3
+FLAG_SYN = 1
+FLAG_ACK = 2
+FLAG_FIN = 4
+FLAG_RST = 8
+
+# 每个流的初始窗口(yamux默认值)，窗口消耗过半时通知对端
+INITIAL_WINDOW = 256 * 1024
+# 每个流一次读取的最大数据量，即轮转发送的单位
+MAX_FRAME = 16384
+# 已编码未写出的数据超过此值时不再从各流取数据帧
+OUT_LIMIT = 65536
+# 接收缓冲区大小，必须大于一个AEAD数据块
+RECV_BUFFER = 65536
+# 流与本地连接之间socketpair的缓冲区大小
+LOCAL_BUFFER = 65536
+
+# 服务端对流请求的应答
+STATUS_SUCCESS = 0
+STATUS_ERROR = 1
+# 失败应答中错误信息的最大长度
+MAX_STATUS = 1024
+
+# 本地关闭后等待对端关闭流的最长时间(秒)，超时后中止流
+STREAM_CLOSE_TIMEOUT = 30
+# 等待其他线程建立多路复用连接的最长时间(秒)
+CONNECT_WAIT = 15
+# 等待服务端对流请求应答(目标是否连接成功)的最长时间(秒)
+OPEN_TIMEOUT = 15
+
+
+def stream_request(host, port):
+    """流开头的请求：标志(2字节，0为TCP) + 目标地址"""
+    return b"\x00\x00" + encode_address(host, port)
+
+
+def encode_status(message=None):
+    """流请求的应答：成功为一个字节，失败时附带错误信息(uvarint长度 + 文本)"""
+    if message is None:
+        return bytes([STATUS_SUCCESS])
+    text = message.encode()[:MAX_STATUS]
+    length = bytearray()
+    n = len(text)
+    while n >= 0x80:
+        length.append(n & 0x7F | 0x80)
+        n >>= 7
+    length.append(n)
+    return bytes([STATUS_ERROR]) + bytes(length) + text
+
+
+def _decode_status(data):
+    """解析流开头的应答，返回(错误信息, 应答长度)，成功时错误信息为None，数据不完整时返回None"""
+    if data[0] == STATUS_SUCCESS:
+        return None, 1
+    if data[0] != STATUS_ERROR:
+        raise ValueError(f"多路复用流的应答错误: {data[0]}")
+    length = 0
+    shift = 0
+    pos = 1
+    while True:
+        if pos >= len(data):
+            return None
+        byte = data[pos]
+        pos += 1
+        length |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    if length > MAX_STATUS:
+        raise ValueError("多路复用流的错误信息过长")
+    if len(data) < pos + length:
+        return None
+    return bytes(data[pos:pos + length]).decode("utf-8", "replace"), pos + length
+
+
+class _OpenWaiter:
+    """打开流的线程等待服务端应答，应答在事件循环线程中设置"""
+
+    __slots__ = ("done", "error", "stream")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None  # 失败原因，成功时为None
+        self.stream = None
+
+    def set(self, error=None):
+        self.error = error
+        self.done.set()
+
+
+class MuxStream:
+    """多路复用连接上的一个流"""
+
+    __slots__ = ("id", "sock", "context", "send_window", "recv_window", "consumed", "inbox",
+                 "frame", "local_eof", "remote_eof", "fin_at", "shut", "closed", "status", "request", "interest",
+                 "waiter")
+
+    def __init__(self, stream_id, sock, context=None):
+        self.id = stream_id
+        self.sock = sock  # 本地一端，服务端在连接目标之前为None
+        self.context = context  # 日志在打开流的连接的上下文中记录
+        self.send_window = INITIAL_WINDOW  # 对端还允许发送的字节数
+        self.recv_window = INITIAL_WINDOW  # 还允许对端发送的字节数
+        self.consumed = 0  # 已写给本地但还没有通知对端的字节数
+        self.inbox = deque()  # 收到的、还没有写给本地的数据
+        self.frame = None  # 已读取、等待发出的数据帧
+        self.local_eof = False  # 本地已关闭，FIN已放入frame
+        self.remote_eof = False  # 收到了对端的FIN
+        self.fin_at = 0  # 本地关闭的时间
+        self.shut = False  # 已关闭本地socket的写方向
+        self.closed = False
+        self.status = None  # 客户端：还没有收完的服务端应答
+        self.request = None  # 服务端：还没有收完的流请求
+        self.interest = 0
+        self.waiter = None  # 客户端：等待服务端应答的_OpenWaiter
+
+    def log(self, level, message):
+        if self.context is not None:
+            self.context.run(logger.log, level, message)
+        else:
+            logger.log(level, message)
+
+
+class MuxSession:
+    """一条多路复用连接：yamux分帧、各流的流量控制和发送调度
+
+    除构造外所有方法只在MuxLoop的线程中调用。codec负责连接上数据的编码/解码，
+    客户端为SSRSession，接口为encode_segments、recv_size、decode_into和drain_sendback。
+    """
+
+    def __init__(self, sock, codec, client=True, on_close=None, on_stream_closed=None, initial=b""):
+        """
+        参数:
+            client: 客户端流ID为奇数，服务端为偶数
+            on_close(session): 连接关闭时调用
+            on_stream_closed(session): 每个流结束时调用
+            initial: 已经解码、还没有解析的数据(服务端在会话请求之后收到的帧)
+        """
+        sock.setblocking(False)
+        self.sock = sock
+        self.codec = codec
+        self.client = client
+        self.on_close = on_close
+        self.on_stream_closed = on_stream_closed
+        self.next_id = 1 if client else 2
+        self.streams = {}  # 流ID -> MuxStream
+        self.ready = deque()  # 有数据帧等待发出的流，按轮转顺序
+        self.control = []  # 等待发出的控制帧(窗口更新、ping应答、RST)，优先于数据帧
+        self.out = deque()  # 已编码、还没有写出的数据
+        self.queued = 0
+        self.buffer = bytearray(RECV_BUFFER)
+        self.view = memoryview(self.buffer)
+        self._inbound = bytearray(initial)  # 解码后还不是完整帧的数据
+        self._dirty = set()  # 状态变化、需要更新关注事件的流
+        self.loop = None
+        self.interest = 0
+        self.closed = False
+        self.going_away = False  # 收到GoAway后不再打开新流
+        self.idle_since = time.monotonic()  # 没有流时开始计时
+        self.assigned = 0  # MuxPool分配到这条连接上的流数(含还没有打开的)
+        self.owner = None  # MuxPool中连接所属的SSRClient
+
+    def attach(self, loop):
+        """登记到事件循环"""
+        self.loop = loop
+        loop.sessions.add(self)
+        if self._inbound:
+            self._parse()
+        self._update()
+
+    def open_stream(self, sock, payload, context=None, waiter=None):
+        """客户端：打开一个新流，payload为流请求和早期数据，收到服务端应答后设置waiter"""
+        if self.closed or self.going_away:
+            sock.close()
+            if waiter:
+                waiter.set("多路复用连接已关闭")
+            if self.on_stream_closed:
+                self.on_stream_closed(self)
+            return
+        stream = MuxStream(self.next_id, sock, context)
+        self.next_id += 2
+        stream.status = bytearray()
+        stream.waiter = waiter
+        if waiter:
+            waiter.stream = stream
+        # 打开流的SYN和请求在同一个数据帧中发出，不需要等待服务端确认
+        stream.send_window -= len(payload)
+        stream.frame = HEADER.pack(YAMUX_VERSION, TYPE_DATA, FLAG_SYN, stream.id, len(payload)) + payload
+        self.streams[stream.id] = stream
+        self.ready.append(stream)
+        self._dirty.add(stream)
+        self._update()
+
+    def handle(self, stream, mask):
+        """处理连接(stream为None)或流的本地socket的事件"""
+        try:
+            if stream is None:
+                if mask & EVENT_WRITE:
+                    self._flush()
+                if mask & EVENT_READ:
+                    self._receive()
+            elif not stream.closed:
+                if mask & EVENT_WRITE:
+                    self._write_local(stream)
+                if mask & EVENT_READ and not stream.closed:
+                    self._read_local(stream)
+        except Exception as e:
+            self.close(e)
+            return
+        self._update()
+
+    def cancel_open(self, waiter):
+        """打开流的线程等待应答超时，中止流"""
+        stream = waiter.stream
+        if stream is not None and not stream.closed:
+            self._reset(stream)
+            self._update()
+
+    def tick(self, now):
+        """中止本地已关闭、对端超时仍未关闭的流"""
+        expired = [stream for stream in self.streams.values()
+                   if stream.local_eof and not stream.remote_eof and now - stream.fin_at >= STREAM_CLOSE_TIMEOUT]
+        for stream in expired:
+            self._reset(stream)
+        if expired:
+            self._update()
+
+    def _update(self):
+        """发出可以发送的帧并更新关注事件"""
+        if self.closed:
+            return
+        try:
+            self._pump()
+            self._sync()
+        except Exception as e:
+            self.close(e)
+
+    def _receive(self):
+        codec = self.codec
+        try:
+            n = self.sock.recv_into(self.view, codec.recv_size(len(self.view)))
+        except BlockingIOError:
+            return
+        if n == 0:
+            raise ConnectionError("对端关闭了多路复用连接")
+        n = codec.decode_into(self.view, n)
+        sendback = codec.drain_sendback()
+        if sendback:
+            self._queue([sendback])
+        if n:
+            self._inbound += self.view[:n]
+            self._parse()
+
+    def _parse(self):
+        """处理缓冲区中所有完整的帧"""
+        buffer = self._inbound
+        view = memoryview(buffer)
+        pos = 0
+        try:
+            while len(buffer) - pos >= HEADER.size:
+                version, frame_type, flags, stream_id, length = HEADER.unpack_from(buffer, pos)
+                if version != YAMUX_VERSION:
+                    raise ValueError(f"多路复用帧版本错误: {version}")
+                end = pos + HEADER.size
+                if frame_type == TYPE_DATA:
+                    # 对端不能发送超过窗口的数据，过长的帧不再缓存
+                    if length > INITIAL_WINDOW:
+                        raise ValueError(f"多路复用数据帧过长: {length}")
+                    end += length
+                    if len(buffer) < end:
+                        break
+                self._on_frame(frame_type, flags, stream_id, length, view[pos + HEADER.size:end])
+                pos = end
+        finally:
+            view.release()
+            del buffer[:pos]
+
+    def _on_frame(self, frame_type, flags, stream_id, length, payload):
+        if frame_type == TYPE_PING:
+            if flags & FLAG_SYN:
+                self.control.append(HEADER.pack(YAMUX_VERSION, TYPE_PING, FLAG_ACK, 0, length))
+            return
+        if frame_type == TYPE_GO_AWAY:
+            self.going_away = True
+            return
+        if frame_type not in (TYPE_DATA, TYPE_WINDOW_UPDATE):
+            raise ValueError(f"多路复用帧类型错误: {frame_type}")
+
+        if flags & FLAG_SYN:
+            self._accept(stream_id)
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            # 已经关闭的流，丢弃
+            return
+        if flags & FLAG_RST:
+            self._close_stream(stream)
+            return
+        if frame_type == TYPE_WINDOW_UPDATE:
+            stream.send_window += length
+        elif payload:
+            if len(payload) > stream.recv_window:
+                stream.log(logging.WARNING, f"多路复用流 {stream.id} 收到的数据超过窗口")
+                self._reset(stream)
+                return
+            stream.recv_window -= len(payload)
+            self._deliver(stream, payload)
+            if stream.closed:
+                return
+        if flags & FLAG_FIN:
+            stream.remote_eof = True
+        self._dirty.add(stream)
+
+    def _accept(self, stream_id):
+        """对端打开了新流：客户端不接受服务端发起的流"""
+        self.control.append(HEADER.pack(YAMUX_VERSION, TYPE_WINDOW_UPDATE, FLAG_RST, stream_id, 0))
+
+    def _deliver(self, stream, data):
+        """收到流的数据：客户端先取出开头的服务端应答"""
+        if stream.status is not None:
+            stream.status += data
+            try:
+                result = _decode_status(stream.status)
+            except ValueError as e:
+                stream.log(logging.WARNING, str(e))
+                self._opened(stream, str(e))
+                self._reset(stream)
+                return
+            if result is None:
+                return
+            message, size = result
+            if message is not None:
+                stream.log(logging.WARNING, f"多路复用流 {stream.id} 连接目标失败: {message}")
+                self._opened(stream, message)
+                self._reset(stream)
+                return
+            data = stream.status[size:]
+            stream.status = None
+            self._opened(stream)
+            # 应答不写给本地，直接计入已消耗的窗口
+            stream.consumed += size
+        if data:
+            stream.inbox.append(memoryview(bytes(data)))
+
+    def _opened(self, stream, error=None):
+        """通知打开流的线程服务端的应答"""
+        waiter = stream.waiter
+        if waiter is not None:
+            stream.waiter = None
+            waiter.set(error)
+
+    def _read_local(self, stream):
+        """从本地读取一个数据帧，本地关闭时发出FIN"""
+        try:
+            data = stream.sock.recv(min(MAX_FRAME, stream.send_window))
+        except BlockingIOError:
+            return
+        except OSError:
+            self._reset(stream)
+            return
+        flags = 0
+        if not data:
+            stream.local_eof = True
+            stream.fin_at = time.monotonic()
+            flags = FLAG_FIN
+        stream.send_window -= len(data)
+        stream.frame = HEADER.pack(YAMUX_VERSION, TYPE_DATA, flags, stream.id, len(data)) + data
+        self.ready.append(stream)
+        self._dirty.add(stream)
+
+    def _write_local(self, stream):
+        """把收到的数据写给本地"""
+        inbox = stream.inbox
+        written = 0
+        try:
+            while inbox:
+                sent = stream.sock.send(inbox[0])
+                written += sent
+                if sent < len(inbox[0]):
+                    inbox[0] = inbox[0][sent:]
+                    break
+                inbox.popleft()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._reset(stream)
+            return
+        stream.consumed += written
+        self._dirty.add(stream)
+
+    def _grant(self, stream):
+        """本地写出的数据累计过半个窗口时通知对端"""
+        consumed = stream.consumed
+        if consumed >= INITIAL_WINDOW // 2:
+            self.control.append(HEADER.pack(YAMUX_VERSION, TYPE_WINDOW_UPDATE, 0, stream.id, consumed))
+            stream.recv_window += consumed
+            stream.consumed = 0
+
+    def _reset(self, stream):
+        """异常结束流，通知对端"""
+        self.control.append(HEADER.pack(YAMUX_VERSION, TYPE_WINDOW_UPDATE, FLAG_RST, stream.id, 0))
+        self._close_stream(stream)
+
+    def _close_stream(self, stream):
+        if stream.closed:
+            return
+        stream.closed = True
+        self._opened(stream, "流在服务端应答前被关闭")
+        self.streams.pop(stream.id, None)
+        self._dirty.discard(stream)
+        if stream.sock is not None:
+            if stream.interest:
+                self.loop.selector.unregister(stream.sock)
+            try:
+                stream.sock.close()
+            except OSError:
+                pass
+        if not self.streams:
+            self.idle_since = time.monotonic()
+        if self.on_stream_closed:
+            self.on_stream_closed(self)
+
+    def _queue(self, segments):
+        for segment in segments:
+            if len(segment):
+                self.out.append(memoryview(segment))
+                self.queued += len(segment)
+
+    def _fill(self):
+        """把控制帧和各流的数据帧编码到发送队列，返回是否有新数据"""
+        frames = self.control
+        self.control = []
+        size = sum(len(frame) for frame in frames)
+        ready = self.ready
+        # 每个流最多一个数据帧在ready中，依次取出即为轮转
+        while ready and self.queued + size < OUT_LIMIT:
+            stream = ready.popleft()
+            if stream.closed:
+                continue
+            frames.append(stream.frame)
+            size += len(stream.frame)
+            stream.frame = None
+            self._dirty.add(stream)
+        if not frames:
+            return False
+        self._queue(self.codec.encode_segments(b"".join(frames)))
+        return True
+
+    def _flush(self):
+        """写出发送队列，返回是否已全部写出"""
+        self.queued -= sockopts.send_segments(self.sock, self.out)
+        return not self.out
+
+    def _pump(self):
+        for stream in list(self._dirty):
+            if not stream.closed:
+                self._grant(stream)
+        while self._fill() and self._flush():
+            pass
+        # 流结束后关闭：FIN已编码、对端也已FIN且数据已写给本地
+        for stream in list(self._dirty):
+            if stream.closed or stream.inbox:
+                continue
+            if stream.remote_eof and not stream.shut and stream.sock is not None:
+                stream.shut = True
+                try:
+                    stream.sock.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+            if stream.remote_eof and stream.local_eof and stream.frame is None:
+                self._close_stream(stream)
+        if self.going_away and not self.streams and not self.out:
+            self.close()
+
+    def _sync(self):
+        """根据缓冲状态更新selector中的关注事件"""
+        if self.closed:
+            return
+        selector = self.loop.selector
+        events = EVENT_READ | (EVENT_WRITE if self.out else 0)
+        if events != self.interest:
+            if self.interest:
+                selector.modify(self.sock, events, (self, None))
+            else:
+                selector.register(self.sock, events, (self, None))
+            self.interest = events
+
+        for stream in self._dirty:
+            if stream.closed or stream.sock is None:
+                continue
+            events = 0
+            # 对端窗口用完或上一个数据帧还没有发出时不再读取本地(背压)
+            if not stream.local_eof and stream.frame is None and stream.send_window > 0:
+                events |= EVENT_READ
+            if stream.inbox:
+                events |= EVENT_WRITE
+            if events == stream.interest:
+                continue
+            if not stream.interest:
+                selector.register(stream.sock, events, (self, stream))
+            elif not events:
+                selector.unregister(stream.sock)
+            else:
+                selector.modify(stream.sock, events, (self, stream))
+            stream.interest = events
+        self._dirty.clear()
+
+    def close(self, error=None):
+        """关闭连接和其上所有的流"""
+        if self.closed:
+            return
+        if error is not None:
+            logger.warning(f"多路复用连接断开: {str(error)}")
+        self.closed = True
+        for stream in list(self.streams.values()):
+            self._close_stream(stream)
+        if self.loop is not None:
+            if self.interest:
+                self.loop.selector.unregister(self.sock)
+            self.loop.sessions.discard(self)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        if self.on_close:
+            self.on_close(self)
+
+
+class MuxLoop(SelectorThread):
+    """在一个线程中用同一个selector驱动所有多路复用连接和流
+
+    其他线程通过call把操作交给该线程执行，连接的状态只在该线程中访问。
+    """
+
+    def __init__(self, name="mux", on_tick=None, tick=1.0):
+        """
+        参数:
+            on_tick(): 有连接时每隔tick秒调用一次，各连接的tick之后调用
+        """
+        super().__init__(name)
+        self.on_tick = on_tick
+        self.tick = tick
+        self.sessions = set()
+        self._last_tick = time.monotonic()
+
+    def call(self, fn, *args):
+        """在事件循环线程中执行fn(*args)"""
+        self.submit((fn, args))
+
+    def add(self, session):
+        """登记连接，在事件循环线程中调用"""
+        session.attach(self)
+
+    def _accept(self, task):
+        fn, args = task
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f"多路复用操作失败: {str(e)}")
+
+    def _dispatch(self, data, sock, mask):
+        session, stream = data
+        if not session.closed:
+            session.handle(stream, mask)
+
+    def _timeout(self):
+        # 没有连接时线程不会醒来
+        return self.tick if self.sessions else None
+
+    def _on_timer(self):
+        now = time.monotonic()
+        if self.sessions and now - self._last_tick >= self.tick:
+            self._last_tick = now
+            for session in list(self.sessions):
+                session.tick(now)
+            if self.on_tick:
+                self.on_tick()
+
+
+class MuxPool:
+    """按节点保持少数几条多路复用连接，新的客户端连接作为流分配到负载最小的连接上"""
+
+    def __init__(self, connections=0, max_streams=32, idle_timeout=60):
+        """
+        参数:
+            connections: 每个节点最多保持的多路复用连接数，0表示禁用
+            max_streams: 每条连接上的最大流数，所有连接都满时新连接不使用多路复用
+            idle_timeout: 没有流的连接保持的时间(秒)
+        """
+        self.connections = connections
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self.loop = MuxLoop(on_tick=self._close_idle)
+        self._sessions = {}  # SSRClient -> [MuxSession]
+        self._connecting = {}  # SSRClient -> 正在建立的连接数
+        self._cond = threading.Condition()
+        self.opened = 0
+        self.fallbacks = 0
+        self.failures = 0
+
+    @property
+    def enabled(self):
+        return self.connections > 0
+
+    def open_stream(self, client, host, port, early_data=b""):
+        """通过节点的多路复用连接打开到目标的流，返回本地socket，没有可用的连接时返回None
+
+        等待服务端确认目标已连接后才返回，返回的socket与已建立隧道的上游socket用法相同。
+        服务端连接目标失败、流被关闭或等待应答超时时抛出ConnectionError。
+        """
+        session = self._acquire(client)
+        if session is None:
+            return None
+        sock, peer = socket.socketpair()
+        for s in (sock, peer):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, LOCAL_BUFFER)
+        peer.setblocking(False)
+        payload = stream_request(host, port) + early_data
+        waiter = _OpenWaiter()
+        self.loop.call(session.open_stream, peer, payload, contextvars.copy_context(), waiter)
+        if not waiter.done.wait(OPEN_TIMEOUT):
+            self.loop.call(session.cancel_open, waiter)
+            sock.close()
+            raise ConnectionError(f"等待多路复用流的应答超时({OPEN_TIMEOUT}秒)")
+        if waiter.error is not None:
+            sock.close()
+            raise ConnectionError(waiter.error)
+        return sock
+
+    def get_stats(self):
+        """获取多路复用统计信息"""
+        with self._cond:
+            sessions = [s for group in self._sessions.values() for s in group]
+            return {
+                "connections": len(sessions),
+                "streams": sum(s.assigned for s in sessions),
+                "opened": self.opened,
+                "fallbacks": self.fallbacks,
+                "connect_failures": self.failures,
+            }
+
+    def _pick(self, sessions):
+        live = [s for s in sessions if not s.closed and not s.going_away and s.assigned < self.max_streams]
+        if not live:
+            return None
+        session = min(live, key=lambda s: s.assigned)
+        session.assigned += 1
+        self.opened += 1
+        return session
+
+    def _acquire(self, client):
+        """取得一条可以打开新流的连接，需要时建立新连接"""
+        deadline = time.monotonic() + CONNECT_WAIT
+        with self._cond:
+            while True:
+                sessions = self._sessions.setdefault(client, [])
+                session = self._pick(sessions)
+                if session:
+                    return session
+                connecting = self._connecting.get(client, 0)
+                if len(sessions) + connecting < self.connections:
+                    self._connecting[client] = connecting + 1
+                    break
+                remaining = deadline - time.monotonic()
+                if not connecting or remaining <= 0:
+                    # 所有连接都已满
+                    self.fallbacks += 1
+                    return None
+                # 等待正在建立的连接
+                self._cond.wait(remaining)
+
+        session = None
+        try:
+            session = self._connect(client)
+        finally:
+            with self._cond:
+                self._connecting[client] -= 1
+                if session:
+                    self._sessions.setdefault(client, []).append(session)
+                    session.assigned = 1
+                    self.opened += 1
+                else:
+                    self.failures += 1
+                    self.fallbacks += 1
+                self._cond.notify_all()
+        return session
+
+    def _connect(self, client):
+        """建立到节点的多路复用连接"""
+        sock, codec = client.connect(MUX_HOST, MUX_PORT, early_data=SESSION_REQUEST)
+        if not sock:
+            logger.warning(f"建立到 {client.server}:{client.port} 的多路复用连接失败")
+            return None
+        session = MuxSession(sock, codec, on_close=self._on_close, on_stream_closed=self._on_stream_closed)
+        session.owner = client
+        self.loop.call(self.loop.add, session)
+        logger.info(f"已建立到 {client.server}:{client.port} 的多路复用连接")
+        return session
+
+    def _on_stream_closed(self, session):
+        with self._cond:
+            session.assigned -= 1
+            self._cond.notify_all()
+
+    def _on_close(self, session):
+        with self._cond:
+            sessions = self._sessions.get(session.owner)
+            if sessions and session in sessions:
+                sessions.remove(session)
+                if not sessions:
+                    del self._sessions[session.owner]
+            self._cond.notify_all()
+
+    def _close_idle(self):
+        """关闭空闲超时的连接"""
+        now = time.monotonic()
+        for session in list(self.loop.sessions):
+            with self._cond:
+                idle = not session.assigned and not session.streams
+            if idle and now - session.idle_since >= self.idle_timeout:
+                logger.info(f"关闭空闲的多路复用连接 {session.owner.server}:{session.owner.port}")
+                session.close()
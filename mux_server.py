@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多路复用测试服务器
+本地测试用的Shadowsocks服务端替身：目标地址为多路复用约定地址(sp.mux.sing-box.arpa:444)的连接
+按sing-mux(yamux)处理，每个流连接各自的目标；其他连接按普通Shadowsocks转发。
+只支持origin协议和plain混淆，加密方式与客户端相同(流加密、AEAD、rc4-md5、table)。
+
+用法:
+    python3 mux_server.py --port 8388 --password secret --method aes-256-gcm
+"""
+
+import socket
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cipher_backends
+from relay import Tunnel, run_tunnel
+from socks5 import parse_address
+from ssr_client import SSRClient
+from mux import (MuxSession, MuxStream, MuxLoop, MUX_HOST, MUX_PORT, PROTOCOL_YAMUX,
+                 HEADER, YAMUX_VERSION, TYPE_DATA, TYPE_WINDOW_UPDATE, FLAG_ACK, FLAG_FIN,
+                 encode_status)
+
+logger = logging.getLogger("mux_server")
+
+# 读取连接开头(IV和目标地址)的超时时间(秒)
+HEADER_TIMEOUT = 10
+# 连接目标的超时时间(秒)
+CONNECT_TIMEOUT = 10
+# 并发连接目标的线程数
+CONNECT_WORKERS = 16
+
+
+class ServerCodec:
+    """服务端一个连接的加密状态，接口与SSRSession相同(方向相反)"""
+
+    obfs = None
+
+    def __init__(self, client, iv):
+        self.client = client
+        self.decipher = client._create_cipher(client.key, iv, encrypt=False)
+        self.iv = client._random_iv()
+        self.cipher = client._create_cipher(client.key, self.iv, encrypt=True)
+        self._iv_sent = False
+
+    def encode_segments(self, data):
+        if self.client.aead:
+            segments = self.cipher.encrypt_segments(data)
+        else:
+            segments = [self.cipher.encrypt(data)]
+        if not self._iv_sent:
+            self._iv_sent = True
+            segments.insert(0, self.iv)
+        return segments
+
+    def drain_sendback(self):
+        return b""
+
+    def recv_size(self, length):
+        if self.client.aead:
+            return length - self.decipher.pending
+        return length
+
+    def decode(self, data):
+        return self.client._decrypt(data, self.decipher)
+
+    def decode_into(self, view, size):
+        return self.client._decrypt_into(view, size, self.decipher)
+
+
+class MuxServerSession(MuxSession):
+    """服务端的多路复用连接：接受客户端打开的流，解析流请求后在线程池中连接目标"""
+
+    def __init__(self, sock, codec, executor, initial=b""):
+        super().__init__(sock, codec, client=False, initial=initial)
+        self.executor = executor
+
+    def _accept(self, stream_id):
+        if stream_id in self.streams:
+            return
+        stream = MuxStream(stream_id, None)
+        stream.request = bytearray()
+        self.streams[stream_id] = stream
+        self.control.append(HEADER.pack(YAMUX_VERSION, TYPE_WINDOW_UPDATE, FLAG_ACK, stream_id, 0))
+
+    def _deliver(self, stream, data):
+        if stream.request is None:
+            super()._deliver(stream, data)
+            return
+        request = stream.request
+        request += data
+        try:
+            parsed = parse_address(request, 2) if len(request) > 2 else None
+        except Exception as e:
+            logger.warning(f"流 {stream.id} 的请求错误: {str(e)}")
+            self._reset(stream)
+            return
+        if parsed is None:
+            return
+        host, port, end = parsed
+        stream.request = None
+        stream.consumed += end
+        super()._deliver(stream, request[end:])
+        self.executor.submit(self._connect, stream, host, port)
+
+    def _connect(self, stream, host, port):
+        """在线程池中连接目标，结果交回事件循环线程"""
+        try:
+            sock = socket.create_connection((host, port), CONNECT_TIMEOUT)
+        except OSError as e:
+            self.loop.call(self._refuse, stream, f"连接 {host}:{port} 失败: {str(e)}")
+            return
+        self.loop.call(self._connected, stream, sock)
+
+    def _connected(self, stream, sock):
+        if stream.closed or self.closed:
+            sock.close()
+            return
+        sock.setblocking(False)
+        stream.sock = sock
+        # 应答是流的第一个数据
+        status = encode_status()
+        stream.send_window -= len(status)
+        stream.frame = HEADER.pack(YAMUX_VERSION, TYPE_DATA, 0, stream.id, len(status)) + status
+        self.ready.append(stream)
+        self._dirty.add(stream)
+        self._update()
+
+    def _refuse(self, stream, message):
+        if stream.closed or self.closed:
+            return
+        status = encode_status(message)
+        self.control.append(HEADER.pack(YAMUX_VERSION, TYPE_DATA, FLAG_FIN, stream.id, len(status)) + status)
+        self._close_stream(stream)
+        self._update()
+
+
+class MuxServer:
+    """监听端口，接受Shadowsocks连接"""
+
+    def __init__(self, host, port, password, method):
+        self.client = SSRClient(host, port, password, method)
+        if not self.client.cipher_supported:
+            raise ValueError(f"加密方式 {method} 不可用")
+        self.listener = socket.create_server((host, port))
+        self.address = self.listener.getsockname()
+        self.loop = MuxLoop(name="mux-server")
+        self.executor = ThreadPoolExecutor(CONNECT_WORKERS)
+        self.accepted = 0  # 接受的连接数
+
+    def start(self):
+        """在后台线程中接受连接"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._handle, args=(sock,), daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+    def _read_header(self, sock):
+        """读取IV和目标地址，返回(codec, host, port, 目标地址之后的明文)"""
+        client = self.client
+        iv = b""
+        while len(iv) < client.iv_len:
+            data = sock.recv(client.iv_len - len(iv))
+            if not data:
+                raise ConnectionError("客户端在发送IV前关闭了连接")
+            iv += data
+        codec = ServerCodec(client, iv)
+        plain = bytearray()
+        while True:
+            parsed = parse_address(plain)
+            if parsed:
+                host, port, end = parsed
+                return codec, host, port, bytes(plain[end:])
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("客户端在发送目标地址前关闭了连接")
+            plain += codec.decode(data)
+
+    def _handle(self, sock):
+        try:
+            sock.settimeout(HEADER_TIMEOUT)
+            codec, host, port, rest = self._read_header(sock)
+            if (host, port) == (MUX_HOST, MUX_PORT):
+                while len(rest) < 2:
+                    data = sock.recv(65536)
+                    if not data:
+                        raise ConnectionError("客户端在发送会话请求前关闭了连接")
+                    rest += codec.decode(data)
+                if rest[0] != 0 or rest[1] != PROTOCOL_YAMUX:
+                    raise ValueError(f"不支持的会话请求: 版本{rest[0]} 协议{rest[1]}")
+                session = MuxServerSession(sock, codec, self.executor, initial=rest[2:])
+                self.loop.call(self.loop.add, session)
+                return
+            target = socket.create_connection((host, port), CONNECT_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"处理连接失败: {str(e)}")
+            sock.close()
+            return
+        try:
+            if rest:
+                target.sendall(rest)
+            tunnel = Tunnel(target, sock, session=codec)
+            try:
+                run_tunnel(tunnel)
+            finally:
+                tunnel.close()
+        except Exception as e:
+            logger.warning(f"转发失败: {str(e)}")
+            target.close()
+            sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多路复用测试服务器")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8388, help="监听端口")
+    parser.add_argument("--password", required=True, help="密码")
+    parser.add_argument("--method", default="aes-256-gcm", help="加密方式")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    cipher_backends.select()
+    server = MuxServer(args.host, args.port, args.password, args.method)
+    logger.info(f"多路复用测试服务器监听 {server.address[0]}:{server.address[1]} ({args.method})")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
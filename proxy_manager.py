@@ -11,7 +11,6 @@ import random
 import logging
 import re
 from datetime import datetime
-from selectors import DefaultSelector, EVENT_READ
 from urllib.parse import unquote, urlparse
 
 try:
@@ -20,16 +19,31 @@ except ImportError:
     yaml = None
 
 try:
-    from ssr_client import SSRClient
+    from ssr_client import SSRConnection
 except ImportError:
-    SSRClient = None
+    SSRConnection = None
     logging.warning("SSR客户端模块导入失败，将使用简单TCP连接")
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from async_proxy import AsyncProxyServer
+from relay import Tunnel, run_tunnel, RELAY_HUB
+from stats import TrafficStats
+from upstream_pool import UpstreamPool
+from mux import MuxPool
+from happy_eyeballs import ConnectAttempt, race, resolve_addresses, ADDRESSES_PER_NODE
+from logging_setup import connection_logger as conn_logger, begin_connection
+from admission import AdmissionControl, Overloaded, REJECT_RESPONSE
+import sockopts
+import dns_cache
+import cipher_backends
+from reaper import ConnectionRegistry, current as current_connection
+from http_proxy import HttpForwarder
+from client_registry import ClientRegistry
+from socks5 import (Socks5Parser, Socks5Error, UdpRelay, UdpAssociation, resolve_udp, build_reply,
+                    CMD_UDP_ASSOCIATE, REP_SUCCEEDED, REP_GENERAL_FAILURE, REP_HOST_UNREACHABLE,
+                    REP_COMMAND_NOT_SUPPORTED, REJECT_GREETING)
+from http_parser import (HeaderParser, parse_target, build_connect_request, connect_reply_length,
+                         recv_connect_reply, is_forward_request, CONNECT_OK, CONNECT_FAILED)
+
 logger = logging.getLogger("proxy_manager")
 
 class Node:
@@ -78,13 +92,23 @@ class Node:
 
         return node_dict
 
+    @classmethod
+    def from_dict(cls, data):
+        """从字典恢复节点（to_dict的逆操作），用于向工作进程下发节点表"""
+        node = cls(data["name"], data["address"], data["port"], data.get("latency"),
+                   data.get("password"), data.get("method"), data.get("obfs"),
+                   data.get("obfs_param"), data.get("protocol"), data.get("protocol_param"))
+        node.status = data.get("status", "unknown")
+        if data.get("last_check"):
+            node.last_check = datetime.fromisoformat(data["last_check"])
+        return node
+
     def check_availability(self, timeout=2):
         """检查节点是否可用"""
         try:
             start_time = time.time()
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(timeout)
-            s.connect((self.address, self.port))
+            # 节点检查需要真正完成握手，不使用TFO
+            s = sockopts.create_connection((self.address, self.port), timeout, fastopen=False)
             s.close()
             end_time = time.time()
             self.latency = int((end_time - start_time) * 1000)  # 转换为毫秒
@@ -99,19 +123,54 @@ class Node:
 
 class ProxyManager:
     """代理管理器"""
-    def __init__(self, options):
+    def __init__(self, options, worker=False):
+        """
+        参数:
+            options: 配置选项
+            worker: 是否为多进程模式下的工作进程，工作进程的节点表由主进程下发
+        """
         print("启动Symi Proxy主程序...")
 
         self.options = options
+        sockopts.configure(options)  # socket选项，启动时报告生效情况
+        dns_cache.configure(options)  # 节点主机名的解析缓存
+        cipher_backends.configure(options)  # 为各加密方式选择最快的实现，须在构造SSR客户端之前
         self.nodes = []  # 节点列表
         self.current_node = None  # 当前使用的节点
         self.last_update = None  # 最后一次更新时间
-        self.stats = {  # 统计信息
-            "total_connections": 0,
-            "active_connections": 0,
-            "total_traffic": 0,  # 单位：字节
-        }
-        self.lock = threading.Lock()  # 线程锁
+        self.stats = TrafficStats()  # 统计信息，流量单位：字节
+        self.lock = threading.RLock()  # 线程锁（select_node会在持有锁时重入）
+        self.async_server = None  # asyncio数据面（data_plane=asyncio时使用）
+        self.upstream_pool = UpstreamPool(  # 当前节点的预连接池
+            targets=lambda: [self.current_node],
+            size=self.options.get("upstream_pool_size", 0),
+            max_age=self.options.get("upstream_pool_max_age", 20)
+        )
+        self.mux = MuxPool(  # SSR节点的多路复用连接
+            connections=self.options.get("mux_connections", 0),
+            max_streams=self.options.get("mux_max_streams", 32),
+            idle_timeout=self.options.get("mux_idle_timeout", 60)
+        )
+        self.admission = AdmissionControl(  # 并发上限
+            max_tunnels=self.options.get("max_tunnels", 0),
+            max_handshakes=self.options.get("max_handshakes", 0),
+            max_per_ip=self.options.get("max_connections_per_ip", 0),
+            policy=self.options.get("overload_policy", "queue"),
+            queue_timeout=self.options.get("admission_queue_timeout", 5)
+        )
+        self.http_forwarder = HttpForwarder(self)  # 普通HTTP代理请求，复用到目标的隧道
+        self.reaper = ConnectionRegistry(  # 握手/空闲/存活时间超时回收
+            handshake_timeout=self.options.get("handshake_timeout", 30),
+            idle_timeout=self.options.get("tunnel_idle_timeout", 600),
+            max_lifetime=self.options.get("tunnel_max_lifetime", 0)
+        )
+        self.clients = ClientRegistry()  # 各SSR节点的客户端，随节点表重建
+        self.node_listeners = [self._update_clients]  # 节点表或当前节点变化时的回调
+        self.worker_stats = None  # 多进程模式下汇总工作进程统计的对象
+
+        if worker:
+            # 工作进程不加载订阅、不检查节点，只负责转发
+            return
 
         # 加载自定义节点
         print("正在加载节点配置...")
@@ -312,6 +371,7 @@ class ProxyManager:
                     self.select_node(self.options.get("default_node", "auto"))
 
             logger.info(f"订阅更新成功，共获取 {len(nodes)} 个节点")
+            self._notify_nodes_changed()
             return True
 
         except Exception as e:
@@ -798,6 +858,8 @@ class ProxyManager:
     def check_all_nodes(self):
         """检查所有节点的可用性"""
         logger.info("开始检查所有节点的可用性")
+        # 先并发解析所有节点的主机名，多个节点共用同一主机名时只解析一次
+        dns_cache.prefetch([node.address for node in self.nodes], timeout=10)
         threads = []
 
         for node in self.nodes:
@@ -813,6 +875,7 @@ class ProxyManager:
         # 统计可用节点数量
         available_nodes = [node for node in self.nodes if node.status == "online"]
         logger.info(f"共有 {len(available_nodes)}/{len(self.nodes)} 个节点可用")
+        self._notify_nodes_changed()
 
         return available_nodes
 
@@ -822,6 +885,11 @@ class ProxyManager:
         参数:
             node_selector: 节点选择器，可以是节点名称、索引或"auto"（自动选择最快节点）
         """
+        selected = self._select_node(node_selector)
+        self._notify_nodes_changed()
+        return selected
+
+    def _select_node(self, node_selector):
         with self.lock:
             # 如果没有节点，返回False
             if not self.nodes:
@@ -858,7 +926,7 @@ class ProxyManager:
                     logger.info(f"选择节点 #{index}: {self.current_node.name}")
                 else:
                     logger.warning(f"节点 #{index} 不可用，自动选择最快节点")
-                    return self.select_node("auto")
+                    return self._select_node("auto")
             else:
                 # 按名称选择节点
                 found = False
@@ -873,7 +941,7 @@ class ProxyManager:
                 if not found:
                     logger.warning(f"节点 '{node_selector}' 不存在或不可用，自动选择最快节点")
                     if available_nodes:
-                        return self.select_node("auto")
+                        return self._select_node("auto")
                     else:
                         return False
 
@@ -908,6 +976,41 @@ class ProxyManager:
         t.start()
         logger.info(f"定时更新线程已启动，间隔: {self.options.get('subscription_update_interval', 24)}小时")
 
+    def add_node_listener(self, callback):
+        """注册节点表变化回调"""
+        self.node_listeners.append(callback)
+
+    def _update_clients(self):
+        with self.lock:
+            nodes = list(self.nodes)
+        self.clients.update(nodes)
+
+    def _notify_nodes_changed(self):
+        for callback in self.node_listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"节点变化回调失败: {str(e)}")
+
+    def get_node_snapshot(self):
+        """导出节点表和当前节点，用于下发给工作进程"""
+        with self.lock:
+            nodes = list(self.nodes)
+            current = self.current_node
+        return {
+            "nodes": [node.to_dict() for node in nodes],
+            "current": nodes.index(current) if current in nodes else None,
+        }
+
+    def apply_node_snapshot(self, snapshot):
+        """应用主进程下发的节点表"""
+        nodes = [Node.from_dict(data) for data in snapshot["nodes"]]
+        with self.lock:
+            self.nodes = nodes
+            index = snapshot.get("current")
+            self.current_node = nodes[index] if index is not None else None
+        self._notify_nodes_changed()
+
     def get_current_node(self):
         """获取当前使用的节点"""
         return self.current_node
@@ -917,15 +1020,30 @@ class ProxyManager:
         return self.nodes
 
     def get_stats(self):
-        """获取统计信息"""
-        return self.stats
+        """获取统计信息（读取时汇总各线程的计数分片）"""
+        stats = self.stats.snapshot()
+        if self.worker_stats:
+            for key, value in self.worker_stats.totals().items():
+                stats[key] += value
+        if self.admission.enabled:
+            stats["admission"] = self.admission.get_stats()
+        if self.http_forwarder.pool.size:
+            pool = self.async_server.http_pool if self.async_server else self.http_forwarder.pool
+            stats["http_pool"] = pool.get_stats()
+        if self.upstream_pool.enabled:
+            stats["upstream_pool"] = self.upstream_pool.get_stats()
+        if self.mux.enabled:
+            stats["mux"] = self.mux.get_stats()
+        if dns_cache.DNS_CACHE.enabled:
+            stats["dns_cache"] = dns_cache.get_stats()
+        stats["reaper"] = self.reaper.get_stats()
+        stats["ssr_clients"] = self.clients.get_stats()
+        stats["relay_hub"] = RELAY_HUB.get_stats()
+        return stats
 
     def update_stats(self, connection_change=0, traffic=0):
-        """更新统计信息"""
-        with self.lock:
-            self.stats["total_connections"] += max(0, connection_change)
-            self.stats["active_connections"] += connection_change
-            self.stats["total_traffic"] += traffic
+        """更新统计信息，不占用全局锁"""
+        self.stats.add(connection_change, traffic)
 
     def xor_encode(self, bstring):
         """XOR编码"""
@@ -937,194 +1055,116 @@ class ProxyManager:
 
     def proxy_process(self, sock1, sock2):
         """在两个socket之间转发数据"""
-        # 检查sock2是否为SSR客户端
-        is_ssr_client = hasattr(sock2, '__class__') and sock2.__class__.__name__ == 'SSRClient'
+        # 检查sock2是否为SSR连接（SSR连接需要加解密，不能直接转发socket数据）
+        is_ssr_client = SSRConnection is not None and isinstance(sock2, SSRConnection)
+
+        # 握手完成，之后按空闲时间回收；上游连接也需要在回收时中止
+        conn = current_connection()
+        if conn:
+            conn.add(sock2)
+            conn.established()
 
         if is_ssr_client:
             # 使用SSR客户端进行数据转发
-            self._proxy_process_ssr(sock1, sock2)
+            self._proxy_process_ssr(sock1, sock2, conn)
         else:
             # 使用普通socket进行数据转发
-            self._proxy_process_normal(sock1, sock2)
+            self._proxy_process_normal(sock1, sock2, conn)
 
-    def _proxy_process_normal(self, sock1, sock2):
+    def _proxy_process_normal(self, sock1, sock2, conn=None):
         """普通socket之间的数据转发"""
-        sel = DefaultSelector()
-        sel.register(sock1, EVENT_READ)
-        sel.register(sock2, EVENT_READ)
-
         # 获取连接信息用于日志
         try:
             local_addr = sock1.getpeername()
             remote_addr = sock2.getpeername()
             connection_info = f"本地({local_addr[0]}:{local_addr[1]}) <-> 远程({remote_addr[0]}:{remote_addr[1]})"
-            logger.info(f"开始数据转发: {connection_info}")
+            conn_logger.info("开始数据转发: %s", connection_info)
         except:
             connection_info = "未知连接"
 
-        # 统计变量
-        bytes_sent = 0
-        bytes_received = 0
-        last_log_time = time.time()
+        tunnel = Tunnel(sock1, sock2, self.options.get("relay_mode", "auto"))
 
-        while True:
-            try:
-                events = sel.select(timeout=1.0)
+        def on_traffic(data_len):
+            # 更新流量统计
+            self.update_stats(traffic=data_len)
+            if conn:
+                conn.touch()
 
-                # 定期记录流量统计
-                current_time = time.time()
-                if current_time - last_log_time > 30:  # 每30秒记录一次
-                    if bytes_sent > 0 or bytes_received > 0:
-                        logger.info(f"连接 {connection_info} 流量统计: 发送={bytes_sent}字节, 接收={bytes_received}字节")
-                    last_log_time = current_time
+        def report():
+            # 定期记录流量统计，由回收线程的时间轮触发，转发线程不需要定期醒来
+            if tunnel.bytes_sent > 0 or tunnel.bytes_received > 0:
+                conn_logger.info("连接 %s 流量统计: 发送=%d字节, 接收=%d字节",
+                                 connection_info, tunnel.bytes_sent, tunnel.bytes_received)
 
-                if not events:  # 超时，继续循环
-                    continue
+        if conn:
+            conn.report_every(30, report)
 
-                for (key, _) in events:
-                    try:
-                        data_in = key.fileobj.recv(8192)
-                    except ConnectionResetError as e:
-                        logger.error(f"连接重置: {str(e)}")
-                        sock1.close()
-                        sock2.close()
-                        self.update_stats(connection_change=-1)
-                        logger.info(f"连接关闭 {connection_info}: 连接重置")
-                        return
-                    except Exception as e:
-                        logger.error(f"数据接收错误: {str(e)}")
-                        sock1.close()
-                        sock2.close()
-                        self.update_stats(connection_change=-1)
-                        logger.info(f"连接关闭 {connection_info}: 数据接收错误")
-                        return
-
-                    if data_in:
-                        # 更新流量统计
-                        data_len = len(data_in)
-                        self.update_stats(traffic=data_len)
+        try:
+            reason = run_tunnel(tunnel, on_traffic)
+            if conn and conn.reaped:
+                reason = f"已回收({conn.reaped})"
+        except Exception as e:
+            logger.error(f"代理处理错误: {str(e)}")
+            reason = "代理处理错误"
+        finally:
+            tunnel.close()
+            self.update_stats(connection_change=-1)
 
-                        try:
-                            if key.fileobj == sock1:
-                                # 本地 -> 远程
-                                bytes_sent += data_len
-                                sock2.send(data_in)  # 直接发送数据，不进行XOR编码
-                            else:
-                                # 远程 -> 本地
-                                bytes_received += data_len
-                                sock1.send(data_in)  # 直接发送数据，不进行XOR编码
-                        except Exception as e:
-                            logger.error(f"数据发送错误: {str(e)}")
-                            sock1.close()
-                            sock2.close()
-                            self.update_stats(connection_change=-1)
-                            logger.info(f"连接关闭 {connection_info}: 数据发送错误")
-                            return
-                    else:
-                        sock1.close()
-                        sock2.close()
-                        self.update_stats(connection_change=-1)
-                        logger.info(f"连接关闭 {connection_info}: 正常关闭, 总流量: 发送={bytes_sent}字节, 接收={bytes_received}字节")
-                        return
-            except Exception as e:
-                logger.error(f"代理处理错误: {str(e)}")
-                try:
-                    sock1.close()
-                    sock2.close()
-                except:
-                    pass
-                self.update_stats(connection_change=-1)
-                logger.info(f"连接关闭 {connection_info}: 代理处理错误")
-                return
+        if reason == "正常关闭":
+            conn_logger.info("连接关闭 %s: 正常关闭, 总流量: 发送=%d字节, 接收=%d字节",
+                             connection_info, tunnel.bytes_sent, tunnel.bytes_received)
+        else:
+            conn_logger.info("连接关闭 %s: %s", connection_info, reason)
 
-    def _proxy_process_ssr(self, sock_local, ssr_connection):
-        """SSR连接的数据转发"""
-        logger.info("开始SSR数据转发")
+    def _proxy_process_ssr(self, sock_local, ssr_connection, conn=None):
+        """SSR连接的数据转发
 
+        隧道交给RelayHub的转发线程，编码/解码随读写在转发线程中进行，当前线程只等待隧道结束。
+        """
         # 获取连接信息用于日志
         try:
             local_addr = sock_local.getpeername()
             remote_addr = ssr_connection.getpeername()
             connection_info = f"本地({local_addr[0]}:{local_addr[1]}) <-> SSR远程({remote_addr[0]}:{remote_addr[1]})"
-            logger.info(f"开始SSR数据转发: {connection_info}")
+            conn_logger.info("开始SSR数据转发: %s", connection_info)
         except:
             connection_info = "SSR连接"
 
-        # 统计变量
-        bytes_sent = 0
-        bytes_received = 0
-        last_log_time = time.time()
-
-        # 创建线程来处理双向数据转发
-        def local_to_remote():
-            nonlocal bytes_sent
-            try:
-                while True:
-                    data = sock_local.recv(8192)
-                    if not data:
-                        break
-
-                    # 通过SSR连接发送数据
-                    ssr_connection.send(data)
-                    bytes_sent += len(data)
-                    self.update_stats(traffic=len(data))
-
-                    logger.debug(f"本地->SSR远程: {len(data)}字节")
-
-            except Exception as e:
-                logger.error(f"本地到SSR远程数据转发错误: {str(e)}")
-            finally:
-                try:
-                    sock_local.close()
-                    ssr_connection.close()
-                except:
-                    pass
-
-        def remote_to_local():
-            nonlocal bytes_received
-            try:
-                while True:
-                    # 从SSR连接接收数据
-                    data = ssr_connection.recv(8192)
-                    if not data:
-                        break
-
-                    # 发送到本地连接
-                    sock_local.send(data)
-                    bytes_received += len(data)
-                    self.update_stats(traffic=len(data))
+        tunnel = Tunnel(sock_local, ssr_connection.sock, session=ssr_connection.session)
 
-                    logger.debug(f"SSR远程->本地: {len(data)}字节")
+        def on_traffic(data_len):
+            # 在转发线程中调用
+            self.update_stats(traffic=data_len)
+            if conn:
+                conn.touch()
 
-            except Exception as e:
-                logger.error(f"SSR远程到本地数据转发错误: {str(e)}")
-            finally:
-                try:
-                    sock_local.close()
-                    ssr_connection.close()
-                except:
-                    pass
-
-        # 启动双向转发线程
-        thread1 = threading.Thread(target=local_to_remote)
-        thread2 = threading.Thread(target=remote_to_local)
-
-        thread1.daemon = True
-        thread2.daemon = True
+        def report():
+            if tunnel.bytes_sent > 0 or tunnel.bytes_received > 0:
+                conn_logger.info("连接 %s 流量统计: 发送=%d字节, 接收=%d字节",
+                                 connection_info, tunnel.bytes_sent, tunnel.bytes_received)
 
-        thread1.start()
-        thread2.start()
+        if conn:
+            conn.report_every(30, report)
 
-        # 等待线程结束
-        thread1.join()
-        thread2.join()
+        try:
+            reason = RELAY_HUB.run(tunnel, on_traffic)
+            if conn and conn.reaped:
+                reason = f"已回收({conn.reaped})"
+        except Exception as e:
+            logger.error(f"SSR代理处理错误: {str(e)}")
+            reason = "代理处理错误"
+        finally:
+            tunnel.close()
+            ssr_connection.closed = True
+            self.update_stats(connection_change=-1)
 
-        self.update_stats(connection_change=-1)
-        logger.info(f"SSR连接关闭 {connection_info}, 总流量: 发送={bytes_sent}字节, 接收={bytes_received}字节")
+        conn_logger.info("SSR连接关闭 %s: %s, 总流量: 发送=%d字节, 接收=%d字节",
+                         connection_info, reason, tunnel.bytes_sent, tunnel.bytes_received)
 
     def handle_connection(self, sock_in, addr):
         """处理新的连接请求"""
-        logger.info(f"新的连接: {addr[0]}:{addr[1]}")
+        begin_connection()
+        conn_logger.info("新的连接: %s:%d", addr[0], addr[1])
         self.update_stats(connection_change=1)
 
         # 获取当前节点
@@ -1135,87 +1175,94 @@ class ProxyManager:
             self.update_stats(connection_change=-1)
             return
 
-        logger.info(f"使用节点: {node.name}")
+        conn_logger.info("使用节点: %s", node.name)
 
         # 尝试解析HTTP请求，支持HTTP代理
+        data = b""
         try:
             sock_in.settimeout(5)
             data = sock_in.recv(4096)
 
             # 检查是否是HTTP CONNECT请求
             if data.startswith(b'CONNECT'):
-                # 解析目标地址
-                first_line = data.split(b'\r\n')[0].decode('utf-8')
-                target = first_line.split(' ')[1]
-                logger.info(f"收到HTTP CONNECT请求: {target}")
-
-                host, port = target.split(':')
-                port = int(port)
-
-                # 发送连接成功响应
-                sock_in.send(b'HTTP/1.1 200 Connection Established\r\n\r\n')
+                # 读取完整的请求头，之后的数据作为早期数据随首包发出
+                parser = HeaderParser()
+                request = parser.feed(data)
+                while request is None:
+                    chunk = sock_in.recv(4096)
+                    if not chunk:
+                        raise ConnectionError("客户端在请求头完成前关闭了连接")
+                    request = parser.feed(chunk)
+                early_data = parser.leftover
+                conn_logger.info("收到HTTP CONNECT请求: %s (早期数据%d字节)", request.target, len(early_data))
+
+                host, port = parse_target(request.target)
+                defer_reply = self.options.get("defer_connect_reply", False)
 
                 try:
-                    logger.info(f"通过节点 {node.name} 连接到目标: {host}:{port}")
-
-                    # 建立远程连接
-                    remote_connection = self._create_remote_connection(node)
-                    if not remote_connection:
-                        logger.error(f"无法创建到远程节点的连接")
+                    with self.admission.handshake():
+                        if not defer_reply:
+                            # 发送连接成功响应
+                            sock_in.send(CONNECT_OK)
+                        node, upstream = self.open_tunnel(node, host, port, early_data)
+                    if not upstream:
+                        if defer_reply:
+                            sock_in.send(CONNECT_FAILED)
                         sock_in.close()
                         self.update_stats(connection_change=-1)
                         return
+                    if defer_reply:
+                        # 上游连接成功后才告诉客户端隧道已建立
+                        sock_in.send(CONNECT_OK)
 
-                    # 检查是否为SSR客户端
-                    if hasattr(remote_connection, '__class__') and remote_connection.__class__.__name__ == 'SSRClient':
-                        # SSR连接：需要先建立到目标的连接
-                        ssr_connection = remote_connection.create_connection(host, port)
-                        if not ssr_connection:
-                            logger.error(f"SSR连接到目标 {host}:{port} 失败")
-                            sock_in.close()
-                            self.update_stats(connection_change=-1)
-                            return
-
-                        logger.info(f"SSR连接已建立到目标: {host}:{port}")
-                        # 使用SSR连接进行数据转发
-                        self.proxy_process(sock_in, ssr_connection)
-                    else:
-                        # 普通TCP连接：需要手动发送CONNECT请求
-                        connect_request = f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n"
-                        remote_connection.send(connect_request.encode())
-
-                        # 接收响应
-                        response = remote_connection.recv(1024)
-                        if b"200" not in response:
-                            logger.error(f"代理服务器拒绝连接到 {host}:{port}")
-                            remote_connection.close()
-                            sock_in.close()
-                            self.update_stats(connection_change=-1)
-                            return
-
-                        logger.info(f"普通代理连接已建立到目标: {host}:{port}")
-                        # 在本地连接与远程连接间转发数据
-                        self.proxy_process(sock_in, remote_connection)
-
+                    # 在本地连接与远程连接间转发数据
+                    self.proxy_process(sock_in, upstream)
+                    return
+                except Overloaded as e:
+                    self._reject(sock_in, addr, str(e))
+                    self.update_stats(connection_change=-1)
                     return
                 except Exception as e:
                     logger.error(f"连接到目标 {host}:{port} 失败: {str(e)}")
+                    if defer_reply:
+                        try:
+                            sock_in.send(CONNECT_FAILED)
+                        except OSError:
+                            pass
                     sock_in.close()
                     self.update_stats(connection_change=-1)
                     return
 
+            # 绝对URI形式的HTTP代理请求：逐个转发请求，复用到目标的隧道
+            if self.options.get("http_proxy", True) and is_forward_request(data):
+                self._serve_http(sock_in, addr, node, data)
+                return
+
             # 如果不是HTTP CONNECT请求，回退到普通代理模式
-            logger.info("非HTTP CONNECT请求，使用普通代理模式")
+            conn_logger.info("非HTTP CONNECT请求，使用普通代理模式")
         except socket.timeout:
-            logger.info("接收数据超时，使用普通代理模式")
+            conn_logger.info("接收数据超时，使用普通代理模式")
         except Exception as e:
             logger.warning(f"解析HTTP请求失败: {str(e)}，使用普通代理模式")
 
+        # 握手超时已被回收的连接不再回退
+        conn = current_connection()
+        if conn and conn.reaped:
+            sock_in.close()
+            self.update_stats(connection_change=-1)
+            return
+
         # 重置socket超时
         sock_in.settimeout(None)
 
         # 建立远程连接
-        sock_remote = self._create_remote_connection(node)
+        try:
+            with self.admission.handshake():
+                sock_remote = self._create_remote_connection(node)
+        except Overloaded as e:
+            self._reject(sock_in, addr, str(e))
+            self.update_stats(connection_change=-1)
+            return
         if not sock_remote:
             # 尝试重新选择节点
             if self.select_node("auto"):
@@ -1235,76 +1282,376 @@ class ProxyManager:
                 self.update_stats(connection_change=-1)
                 return
 
-        # 在本地连接与远程连接间转发数据
-        logger.info(f"开始在本地连接 {addr[0]}:{addr[1]} 和远程节点 {node.address}:{node.port} 之间转发数据")
+        if not isinstance(sock_remote, socket.socket):
+            # SSR节点的连接需要目标地址，非HTTP请求的数据没有目标，不能转发
+            logger.error(f"节点 {node.name} 是SSR节点，不能转发非HTTP请求的数据")
+            sock_in.close()
+            self.update_stats(connection_change=-1)
+            return
+
+        # 在本地连接与远程连接间转发数据，已读取的数据先发给节点
+        conn_logger.info("开始在本地连接 %s:%d 和远程节点 %s:%d 之间转发数据",
+                         addr[0], addr[1], node.address, node.port)
+        if data:
+            try:
+                sock_remote.sendall(data)
+            except OSError as e:
+                logger.error(f"转发初始数据失败: {str(e)}")
+                sock_remote.close()
+                sock_in.close()
+                self.update_stats(connection_change=-1)
+                return
         self.proxy_process(sock_in, sock_remote)
 
+    def _serve_http(self, sock_in, addr, node, data):
+        """处理普通HTTP代理请求，直到客户端连接关闭"""
+        upgraded = None
+        conn = current_connection()
+        if conn:
+            # 请求之间的空闲由http_keepalive_timeout控制
+            conn.established(track_idle=False)
+        try:
+            upgraded = self.http_forwarder.serve(sock_in, node, data)
+        except Overloaded as e:
+            self._reject(sock_in, addr, str(e))
+        except Exception as e:
+            logger.error(f"HTTP代理请求失败: {str(e)}")
+
+        if upgraded:
+            # 协议升级(例如WebSocket)之后按隧道转发，升级请求之后已读取的数据先发给目标
+            tunnel, leftover = upgraded
+            if leftover:
+                try:
+                    tunnel.sendall(leftover)
+                except OSError as e:
+                    logger.error(f"转发升级后的数据失败: {str(e)}")
+            sock_in.settimeout(None)
+            self.proxy_process(sock_in, tunnel)
+            return
+
+        try:
+            sock_in.close()
+        except OSError:
+            pass
+        self.update_stats(connection_change=-1)
+
+    def handle_socks5(self, sock_in, addr):
+        """处理新的SOCKS5连接"""
+        begin_connection()
+        conn_logger.info("新的SOCKS5连接: %s:%d", addr[0], addr[1])
+        self.update_stats(connection_change=1)
+
+        try:
+            sock_in.settimeout(5)
+            parser = Socks5Parser()
+            request = None
+            while request is None:
+                data = sock_in.recv(4096)
+                if not data:
+                    raise ConnectionError("客户端在协商完成前关闭了连接")
+                reply, request = parser.feed(data)
+                if reply:
+                    sock_in.sendall(reply)
+            command, host, port = request
+
+            node = self.get_current_node()
+            if not node:
+                logger.error("没有可用节点，拒绝连接")
+                sock_in.sendall(build_reply(REP_GENERAL_FAILURE))
+            elif command == CMD_UDP_ASSOCIATE:
+                self._socks5_udp(sock_in, addr, node)
+            else:
+                # 请求之后客户端提前发送的数据作为早期数据随首包发出
+                early_data = parser.leftover
+                conn_logger.info("收到SOCKS5 CONNECT请求: %s:%d (早期数据%d字节)", host, port, len(early_data))
+                with self.admission.handshake():
+                    node, upstream = self.open_tunnel(node, host, port, early_data)
+                if not upstream:
+                    sock_in.sendall(build_reply(REP_HOST_UNREACHABLE))
+                else:
+                    sock_in.sendall(build_reply(REP_SUCCEEDED))
+                    sock_in.settimeout(None)
+                    # 在本地连接与远程连接间转发数据
+                    self.proxy_process(sock_in, upstream)
+                    return
+        except Socks5Error as e:
+            logger.warning(f"SOCKS5协商失败: {str(e)}")
+            try:
+                sock_in.sendall(e.reply)
+            except OSError:
+                pass
+        except Overloaded as e:
+            self._reject(sock_in, addr, str(e), build_reply(REP_GENERAL_FAILURE))
+        except Exception as e:
+            logger.error(f"处理SOCKS5连接失败: {str(e)}")
+
+        try:
+            sock_in.close()
+        except OSError:
+            pass
+        self.update_stats(connection_change=-1)
+
+    def _socks5_udp(self, sock_in, addr, node):
+        """UDP ASSOCIATE：在客户端和SSR节点之间转发数据报，直到控制连接关闭"""
+        client = self._get_ssr_client(node) if node.password else None
+        if not client or not client.udp_supported:
+            logger.warning(f"节点 {node.name} 不支持UDP转发")
+            sock_in.sendall(build_reply(REP_COMMAND_NOT_SUPPORTED))
+            return
+
+        relay = UdpRelay(client, addr[0], lambda n: self.update_stats(traffic=n))
+        association = UdpAssociation(relay, sock_in.getsockname()[0], resolve_udp(node.address, node.port),
+                                     self.options.get("socks5_udp_timeout", 60))
+        bound_host, bound_port = association.bound
+        conn_logger.info("UDP关联已建立: %s:%d <-> 节点 %s", bound_host, bound_port, node.name)
+        sock_in.sendall(build_reply(REP_SUCCEEDED, bound_host, bound_port))
+        sock_in.settimeout(None)
+        conn = current_connection()
+        if conn:
+            # UDP关联有自己的空闲超时
+            conn.established(track_idle=False)
+        association.serve(sock_in)
+
+    def _reject(self, sock, addr, reason, response=REJECT_RESPONSE):
+        """过载时返回503(或指定的应答)并关闭连接"""
+        conn_logger.warning("拒绝连接 %s:%d: %s", addr[0], addr[1], reason)
+        try:
+            sock.setblocking(False)
+            sock.send(response)
+        except OSError:
+            pass
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def _handle_admitted(self, handler, sock_in, addr):
+        """处理已获得准入名额的连接，结束后释放名额"""
+        try:
+            with self.reaper.track(sock_in):
+                handler(sock_in, addr)
+        finally:
+            self.admission.release(addr[0])
+
+    def open_tunnel(self, node, host, port, early_data=b""):
+        """通过节点建立到目标的隧道，返回(实际使用的节点, 隧道)，失败时隧道为None
+
+        隧道为SSRConnection（SSR节点）或已完成CONNECT握手的socket（普通节点）。
+        connect_mode为race时，在多个节点之间竞速建立连接。
+        early_data为客户端在CONNECT请求头之后已经发送的数据。
+        """
+        if self.options.get("connect_mode", "single") == "race":
+            # 连接池中有预连接时直接使用，不需要竞速
+            pooled = self.upstream_pool.acquire(node)
+            if pooled:
+                return node, self._open_tunnel_on(node, host, port, pooled, early_data)
+            return self._race_tunnel(host, port, early_data)
+        return node, self._open_tunnel_on(node, host, port, early_data=early_data)
+
+    def _open_tunnel_on(self, node, host, port, sock=None, early_data=b""):
+        """通过指定节点建立到目标的隧道"""
+        conn_logger.info("通过节点 %s 连接到目标: %s:%d", node.name, host, port)
+
+        # SSR节点
+        if node.password:
+            ssr_client = self._get_ssr_client(node)
+            if not ssr_client:
+                logger.error(f"无法创建到远程节点的连接")
+                if sock:
+                    sock.close()
+                return None
+
+            # 多路复用：作为流打开在已有的长连接上，连接都已满时使用单独的SSR连接
+            if sock is None and self.mux.enabled:
+                try:
+                    stream = self.mux.open_stream(ssr_client, host, port, early_data)
+                except ConnectionError as e:
+                    logger.error(f"SSR多路复用流连接到目标 {host}:{port} 失败: {str(e)}")
+                    return None
+                if stream:
+                    conn_logger.info("SSR多路复用流已打开到目标: %s:%d", host, port)
+                    return stream
+
+            # SSR连接：需要先建立到目标的连接
+            if sock is None:
+                sock = self.upstream_pool.acquire(node)
+            ssr_connection = ssr_client.create_connection(host, port, sock, early_data)
+            if not ssr_connection:
+                logger.error(f"SSR连接到目标 {host}:{port} 失败")
+                return None
+
+            conn_logger.info("SSR连接已建立到目标: %s:%d", host, port)
+            return ssr_connection
+
+        # 普通TCP连接
+        remote_connection = sock or self._create_remote_connection(node)
+        if not remote_connection:
+            logger.error(f"无法创建到远程节点的连接")
+            return None
+
+        # 普通TCP连接：需要手动发送CONNECT请求，早期数据紧跟在请求头之后
+        remote_connection.sendall(build_connect_request(host, port) + early_data)
+
+        # 接收响应
+        if not recv_connect_reply(remote_connection):
+            logger.error(f"代理服务器拒绝连接到 {host}:{port}")
+            remote_connection.close()
+            return None
+
+        conn_logger.info("普通代理连接已建立到目标: %s:%d", host, port)
+        return remote_connection
+
+    def get_ranked_nodes(self, limit=3):
+        """按最近一次检查的延迟返回可用节点，当前节点排在最前
+
+        只使用已有的检查结果，不会触发新的节点检查。
+        """
+        nodes = [node for node in self.nodes if node.status == "online"]
+        if self.options.get("use_custom_node", False):
+            custom_nodes = [node for node in nodes if node.name.startswith("自定义节点")]
+            if custom_nodes:
+                nodes = custom_nodes
+        nodes.sort(key=lambda x: x.latency if x.latency is not None else float('inf'))
+
+        current = self.current_node
+        if current in nodes:
+            nodes.remove(current)
+            nodes.insert(0, current)
+        elif current and not nodes:
+            nodes = [current]
+        return nodes[:limit]
+
+    def _race_tunnel(self, host, port, early_data=b""):
+        """在延迟最低的几个节点之间竞速建立隧道"""
+        candidates = self.get_ranked_nodes(self.options.get("race_nodes", 3))
+        stagger = self.options.get("race_stagger_ms", 250) / 1000.0
+
+        # 每个节点的地址（IPv6/IPv4交替），先尝试各节点的第一个地址
+        per_node = []
+        for node in candidates:
+            try:
+                per_node.append((node, resolve_addresses(node.address, node.port)))
+            except OSError as e:
+                logger.warning(f"解析节点 {node.name} 地址失败: {str(e)}")
+
+        attempts = []
+        for i in range(ADDRESSES_PER_NODE):
+            for node, addresses in per_node:
+                if i < len(addresses):
+                    attempt = self._make_attempt(node, addresses[i], host, port, early_data)
+                    if attempt:
+                        attempts.append(attempt)
+
+        if not attempts:
+            logger.error("没有可用于竞速连接的节点")
+            return None, None
+
+        conn_logger.info("竞速连接到 %s:%d，候选节点: %s", host, port, ", ".join(node.name for node, _ in per_node))
+        winner = race(attempts, stagger=stagger, timeout=15)
+        if not winner:
+            logger.error(f"所有节点都无法连接到 {host}:{port}")
+            return None, None
+
+        conn_logger.info("竞速连接胜出: %s", winner)
+        if winner.context is not None:
+            return winner.node, SSRConnection(winner.sock, winner.context)
+        return winner.node, winner.sock
+
+    def _make_attempt(self, node, address, host, port, early_data=b""):
+        """为节点的一个地址构造连接尝试"""
+        family, sockaddr = address
+        if node.password:
+            ssr_client = self._get_ssr_client(node)
+            if not ssr_client:
+                return None
+            session = ssr_client.new_session()
+            first_packet = session.handshake(host, port, early_data)
+            if first_packet is None:
+                return None
+            return ConnectAttempt(node, family, sockaddr, first_packet, context=session)
+
+        return ConnectAttempt(node, family, sockaddr, build_connect_request(host, port) + early_data,
+                              connect_reply_length)
+
     def _create_remote_connection(self, node):
         """创建到远程节点的连接"""
         try:
             # 对于SSR节点，我们需要特殊处理
             if hasattr(node, 'password') and node.password:
-                logger.info(f"检测到SSR节点: {node.name}")
-
-                # 检查加密库是否可用
-                try:
-                    from ssr_client import CRYPTO_AVAILABLE
-                    if CRYPTO_AVAILABLE and SSRClient:
-                        logger.info(f"使用SSR协议连接到节点: {node.name}")
-
-                        # 创建SSR客户端
-                        ssr_client = SSRClient(
-                            server=node.address,
-                            port=node.port,
-                            password=node.password,
-                            method=getattr(node, 'method', 'rc4-md5'),
-                            protocol=getattr(node, 'protocol', 'origin'),
-                            obfs=getattr(node, 'obfs', 'plain'),
-                            protocol_param=getattr(node, 'protocol_param', ''),
-                            obfs_param=getattr(node, 'obfs_param', '')
-                        )
+                return self._get_ssr_client(node)
 
-                        return ssr_client
-                    else:
-                        logger.warning("加密库不可用，SSR节点无法使用普通TCP连接")
-                        return None
-                except ImportError:
-                    logger.warning("SSR模块不可用，SSR节点无法使用")
-                    return None
+            # 优先使用连接池中已建立的连接
+            sock_remote = self.upstream_pool.acquire(node)
+            if sock_remote:
+                conn_logger.info("使用预连接到节点: %s:%d", node.address, node.port)
+                return sock_remote
 
             # 普通TCP连接（仅用于非SSR节点）
-            logger.info(f"使用普通TCP连接到节点: {node.address}:{node.port}")
-            sock_remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock_remote.settimeout(15)
-            sock_remote.connect((node.address, node.port))
-            logger.info(f"成功连接到远程节点: {node.address}:{node.port}")
+            conn_logger.info("使用普通TCP连接到节点: %s:%d", node.address, node.port)
+            sock_remote = sockopts.create_connection((node.address, node.port), 15)
+            conn_logger.info("成功连接到远程节点: %s:%d", node.address, node.port)
             return sock_remote
 
         except Exception as e:
             logger.error(f"连接到远程节点 {node.name} ({node.address}:{node.port}) 失败: {str(e)}")
             return None
 
+    def _get_ssr_client(self, node):
+        """取得SSR节点的客户端(节点表变化时预先构造)，加密库不可用时返回None"""
+        client = self.clients.get(node)
+        if client is None:
+            logger.warning(f"节点 {node.name} 的加密方式、协议或混淆不可用，SSR节点不能以明文连接")
+            return None
+        conn_logger.info("使用SSR协议连接到节点: %s", node.name)
+        return client
+
     def start_proxy_server(self):
         """启动代理服务器"""
         local_port = self.options.get("local_port", 7088)
 
-        def server_thread():
+        # 启动上游预连接池和连接超时回收
+        self.upstream_pool.start()
+        self.reaper.start()
+
+        # 多进程模式下各工作进程以SO_REUSEPORT绑定同一端口
+        reuse_port = self.options.get("workers", 1) > 1
+        backlog = self.options.get("listen_backlog", 128)
+
+        # SOCKS5监听端口，0表示不启用
+        socks5_port = self.options.get("socks5_port", 0)
+
+        # asyncio数据面：单线程事件循环处理所有连接
+        if self.options.get("data_plane", "threading") == "asyncio":
+            self.async_server = AsyncProxyServer(self)
+            self.async_server.start("0.0.0.0", local_port, reuse_port=reuse_port, backlog=backlog,
+                                    socks5_port=socks5_port)
+            return True
+
+        def server_thread(port, handler, reject_response, name):
             try:
                 # 创建服务器socket
                 server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                server_sock.bind(("0.0.0.0", local_port))
-                server_sock.listen(128)
+                if reuse_port:
+                    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                sockopts.apply_listener(server_sock)
+                server_sock.bind(("0.0.0.0", port))
+                server_sock.listen(backlog)
 
-                logger.info(f"代理服务器已启动，监听端口: {local_port}")
+                logger.info(f"{name}已启动，监听端口: {port}")
 
                 while True:
                     try:
                         client_sock, addr = server_sock.accept()
+                        sockopts.apply_client(client_sock)
+                        # 超过并发上限时在这里排队，新连接留在内核的监听队列中
+                        if not self.admission.admit(addr[0]):
+                            self._reject(client_sock, addr, "并发连接数超过上限", reject_response)
+                            continue
                         # 为每个连接创建新线程
                         client_thread = threading.Thread(
-                            target=self.handle_connection,
-                            args=(client_sock, addr),
+                            target=self._handle_admitted,
+                            args=(handler, client_sock, addr),
                             daemon=True
                         )
                         client_thread.start()
@@ -1312,13 +1659,24 @@ class ProxyManager:
                         logger.error(f"接受连接失败: {str(e)}")
 
             except Exception as e:
-                logger.error(f"代理服务器启动失败: {str(e)}")
-                print(f"代理服务器启动失败: {str(e)}")
+                logger.error(f"{name}启动失败: {str(e)}")
+                print(f"{name}启动失败: {str(e)}")
 
         # 启动服务器线程
-        server_thread_obj = threading.Thread(target=server_thread, daemon=True)
+        server_thread_obj = threading.Thread(
+            target=server_thread,
+            args=(local_port, self.handle_connection, REJECT_RESPONSE, "代理服务器"),
+            daemon=True
+        )
         server_thread_obj.start()
 
+        if socks5_port:
+            threading.Thread(
+                target=server_thread,
+                args=(socks5_port, self.handle_socks5, REJECT_GREETING, "SOCKS5代理服务器"),
+                daemon=True
+            ).start()
+
         return True
 
     def test_connection(self):
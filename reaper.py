@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+连接超时回收
+所有连接登记到中心注册表，握手超时、空闲超时和最长存活时间由一个分层时间轮统一计时，
+整个进程只有一个线程每秒推进一次时间轮，转发线程不再为检查定时器而定期醒来。
+
+回收连接时只对socket调用shutdown：阻塞在recv/select上的转发线程或协程会立即读到连接关闭，
+由连接自己的线程关闭socket，避免在其他线程仍在使用时关闭文件描述符。
+"""
+
+import time
+import socket
+import logging
+import threading
+import contextvars
+
+from logging_setup import connection_logger as conn_logger
+
+logger = logging.getLogger("reaper")
+
+# 回收原因
+REASON_HANDSHAKE = "handshake"
+REASON_IDLE = "idle"
+REASON_LIFETIME = "lifetime"
+
+# 当前线程/协程正在处理的连接
+_current = contextvars.ContextVar("tracked_connection", default=None)
+
+
+class Timer:
+    """时间轮中的一个定时器"""
+
+    __slots__ = ("expires", "callback", "slot")
+
+    def __init__(self, expires, callback):
+        self.expires = expires  # 到期的tick序号
+        self.callback = callback
+        self.slot = None
+
+
+class TimerWheel:
+    """分层时间轮
+
+    每层slots个槽，第0层每槽一个tick，第n层每槽slots^n个tick。
+    添加和取消定时器都是O(1)；每个tick只取出第0层当前槽中的定时器，
+    上层的槽在下层转完一圈时整体下放一次，超出最高层范围的定时器放在最高层，下放时重新放置。
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=3):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.current = 0  # 已推进的tick数
+        self.count = 0  # 未到期的定时器数
+        self._lock = threading.Lock()
+
+    def schedule(self, delay, callback):
+        """delay秒后调用callback，返回可以取消的Timer"""
+        ticks = max(1, int(-(-delay // self.tick)))  # 向上取整，至少一个tick
+        with self._lock:
+            timer = Timer(self.current + ticks, callback)
+            self._place(timer)
+            self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """取消定时器，已到期或已取消时无效果"""
+        with self._lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+                self.count -= 1
+
+    def _place(self, timer):
+        delta = timer.expires - self.current
+        level = 0
+        span = self.slots
+        while delta >= span and level < self.levels - 1:
+            level += 1
+            span *= self.slots
+        # 超出最高层范围时先放在最高层的最后一个槽，下放时再按真实到期时间放置
+        expires = min(timer.expires, self.current + span - 1)
+        unit = self.slots ** level
+        slot = self.wheels[level][(expires // unit) % self.slots]
+        slot.add(timer)
+        timer.slot = slot
+
+    def advance(self):
+        """推进一个tick，返回到期的定时器"""
+        with self._lock:
+            self.current += 1
+            now = self.current
+            # 下层转完一圈时把上层对应槽中的定时器下放
+            unit = 1
+            for level in range(1, self.levels):
+                unit *= self.slots
+                if now % unit:
+                    break
+                wheel = self.wheels[level]
+                index = (now // unit) % self.slots
+                timers, wheel[index] = wheel[index], set()
+                for timer in timers:
+                    self._place(timer)
+
+            wheel = self.wheels[0]
+            index = now % self.slots
+            due, wheel[index] = wheel[index], set()
+            for timer in due:
+                timer.slot = None
+            self.count -= len(due)
+        return due
+
+
+def abort(target):
+    """中止连接：callable直接调用，socket(或带sock属性的包装对象)调用shutdown"""
+    try:
+        if callable(target):
+            target()
+        else:
+            getattr(target, "sock", target).shutdown(socket.SHUT_RDWR)
+    except (OSError, AttributeError):
+        pass
+
+
+class TrackedConnection:
+    """注册表中的一个连接"""
+
+    __slots__ = ("registry", "created", "last_active", "targets", "timers", "reaped", "closed", "context",
+                 "is_established")
+
+    def __init__(self, registry, targets):
+        self.registry = registry
+        self.created = time.monotonic()
+        self.last_active = self.created
+        self.targets = list(targets)  # 回收时需要中止的socket或回调
+        self.timers = {}
+        self.reaped = None  # 被回收的原因
+        self.closed = False  # 已注销
+        self.context = contextvars.copy_context()  # 定时器回调(日志)在连接自己的上下文中执行
+        self.is_established = False
+
+    def touch(self):
+        """有数据转发时调用，只记录时间，不操作时间轮"""
+        self.last_active = time.monotonic()
+
+    def add(self, target):
+        """追加回收时需要中止的对象（例如上游连接）"""
+        self.targets.append(target)
+        if self.reaped:
+            abort(target)
+
+    def established(self, track_idle=True):
+        """握手完成，开始转发
+
+        track_idle: 是否检查空闲超时；自己有空闲超时的协议(例如HTTP keep-alive、UDP关联)传入False
+        """
+        registry = self.registry
+        self.is_established = True
+        registry._cancel(self, REASON_HANDSHAKE)
+        self.last_active = time.monotonic()
+        self.context = contextvars.copy_context()
+        if track_idle and registry.idle_timeout and REASON_IDLE not in self.timers:
+            registry._schedule(self, REASON_IDLE, registry.idle_timeout)
+
+    def report_every(self, interval, callback):
+        """每隔interval秒在连接的上下文中调用一次callback(例如记录流量统计)"""
+        def report():
+            if self.closed:
+                return
+            self.context.run(callback)
+            self.registry._schedule(self, "report", interval, report)
+        self.registry._schedule(self, "report", interval, report)
+
+    def reap(self, reason):
+        """中止连接"""
+        if self.reaped:
+            return
+        self.reaped = reason
+        for target in list(self.targets):
+            abort(target)
+
+
+class ConnectionRegistry:
+    """连接注册表和回收线程"""
+
+    def __init__(self, handshake_timeout=30, idle_timeout=600, max_lifetime=0, tick=1.0):
+        """
+        参数:
+            handshake_timeout: 从接受连接到开始转发的最长时间(秒)
+            idle_timeout: 双向都没有数据的最长时间(秒)
+            max_lifetime: 连接的最长存活时间(秒)
+            均为0表示不限制
+        """
+        self.handshake_timeout = handshake_timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.wheel = TimerWheel(tick)
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reaped = {REASON_HANDSHAKE: 0, REASON_IDLE: 0, REASON_LIFETIME: 0}
+
+    def start(self):
+        """启动回收线程"""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # 使用单调时钟，系统时间跳变(例如开机后NTP同步)不会误回收连接
+        next_tick = time.monotonic() + self.wheel.tick
+        while True:
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_tick += self.wheel.tick
+            for timer in self.wheel.advance():
+                try:
+                    timer.callback()
+                except Exception as e:
+                    logger.error(f"连接定时器执行失败: {str(e)}")
+
+    def track(self, *targets):
+        """登记连接，返回上下文管理器，退出时注销；处理期间可通过current()取得"""
+        return _Tracking(self, targets)
+
+    def register(self, targets):
+        conn = TrackedConnection(self, targets)
+        with self._lock:
+            self._connections.add(conn)
+        if self.handshake_timeout:
+            self._schedule(conn, REASON_HANDSHAKE, self.handshake_timeout)
+        if self.max_lifetime:
+            self._schedule(conn, REASON_LIFETIME, self.max_lifetime)
+        return conn
+
+    def unregister(self, conn):
+        conn.closed = True
+        with self._lock:
+            self._connections.discard(conn)
+        for timer in list(conn.timers.values()):
+            self.wheel.cancel(timer)
+        conn.timers.clear()
+
+    def _schedule(self, conn, kind, delay, callback=None):
+        if conn.closed:
+            return
+        timer = self.wheel.schedule(delay, callback or (lambda: self._expire(conn, kind)))
+        conn.timers[kind] = timer
+
+    def _cancel(self, conn, kind):
+        timer = conn.timers.pop(kind, None)
+        if timer:
+            self.wheel.cancel(timer)
+
+    def _expire(self, conn, kind):
+        """定时器到期"""
+        conn.timers.pop(kind, None)
+        if conn.reaped or conn.closed:
+            return
+        if kind == REASON_IDLE:
+            # 期间有数据转发时按最后活动时间重新计时
+            idle = time.monotonic() - conn.last_active
+            if idle < self.idle_timeout:
+                self._schedule(conn, REASON_IDLE, self.idle_timeout - idle)
+                return
+        elif kind == REASON_HANDSHAKE and conn.is_established:
+            return
+
+        with self._lock:
+            self.reaped[kind] += 1
+        conn.context.run(_log_reap, conn, kind)
+        conn.reap(kind)
+
+    def get_stats(self):
+        """获取注册表统计信息"""
+        with self._lock:
+            return {
+                "tracked": len(self._connections),
+                "timers": self.wheel.count,
+                "reaped": dict(self.reaped),
+            }
+
+
+_REASON_TEXT = {
+    REASON_HANDSHAKE: "握手超时",
+    REASON_IDLE: "空闲超时",
+    REASON_LIFETIME: "超过最长存活时间",
+}
+
+
+def _log_reap(conn, kind):
+    # 在连接的上下文中记录，按连接日志采样
+    conn_logger.info("回收连接: %s (已存活%d秒)", _REASON_TEXT[kind], time.monotonic() - conn.created)
+
+
+class _Tracking:
+    """track()返回的上下文管理器"""
+
+    __slots__ = ("registry", "targets", "conn", "token")
+
+    def __init__(self, registry, targets):
+        self.registry = registry
+        self.targets = targets
+
+    def __enter__(self):
+        self.conn = self.registry.register(self.targets)
+        self.token = _current.set(self.conn)
+        return self.conn
+
+    def __exit__(self, *exc):
+        _current.reset(self.token)
+        self.registry.unregister(self.conn)
+        return False
+
+
+def current():
+    """当前线程/协程正在处理的连接，未登记时返回None"""
+    return _current.get()
@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据转发核心
+隧道(Tunnel)由两个方向的搬运器(pump)组成，socket全部为非阻塞模式：
+目标端写不下时保留未发送的数据并暂停读取源端(背压)，等目标端可写后再继续。
+SSR隧道的两个方向在搬运时直接编码/解码(EncodePump/DecodePump)。
+
+隧道可以由处理连接的线程自己驱动(run_tunnel)，也可以交给RelayHub：
+一个转发线程用同一个selector驱动所有登记的隧道。
+"""
+
+import os
+import errno
+import time
+import select
+import socket
+import logging
+import threading
+import contextvars
+from collections import deque
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+
+import sockopts
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger("relay")
+
+# os.splice 仅在 Linux + Python 3.10 以上可用
+SPLICE_AVAILABLE = hasattr(os, "splice")
+
+# 缓冲区尺寸分级：交互流量用小缓冲区，持续的大流量逐级升级
+BUFFER_SIZES = (16384, 65536, 262144)
+# 每个尺寸最多缓存的空闲缓冲区数量
+POOL_LIMITS = {16384: 64, 65536: 32, 262144: 8}
+# 连续读满缓冲区多少次后升级尺寸
+UPGRADE_AFTER = 4
+# 连续读到不足1/4缓冲区多少次后降级尺寸
+DOWNGRADE_AFTER = 16
+
+SPLICE_CHUNK = 262144
+
+# fcntl 中设置管道容量的命令 (Linux)
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031) if fcntl else None
+
+
+class RelayBuffer:
+    """池化的缓冲区，memoryview只创建一次"""
+
+    __slots__ = ("size", "data", "view")
+
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+
+
+class BufferPool:
+    """按尺寸分级的缓冲区池，持续转发时不再分配新的缓冲区"""
+
+    def __init__(self, limits=None):
+        self.limits = limits or POOL_LIMITS
+        self._free = {size: [] for size in self.limits}
+
+    def acquire(self, size):
+        """取出一个缓冲区，池中没有时新建"""
+        try:
+            return self._free[size].pop()
+        except IndexError:
+            return RelayBuffer(size)
+
+    def release(self, buffer):
+        """归还缓冲区，超过上限的直接丢弃"""
+        free = self._free[buffer.size]
+        if len(free) < self.limits[buffer.size]:
+            free.append(buffer)
+
+
+# 全局缓冲区池
+BUFFER_POOL = BufferPool()
+
+
+class CopyPump:
+    """通过用户态缓冲区搬运数据: recv_into 后按 memoryview 切片发送"""
+
+    def __init__(self, src, dst, pool=BUFFER_POOL):
+        self.src = src
+        self.dst = dst
+        self.pool = pool
+        self.level = 0
+        self.buffer = pool.acquire(BUFFER_SIZES[0])
+        self.start = 0
+        self.end = 0
+        self.full_reads = 0
+        self.short_reads = 0
+
+    @property
+    def pending(self):
+        """尚未写入目标端的字节数"""
+        return self.end - self.start
+
+    def transfer(self):
+        """源端可读时调用，返回读取的字节数，0表示对端已关闭，-1表示暂无数据"""
+        try:
+            n = self.src.recv_into(self.buffer.view)
+        except BlockingIOError:
+            return -1
+        if n == 0:
+            return 0
+
+        self._adapt(n)
+        self.start = 0
+        self.end = n
+        self.flush()
+        return n
+
+    def flush(self):
+        """目标端可写时调用，返回是否已全部写出"""
+        view = self.buffer.view
+        while self.start < self.end:
+            try:
+                self.start += self.dst.send(view[self.start:self.end])
+            except BlockingIOError:
+                return False
+        self.start = self.end = 0
+        self._resize()
+        return True
+
+    def _adapt(self, n):
+        """根据读取量统计流量特征"""
+        size = self.buffer.size
+        if n == size:
+            self.full_reads += 1
+            self.short_reads = 0
+        elif n < size // 4:
+            self.short_reads += 1
+            self.full_reads = 0
+        else:
+            self.full_reads = self.short_reads = 0
+
+    def _resize(self):
+        """缓冲区为空时按流量特征升级或降级尺寸"""
+        level = self.level
+        if self.full_reads >= UPGRADE_AFTER and level < len(BUFFER_SIZES) - 1:
+            level += 1
+        elif self.short_reads >= DOWNGRADE_AFTER and level > 0:
+            level -= 1
+        else:
+            return
+
+        self.pool.release(self.buffer)
+        self.buffer = self.pool.acquire(BUFFER_SIZES[level])
+        self.level = level
+        self.full_reads = self.short_reads = 0
+
+    def close(self):
+        if self.buffer:
+            self.pool.release(self.buffer)
+            self.buffer = None
+
+
+class SplicePump:
+    """通过 os.splice 在内核中搬运数据: socket -> 管道 -> socket
+
+    数据不经过Python解释器，适合大流量传输。
+    splice不可用时(例如对端不是普通TCP socket)自动退回CopyPump。
+    """
+
+    def __init__(self, src, dst, pool=BUFFER_POOL, chunk=SPLICE_CHUNK):
+        self.src = src
+        self.dst = dst
+        self.pool = pool
+        self.chunk = chunk
+        self.fallback = None
+        self.in_pipe = 0
+        self.pipe_r, self.pipe_w = os.pipe()
+        if F_SETPIPE_SZ is not None:
+            try:
+                fcntl.fcntl(self.pipe_w, F_SETPIPE_SZ, chunk)
+            except OSError:
+                pass
+
+    @property
+    def pending(self):
+        """管道中尚未写入目标端的字节数"""
+        if self.fallback:
+            return self.fallback.pending
+        return self.in_pipe
+
+    def transfer(self):
+        """源端可读时调用，返回读取的字节数，0表示对端已关闭，-1表示暂无数据"""
+        if self.fallback:
+            return self.fallback.transfer()
+
+        try:
+            n = os.splice(self.src.fileno(), self.pipe_w, self.chunk,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return -1
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                logger.info("splice不可用(%s)，退回普通转发", e)
+                self.fallback = CopyPump(self.src, self.dst, self.pool)
+                return self.fallback.transfer()
+            raise
+
+        self.in_pipe = n
+        self.flush()
+        return n
+
+    def flush(self):
+        """目标端可写时调用，返回是否已全部写出"""
+        if self.fallback:
+            return self.fallback.flush()
+
+        dst_fd = self.dst.fileno()
+        while self.in_pipe > 0:
+            try:
+                self.in_pipe -= os.splice(self.pipe_r, dst_fd, self.in_pipe,
+                                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                return False
+        return True
+
+    def close(self):
+        if self.fallback:
+            self.fallback.close()
+        for fd in (self.pipe_r, self.pipe_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class EncodePump:
+    """本地 -> SSR远程: 读取明文，编码(协议、加密、混淆)后写出
+
+    编码结果可能是多个缓冲区(AEAD数据块、TLS记录)，用sendmsg一次写出，写不下的部分保留到目标端可写时。
+    """
+
+    def __init__(self, src, dst, session, pool=BUFFER_POOL):
+        self.src = src
+        self.dst = dst
+        self.session = session
+        self.pool = pool
+        self.buffer = pool.acquire(BUFFER_SIZES[1])
+        self.segments = deque()  # 尚未写出的编码结果
+        self.queued = 0
+
+    @property
+    def pending(self):
+        """尚未写入目标端的字节数"""
+        return self.queued
+
+    def queue(self, segments):
+        """追加需要写给SSR服务器的数据"""
+        for segment in segments:
+            if len(segment):
+                self.segments.append(memoryview(segment))
+                self.queued += len(segment)
+
+    def transfer(self):
+        """源端可读时调用，返回读取的字节数，0表示对端已关闭，-1表示暂无数据"""
+        view = self.buffer.view
+        try:
+            n = self.src.recv_into(view)
+        except BlockingIOError:
+            return -1
+        if n == 0:
+            return 0
+        # 编码结果不引用读取缓冲区，缓冲区可以立即复用
+        self.queue(self.session.encode_segments(view[:n]))
+        self.flush()
+        return n
+
+    def flush(self):
+        """目标端可写时调用，返回是否已全部写出"""
+        self.queued -= sockopts.send_segments(self.dst, self.segments)
+        return not self.segments
+
+    def close(self):
+        if self.buffer:
+            self.pool.release(self.buffer)
+            self.buffer = None
+
+
+class DecodePump:
+    """SSR远程 -> 本地: 读取服务器数据，在缓冲区中原地解码后写出明文
+
+    混淆层在接收时产生的数据(TLS混淆握手)交给反方向的EncodePump写给服务器，保持发送顺序。
+    """
+
+    def __init__(self, src, dst, session, upstream, pool=BUFFER_POOL):
+        self.src = src
+        self.dst = dst
+        self.session = session
+        self.upstream = upstream
+        self.pool = pool
+        self.buffer = pool.acquire(BUFFER_SIZES[1])
+        self.start = 0
+        self.end = 0
+
+    @property
+    def pending(self):
+        """尚未写入目标端的字节数"""
+        return self.end - self.start
+
+    def transfer(self):
+        """源端可读时调用，返回解码出的字节数，0表示对端已关闭，-1表示暂无数据"""
+        session = self.session
+        view = self.buffer.view
+        try:
+            n = self.src.recv_into(view, session.recv_size(len(view)))
+        except BlockingIOError:
+            return -1
+        if n == 0:
+            return 0
+        n = session.decode_into(view, n)
+        if session.obfs:
+            sendback = session.drain_sendback()
+            if sendback:
+                self.upstream.queue([sendback])
+                self.upstream.flush()
+        if not n:
+            # 只收到IV或不完整的数据块
+            return -1
+        self.start = 0
+        self.end = n
+        self.flush()
+        return n
+
+    def flush(self):
+        """目标端可写时调用，返回是否已全部写出"""
+        view = self.buffer.view
+        while self.start < self.end:
+            try:
+                self.start += self.dst.send(view[self.start:self.end])
+            except BlockingIOError:
+                return False
+        self.start = self.end = 0
+        return True
+
+    def close(self):
+        if self.buffer:
+            self.pool.release(self.buffer)
+            self.buffer = None
+
+
+def create_pump(src, dst, mode="auto", pool=BUFFER_POOL):
+    """按转发模式创建pump
+
+    mode: auto(可用时使用splice) / splice / copy
+    """
+    if mode in ("auto", "splice") and SPLICE_AVAILABLE:
+        try:
+            return SplicePump(src, dst, pool)
+        except OSError as e:
+            logger.warning(f"创建splice管道失败: {str(e)}，使用普通转发")
+    elif mode == "splice":
+        logger.warning("当前系统不支持splice，使用普通转发")
+    return CopyPump(src, dst, pool)
+
+
+class Tunnel:
+    """本地socket与远程socket之间的双向隧道"""
+
+    def __init__(self, local, remote, mode="auto", pool=BUFFER_POOL, session=None):
+        """
+        参数:
+            session: SSR连接的SSRSession，remote为到SSR服务器的socket时传入，搬运时编码/解码
+        """
+        local.setblocking(False)
+        remote.setblocking(False)
+        self.local = local
+        self.remote = remote
+        if session is not None:
+            self.upstream = EncodePump(local, remote, session, pool)
+            self.downstream = DecodePump(remote, local, session, self.upstream, pool)
+        else:
+            self.upstream = create_pump(local, remote, mode, pool)    # 本地 -> 远程
+            self.downstream = create_pump(remote, local, mode, pool)  # 远程 -> 本地
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.eof = False
+        self._interest = {}
+
+    def _wanted(self, sock):
+        """计算socket需要关注的事件"""
+        if sock is self.local:
+            outgoing, incoming = self.upstream, self.downstream
+        else:
+            outgoing, incoming = self.downstream, self.upstream
+        events = 0
+        # 对端已关闭时只写出剩余的数据
+        if not outgoing.pending and not self.eof:
+            events |= EVENT_READ
+        if incoming.pending:
+            events |= EVENT_WRITE
+        return events
+
+    def sync(self, sel):
+        """根据缓冲状态更新selector中的关注事件"""
+        for sock in (self.local, self.remote):
+            events = self._wanted(sock)
+            current = self._interest.get(sock, 0)
+            if events == current:
+                continue
+            if not current:
+                sel.register(sock, events, self)
+            elif not events:
+                sel.unregister(sock)
+            else:
+                sel.modify(sock, events, self)
+            self._interest[sock] = events
+
+    def unregister(self, sel):
+        """从selector中移除"""
+        for sock, events in self._interest.items():
+            if events:
+                try:
+                    sel.unregister(sock)
+                except (KeyError, ValueError):
+                    pass
+        self._interest = {}
+
+    def on_event(self, sock, mask):
+        """处理socket事件，返回本次读取的字节数"""
+        if sock is self.local:
+            outgoing, incoming = self.upstream, self.downstream
+        else:
+            outgoing, incoming = self.downstream, self.upstream
+
+        if mask & EVENT_WRITE:
+            incoming.flush()
+
+        moved = 0
+        if mask & EVENT_READ and not outgoing.pending and not self.eof:
+            n = outgoing.transfer()
+            if n == 0:
+                self.eof = True
+            elif n > 0:
+                moved = n
+                if sock is self.local:
+                    self.bytes_sent += n
+                else:
+                    self.bytes_received += n
+        return moved
+
+    @property
+    def flushed(self):
+        """两个方向都没有未写出的数据"""
+        return not self.upstream.pending and not self.downstream.pending
+
+    def drain(self, timeout=5.0):
+        """对端关闭后尽量写出缓冲中剩余的数据"""
+        deadline = time.time() + timeout
+        for pump in (self.upstream, self.downstream):
+            while pump.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                if not pump.flush():
+                    select.select([], [pump.dst], [], remaining)
+
+    def close(self):
+        """关闭两端socket并释放缓冲区"""
+        self.upstream.close()
+        self.downstream.close()
+        for sock in (self.local, self.remote):
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+def run_tunnel(tunnel, on_traffic=None, on_tick=None, tick=1.0):
+    """在当前线程中驱动一条隧道直到结束，返回关闭原因
+
+    on_traffic(n): 每次读取到数据时调用
+    on_tick(): 每隔tick秒调用一次；不提供时select不设超时，没有数据时线程不会醒来
+    """
+    sel = DefaultSelector()
+    last_tick = time.time()
+    timeout = tick if on_tick else None
+    try:
+        tunnel.sync(sel)
+        while True:
+            events = sel.select(timeout=timeout)
+
+            if on_tick:
+                now = time.time()
+                if now - last_tick >= tick:
+                    on_tick()
+                    last_tick = now
+
+            for key, mask in events:
+                try:
+                    n = tunnel.on_event(key.fileobj, mask)
+                except ConnectionResetError as e:
+                    logger.error(f"连接重置: {str(e)}")
+                    return "连接重置"
+                except Exception as e:
+                    logger.error(f"数据转发错误: {str(e)}")
+                    return "数据转发错误"
+                if n and on_traffic:
+                    on_traffic(n)
+                if tunnel.eof:
+                    tunnel.drain()
+                    return "正常关闭"
+
+            tunnel.sync(sel)
+    finally:
+        tunnel.unregister(sel)
+        sel.close()
+
+
+class _HubJob:
+    """交给RelayHub的一条隧道"""
+
+    __slots__ = ("tunnel", "on_traffic", "context", "done", "reason", "deadline")
+
+    def __init__(self, tunnel, on_traffic):
+        self.tunnel = tunnel
+        self.on_traffic = on_traffic
+        self.context = contextvars.copy_context()  # 日志在连接自己的上下文中记录
+        self.done = threading.Event()
+        self.reason = None
+        self.deadline = None  # 对端关闭后写出剩余数据的截止时间
+
+
+class SelectorThread:
+    """在一个后台线程中用同一个selector处理多个socket的事件
+
+    其他线程用submit把工作交给该线程，通过唤醒socket通知；线程在第一次submit时启动。
+    子类实现_accept(item)处理交来的工作，_dispatch(data, sock, mask)处理登记时附带data的socket事件；
+    _timeout()返回select的超时，不为None时每轮select之后调用_on_timer()。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.selector = None
+        self._incoming = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wakeup_r = self._wakeup_w = None
+
+    def start(self):
+        """启动事件线程"""
+        with self._lock:
+            if self._thread:
+                return
+            self.selector = DefaultSelector()
+            self._wakeup_r, self._wakeup_w = socket.socketpair()
+            self._wakeup_r.setblocking(False)
+            self._wakeup_w.setblocking(False)
+            self.selector.register(self._wakeup_r, EVENT_READ, None)
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def submit(self, item):
+        """把工作交给事件线程"""
+        self.start()
+        self._incoming.append(item)
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass  # 唤醒socket已满，事件线程必定会醒来
+
+    def _accept(self, item):
+        raise NotImplementedError
+
+    def _dispatch(self, data, sock, mask):
+        raise NotImplementedError
+
+    def _timeout(self):
+        return None
+
+    def _on_timer(self):
+        pass
+
+    def _drain(self):
+        """清空唤醒socket，处理交来的工作"""
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._incoming:
+            self._accept(self._incoming.popleft())
+
+    def _run(self):
+        selector = self.selector
+        while True:
+            timeout = self._timeout()
+            for key, mask in selector.select(timeout=timeout):
+                if key.data is None:
+                    self._drain()
+                else:
+                    self._dispatch(key.data, key.fileobj, mask)
+            if timeout is not None:
+                self._on_timer()
+
+
+class RelayHub(SelectorThread):
+    """在一个转发线程中用同一个selector驱动多条隧道
+
+    处理连接的线程把隧道交给转发线程后只等待隧道结束，不再自己读写socket；
+    编码/解码在转发线程中随读写进行，每条SSR隧道不再需要两个转发线程。
+    处理连接的线程仍然阻塞到隧道结束(准入名额和回收登记随它释放)，每条隧道仍占用一个等待中的线程。
+    """
+
+    def __init__(self, drain_timeout=5.0):
+        super().__init__("relay-hub")
+        self.drain_timeout = drain_timeout
+        self._jobs = {}  # Tunnel -> _HubJob，只在转发线程中访问
+        self._draining = set()  # 对端已关闭、正在写出剩余数据的_HubJob
+
+    def run(self, tunnel, on_traffic=None):
+        """由转发线程驱动隧道，阻塞到隧道结束，返回关闭原因
+
+        on_traffic(n): 每次读取到数据时在转发线程中调用
+        """
+        job = _HubJob(tunnel, on_traffic)
+        self.submit(job)
+        job.done.wait()
+        return job.reason
+
+    def get_stats(self):
+        """获取转发线程统计信息"""
+        return {"tunnels": len(self._jobs)}
+
+    def _accept(self, job):
+        """登记新交来的隧道"""
+        self._jobs[job.tunnel] = job
+        try:
+            job.tunnel.sync(self.selector)
+        except (OSError, ValueError) as e:
+            # socket已被关闭(例如连接已被回收)
+            self._finish(job, "数据转发错误", e)
+
+    def _finish(self, job, reason, error=None):
+        if error is not None:
+            job.context.run(logger.error, f"{reason}: {str(error)}")
+        job.tunnel.unregister(self.selector)
+        self._jobs.pop(job.tunnel, None)
+        self._draining.discard(job)
+        job.reason = reason
+        job.done.set()
+
+    def _dispatch(self, tunnel, sock, mask):
+        job = self._jobs.get(tunnel)
+        if job is not None:
+            self._handle(job, sock, mask)
+
+    def _handle(self, job, sock, mask):
+        """处理一条隧道的socket事件"""
+        tunnel = job.tunnel
+        try:
+            n = tunnel.on_event(sock, mask)
+        except ConnectionResetError as e:
+            self._finish(job, "连接重置", e)
+            return
+        except Exception as e:
+            self._finish(job, "数据转发错误", e)
+            return
+        if n > 0 and job.on_traffic:
+            job.on_traffic(n)
+        if tunnel.eof:
+            if tunnel.flushed:
+                self._finish(job, "正常关闭")
+                return
+            if job.deadline is None:
+                job.deadline = time.monotonic() + self.drain_timeout
+                self._draining.add(job)
+        try:
+            tunnel.sync(self.selector)
+        except (OSError, ValueError) as e:
+            self._finish(job, "数据转发错误", e)
+
+    def _timeout(self):
+        # 有隧道在写出剩余数据时定期检查截止时间，否则没有事件时线程不会醒来
+        return 1.0 if self._draining else None
+
+    def _on_timer(self):
+        now = time.monotonic()
+        for job in [job for job in self._draining if now >= job.deadline]:
+            self._finish(job, "正常关闭")
+
+
+# 全局转发线程
+RELAY_HUB = RelayHub()
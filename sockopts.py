@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TCP socket选项
+监听socket、客户端连接和上游连接的socket选项统一在这里设置：
+TCP_NODELAY、TCP Fast Open、TCP keepalive / TCP_USER_TIMEOUT 以及收发缓冲区大小。
+启动时用一个临时socket试设置所有选项，报告哪些选项在当前系统上生效。
+另外提供用一次sendmsg发送多个缓冲区的send_segments和sendmsg_all。
+"""
+
+import sys
+import socket
+import logging
+from itertools import islice
+from collections import deque
+
+import dns_cache
+
+logger = logging.getLogger("sockopts")
+
+_LINUX = sys.platform.startswith("linux")
+
+# 部分Python版本的socket模块没有导出这些常量，使用Linux上的取值
+TCP_FASTOPEN = getattr(socket, "TCP_FASTOPEN", 23 if _LINUX else None)
+TCP_FASTOPEN_CONNECT = getattr(socket, "TCP_FASTOPEN_CONNECT", 30 if _LINUX else None)
+TCP_USER_TIMEOUT = getattr(socket, "TCP_USER_TIMEOUT", 18 if _LINUX else None)
+TCP_KEEPIDLE = getattr(socket, "TCP_KEEPIDLE", None)
+TCP_KEEPINTVL = getattr(socket, "TCP_KEEPINTVL", None)
+TCP_KEEPCNT = getattr(socket, "TCP_KEEPCNT", None)
+
+# 监听socket的TFO队列长度
+FASTOPEN_QUEUE = 256
+
+# 单次sendmsg的最大缓冲区数(Linux的IOV_MAX为1024)
+SENDMSG_MAX_BUFFERS = 1024
+
+
+class SocketOptions:
+    """按配置设置socket选项"""
+
+    def __init__(self, options=None):
+        options = options or {}
+        self.nodelay = options.get("tcp_nodelay", True)
+        self.fastopen = options.get("tcp_fastopen", False)
+        self.keepalive = options.get("tcp_keepalive", True)
+        self.keepalive_idle = options.get("tcp_keepalive_idle", 60)
+        self.keepalive_interval = options.get("tcp_keepalive_interval", 10)
+        self.keepalive_count = options.get("tcp_keepalive_count", 3)
+        self.user_timeout = options.get("tcp_user_timeout_ms", 0)
+        self.sndbuf = options.get("socket_sndbuf", 0)
+        self.rcvbuf = options.get("socket_rcvbuf", 0)
+        self.results = {}  # 选项名 -> 是否生效
+
+    def _set(self, sock, level, option, value, name):
+        """设置单个选项，失败时只记录，不影响连接"""
+        if option is None:
+            self.results.setdefault(name, False)
+            return False
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError:
+            self.results.setdefault(name, False)
+            return False
+        self.results.setdefault(name, True)
+        return True
+
+    def _apply_common(self, sock):
+        """客户端和上游连接共用的选项"""
+        if self.nodelay:
+            self._set(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, 1, "TCP_NODELAY")
+        if self.keepalive:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1, "SO_KEEPALIVE")
+            self._set(sock, socket.IPPROTO_TCP, TCP_KEEPIDLE, self.keepalive_idle, "TCP_KEEPIDLE")
+            self._set(sock, socket.IPPROTO_TCP, TCP_KEEPINTVL, self.keepalive_interval, "TCP_KEEPINTVL")
+            self._set(sock, socket.IPPROTO_TCP, TCP_KEEPCNT, self.keepalive_count, "TCP_KEEPCNT")
+        if self.user_timeout:
+            self._set(sock, socket.IPPROTO_TCP, TCP_USER_TIMEOUT, self.user_timeout, "TCP_USER_TIMEOUT")
+
+    def _apply_buffers(self, sock):
+        if self.sndbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf, "SO_SNDBUF")
+        if self.rcvbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf, "SO_RCVBUF")
+
+    def apply_listener(self, sock):
+        """监听socket，在listen之前调用；缓冲区大小会被接受的连接继承"""
+        self._apply_buffers(sock)
+        if self.fastopen:
+            self._set(sock, socket.IPPROTO_TCP, TCP_FASTOPEN, FASTOPEN_QUEUE, "TCP_FASTOPEN(监听)")
+
+    def apply_client(self, sock):
+        """接受的客户端连接"""
+        self._apply_common(sock)
+
+    def apply_upstream(self, sock, fastopen=True):
+        """到节点的连接，在connect之前调用
+
+        fastopen: 启用TFO时connect不会立即握手，握手随第一次发送的数据进行。
+                  节点检查和预连接需要真正完成握手，应传入False。
+        """
+        self._apply_common(sock)
+        self._apply_buffers(sock)
+        if fastopen and self.fastopen:
+            self._set(sock, socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1, "TCP_FASTOPEN_CONNECT")
+
+    def probe(self):
+        """用临时socket试设置所有选项，返回 {选项名: 是否生效}"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.apply_listener(sock)
+            self.apply_upstream(sock)
+        finally:
+            sock.close()
+        return dict(self.results)
+
+
+# 全局socket选项
+SOCKET_OPTIONS = SocketOptions()
+
+
+def configure(options):
+    """按配置重建全局socket选项，并报告生效情况"""
+    global SOCKET_OPTIONS
+    SOCKET_OPTIONS = SocketOptions(options)
+    results = SOCKET_OPTIONS.probe()
+    enabled = [name for name, ok in results.items() if ok]
+    failed = [name for name, ok in results.items() if not ok]
+    logger.info(f"socket选项已生效: {', '.join(enabled) or '无'}")
+    if failed:
+        logger.warning(f"当前系统不支持的socket选项: {', '.join(failed)}")
+    return results
+
+
+def apply_listener(sock):
+    SOCKET_OPTIONS.apply_listener(sock)
+
+
+def apply_client(sock):
+    SOCKET_OPTIONS.apply_client(sock)
+
+
+def apply_upstream(sock, fastopen=True):
+    SOCKET_OPTIONS.apply_upstream(sock, fastopen)
+
+
+def create_connection(address, timeout=None, fastopen=True):
+    """与socket.create_connection相同，连接前设置上游socket选项，主机名的解析结果来自缓存"""
+    host, port = address
+    error = None
+    for family, socktype, proto, _, sockaddr in dns_cache.getaddrinfo(host, port):
+        sock = socket.socket(family, socktype, proto)
+        try:
+            apply_upstream(sock, fastopen)
+            sock.settimeout(timeout)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            error = e
+            sock.close()
+    raise error or OSError(f"无法解析地址: {host}")
+
+
+def send_segments(sock, segments):
+    """写出缓冲区队列(deque，元素为非空的memoryview)，已写出的部分从队列中移除，返回写出的字节数
+
+    多个缓冲区通过sendmsg(scatter/gather)在一次系统调用中发出；非阻塞socket写满时停止，剩余数据留在队列中
+    """
+    total = 0
+    use_sendmsg = hasattr(sock, "sendmsg")
+    while segments:
+        try:
+            if len(segments) == 1 or not use_sendmsg:
+                sent = sock.send(segments[0])
+            else:
+                sent = sock.sendmsg(list(islice(segments, SENDMSG_MAX_BUFFERS)))
+        except BlockingIOError:
+            break
+        total += sent
+        # 部分写入时跳过已发送的缓冲区，从未发完的缓冲区中间继续
+        while sent and sent >= len(segments[0]):
+            sent -= len(segments.popleft())
+        if sent:
+            segments[0] = segments[0][sent:]
+    return total
+
+
+def sendmsg_all(sock, buffers):
+    """在阻塞socket上发送缓冲区列表中的全部数据"""
+    if len(buffers) == 1:
+        sock.sendall(buffers[0])
+        return
+    segments = deque(memoryview(buffer) for buffer in buffers if len(buffer))
+    send_segments(sock, segments)
+    if segments:
+        raise BlockingIOError("socket写缓冲区已满")
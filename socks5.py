@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SOCKS5入站协议(RFC 1928)
+与HTTP CONNECT监听端口并行提供SOCKS5代理，支持CONNECT和UDP ASSOCIATE，
+节点选择、隧道建立和转发与HTTP CONNECT共用。
+协议解析不涉及socket读写，线程模式和asyncio模式共用；
+SOCKS5的地址格式与SSR首包中的目标地址头相同，UDP数据报去掉头部3字节后即可直接加密发往节点。
+"""
+
+import time
+import select
+import socket
+import struct
+import logging
+
+import dns_cache
+from logging_setup import connection_logger as conn_logger
+
+logger = logging.getLogger("socks5")
+
+VERSION = 5
+
+METHOD_NO_AUTH = 0x00
+METHOD_NONE_ACCEPTABLE = 0xFF
+
+CMD_CONNECT = 0x01
+CMD_UDP_ASSOCIATE = 0x03
+
+ATYP_IPV4 = 0x01
+ATYP_DOMAIN = 0x03
+ATYP_IPV6 = 0x04
+
+REP_SUCCEEDED = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_HOST_UNREACHABLE = 0x04
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ADDRESS_NOT_SUPPORTED = 0x08
+
+# 协商之前过载时的应答：没有可接受的认证方式，客户端会直接关闭连接
+REJECT_GREETING = bytes([VERSION, METHOD_NONE_ACCEPTABLE])
+
+# 单个UDP数据报的最大长度
+UDP_RECV_SIZE = 65535
+
+
+class Socks5Error(Exception):
+    """协商失败，reply为关闭连接前发给客户端的应答"""
+
+    def __init__(self, message, reply=b""):
+        super().__init__(message)
+        self.reply = reply
+
+
+def encode_address(host, port):
+    """构造 地址类型 + 地址 + 端口 形式的地址头"""
+    for family, atyp in ((socket.AF_INET, ATYP_IPV4), (socket.AF_INET6, ATYP_IPV6)):
+        try:
+            addr = socket.inet_pton(family, host)
+        except OSError:
+            continue
+        return bytes([atyp]) + addr + struct.pack(">H", port)
+
+    name = host.encode("idna")
+    if len(name) > 255:
+        raise ValueError(f"域名过长: {host[:100]}")
+    return bytes([ATYP_DOMAIN, len(name)]) + name + struct.pack(">H", port)
+
+
+def parse_address(data, offset=0):
+    """解析地址头，返回(host, port, 结束位置)，数据还不完整时返回None"""
+    if len(data) <= offset:
+        return None
+    atyp = data[offset]
+    if atyp == ATYP_IPV4:
+        start, end = offset + 1, offset + 5
+    elif atyp == ATYP_IPV6:
+        start, end = offset + 1, offset + 17
+    elif atyp == ATYP_DOMAIN:
+        if len(data) <= offset + 1:
+            return None
+        start = offset + 2
+        end = start + data[offset + 1]
+    else:
+        raise Socks5Error(f"不支持的地址类型: {atyp}", build_reply(REP_ADDRESS_NOT_SUPPORTED))
+    if len(data) < end + 2:
+        return None
+
+    raw = bytes(data[start:end])
+    if atyp == ATYP_DOMAIN:
+        host = raw.decode("ascii", "replace")
+    else:
+        host = socket.inet_ntop(socket.AF_INET if atyp == ATYP_IPV4 else socket.AF_INET6, raw)
+    port = struct.unpack_from(">H", data, end)[0]
+    return host, port, end + 2
+
+
+def build_reply(rep, host="0.0.0.0", port=0):
+    """构造对请求的应答"""
+    return bytes([VERSION, rep, 0]) + encode_address(host, port)
+
+
+class Socks5Parser:
+    """增量解析客户端的问候和请求
+
+    feed返回(需要发给客户端的数据, 请求)，请求完整之前请求为None，
+    完整后为(命令, host, port)；请求之后客户端已经发送的数据保留在leftover中。
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.greeted = False
+        self.leftover = b""
+
+    def feed(self, data):
+        self.buffer += data
+        reply = b""
+        if not self.greeted:
+            if len(self.buffer) < 2:
+                return reply, None
+            if self.buffer[0] != VERSION:
+                raise Socks5Error(f"不是SOCKS5请求: 版本 {self.buffer[0]}")
+            end = 2 + self.buffer[1]
+            if len(self.buffer) < end:
+                return reply, None
+            if METHOD_NO_AUTH not in self.buffer[2:end]:
+                raise Socks5Error("客户端不支持无认证方式", REJECT_GREETING)
+            self.buffer = self.buffer[end:]
+            self.greeted = True
+            reply = bytes([VERSION, METHOD_NO_AUTH])
+
+        # 请求可能和问候一起到达，出错时问候的应答要先发出
+        try:
+            if len(self.buffer) < 4:
+                return reply, None
+            if self.buffer[0] != VERSION:
+                raise Socks5Error(f"无效的请求版本: {self.buffer[0]}")
+            command = self.buffer[1]
+            address = parse_address(self.buffer, 3)
+            if address is None:
+                return reply, None
+            if command not in (CMD_CONNECT, CMD_UDP_ASSOCIATE):
+                raise Socks5Error(f"不支持的命令: {command}", build_reply(REP_COMMAND_NOT_SUPPORTED))
+        except Socks5Error as e:
+            e.reply = reply + e.reply
+            raise
+
+        host, port, end = address
+        self.leftover = self.buffer[end:]
+        self.buffer = b""
+        return reply, (command, host, port)
+
+
+class UdpRelay:
+    """UDP ASSOCIATE的数据报转换，线程模式和asyncio模式共用
+
+    客户端数据报: RSV(2) FRAG(1) 地址头 数据
+    节点数据报:   IV + 加密(地址头 数据)，每个数据报单独加密
+    """
+
+    def __init__(self, ssr_client, client_ip, on_traffic=None):
+        self.ssr_client = ssr_client
+        self.client_ip = client_ip
+        self.on_traffic = on_traffic
+        self.client_addr = None  # 客户端实际发送数据报的地址，收到第一个数据报后确定
+        self.last_active = time.time()
+
+    def from_client(self, packet, addr):
+        """处理客户端发来的数据报，返回发往节点的数据报，需要丢弃时返回None"""
+        # 只接受建立关联的客户端发来的数据报；不支持分片
+        if addr[0] != self.client_ip or len(packet) < 4 or packet[2] != 0:
+            return None
+        try:
+            if parse_address(packet, 3) is None:
+                return None
+        except Socks5Error:
+            return None
+        self.client_addr = addr
+        self.last_active = time.time()
+        if self.on_traffic:
+            self.on_traffic(len(packet))
+        return self.ssr_client.encode_udp(packet[3:])
+
+    def from_node(self, packet):
+        """处理节点发来的数据报，返回发给客户端的数据报，需要丢弃时返回None"""
+        if self.client_addr is None:
+            return None
+        data = self.ssr_client.decode_udp(packet)
+        try:
+            if not data or parse_address(data) is None:
+                return None
+        except Socks5Error:
+            return None
+        self.last_active = time.time()
+        if self.on_traffic:
+            self.on_traffic(len(data))
+        return b"\x00\x00\x00" + data
+
+
+def resolve_udp(host, port):
+    """解析节点的UDP地址，返回(family, sockaddr)"""
+    family, _, _, _, sockaddr = dns_cache.getaddrinfo(host, port, socket.SOCK_DGRAM)[0]
+    return family, sockaddr
+
+
+class UdpAssociation:
+    """线程模式下的UDP ASSOCIATE
+
+    在客户端和节点之间转发数据报，控制连接关闭或空闲超时后结束。
+    """
+
+    def __init__(self, relay, bind_host, node_address, idle_timeout=60):
+        self.relay = relay
+        self.idle_timeout = idle_timeout
+        family, self.node_addr = node_address
+        self.client_sock = socket.socket(socket.AF_INET6 if ":" in bind_host else socket.AF_INET,
+                                         socket.SOCK_DGRAM)
+        self.node_sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            self.client_sock.bind((bind_host, 0))
+            self.node_sock.connect(self.node_addr)
+        except OSError:
+            self.close()
+            raise
+
+    @property
+    def bound(self):
+        """客户端应当把数据报发往的地址"""
+        return self.client_sock.getsockname()[:2]
+
+    def serve(self, control):
+        """转发数据报，直到控制连接关闭或空闲超时"""
+        relay = self.relay
+        sockets = [control, self.client_sock, self.node_sock]
+        try:
+            while True:
+                remaining = relay.last_active + self.idle_timeout - time.time()
+                if remaining <= 0:
+                    conn_logger.info("UDP关联空闲超时")
+                    return
+                readable, _, _ = select.select(sockets, [], [], remaining)
+                if control in readable:
+                    # 控制连接上不应再有数据，可读意味着客户端关闭了连接
+                    if not control.recv(1024):
+                        return
+                if self.client_sock in readable:
+                    packet, addr = self.client_sock.recvfrom(UDP_RECV_SIZE)
+                    out = relay.from_client(packet, addr)
+                    if out:
+                        self.node_sock.send(out)
+                if self.node_sock in readable:
+                    try:
+                        packet = self.node_sock.recv(UDP_RECV_SIZE)
+                    except ConnectionRefusedError:
+                        # 节点的UDP端口暂时不可达(ICMP)，之后的数据报仍可能成功
+                        continue
+                    out = relay.from_node(packet)
+                    if out:
+                        self.client_sock.sendto(out, relay.client_addr)
+        except OSError as e:
+            logger.debug("UDP转发结束: %s", e)
+        finally:
+            self.close()
+
+    def close(self):
+        self.client_sock.close()
+        self.node_sock.close()
@@ -5,33 +5,70 @@ SSR客户端实现
 支持基本的SSR协议、加密和混淆
 """
 
-import socket
-import struct
+import os
 import hashlib
-import hmac
-import random
-import time
 import logging
-import base64
-
-try:
-    from Crypto.Cipher import AES, ChaCha20
-    from Crypto.Random import get_random_bytes
-    CRYPTO_AVAILABLE = True
-except ImportError:
-    try:
-        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-        from cryptography.hazmat.backends import default_backend
-        import os as crypto_os
-        CRYPTO_AVAILABLE = True
-    except ImportError:
-        CRYPTO_AVAILABLE = False
-        logging.warning("加密库不可用，SSR功能将受限")
+import functools
+import threading
+
+import sockopts
+from socks5 import encode_address
+import cipher_backends
+from aead import AEAD_METHODS
+from legacy_ciphers import new_rc4_md5, TableCipher
+from ssr_protocol import AuthAes128, AuthClientState, AUTH_PROTOCOLS, PROTOCOL_AVAILABLE
+from ssr_obfs import TlsTicketAuth, TlsClientState, OBFS_PROTOCOLS
+
+# pycryptodome和cryptography至少安装了一个
+CRYPTO_AVAILABLE = bool(cipher_backends.BACKENDS)
+if not CRYPTO_AVAILABLE:
+    logging.warning("加密库不可用，SSR功能将受限")
 
 logger = logging.getLogger("ssr_client")
 
+# 派生密钥缓存的最大条目数，节点数通常远小于该值
+KEY_CACHE_SIZE = 128
+
+# 各加密方式的密钥长度
+KEY_LENGTHS = {
+    'aes-128-cfb': 16, 'aes-192-cfb': 24, 'aes-256-cfb': 32,
+    'aes-128-ctr': 16, 'aes-192-ctr': 24, 'aes-256-ctr': 32,
+    'chacha20': 32, 'chacha20-ietf': 32,
+    'rc4-md5': 16
+}
+KEY_LENGTHS.update({method: key_len for method, (key_len, _) in AEAD_METHODS.items()})
+
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def derive_key(password, method):
+    """EVP_BytesToKey(MD5)从密码派生密钥，结果按(密码, 加密方式)缓存"""
+    key_len = KEY_LENGTHS.get(method, 32)
+    d = d_i = b''
+    while len(d) < key_len:
+        d_i = hashlib.md5(d_i + password.encode()).digest()
+        d += d_i
+    return d[:key_len]
+
+
+def _cipher_factory(method, password):
+    """返回创建加密器的函数 factory(key, iv, encrypt)，加密方式不支持时返回None"""
+    # 旧式加密方式不依赖加密库，没有可用的库时使用纯Python实现
+    if method == 'rc4-md5':
+        return lambda key, iv, encrypt: new_rc4_md5(key, iv)
+    if method == 'table':
+        return lambda key, iv, encrypt: TableCipher(password.encode())
+    # 其他加密方式使用cipher_backends为当前CPU选用的实现
+    return cipher_backends.factory(method)
+
+
 class SSRClient:
-    """SSR客户端"""
+    """SSR客户端
+
+    密钥、IV长度和加密器构造函数在构造时确定，之后不再修改；
+    每个连接的状态保存在SSRSession中，同一节点的所有连接可以共用一个客户端。
+    例外是auth_aes128协议的客户端ID和连接ID计数器(AuthClientState加锁维护)
+    以及tls1.2_ticket_auth混淆的会话票据(TlsClientState)。
+    """
 
     def __init__(self, server, port, password, method, protocol="origin", obfs="plain",
                  protocol_param="", obfs_param=""):
@@ -46,44 +83,44 @@ class SSRClient:
 
         # 生成密钥
         self.key = self._derive_key(password, method)
+        self.aead = method in AEAD_METHODS
+        if self.aead:
+            self.iv_len = AEAD_METHODS[method][1]
+        elif method == 'table':
+            self.iv_len = 0
+        else:
+            self.iv_len = 16 if method.startswith(('aes-', 'rc4-md5')) else 12 if method == 'chacha20-ietf' else 8
+        self._new_cipher = _cipher_factory(method, password)
+        self.protocol_state = AuthClientState(self.key, protocol, protocol_param) if protocol in AUTH_PROTOCOLS else None
+        self.obfs_state = TlsClientState() if obfs in OBFS_PROTOCOLS else None
+
+    @property
+    def cipher_supported(self):
+        """支持该加密方式(需要的加密库可用)"""
+        return self._new_cipher is not None
+
+    @property
+    def protocol_supported(self):
+        """支持该协议(需要的加密库可用)"""
+        return self.protocol == "origin" or (self.protocol in AUTH_PROTOCOLS and PROTOCOL_AVAILABLE)
+
+    @property
+    def obfs_supported(self):
+        """支持该混淆方式"""
+        return self.obfs == "plain" or self.obfs in OBFS_PROTOCOLS
 
     def _derive_key(self, password, method):
-        """从密码派生密钥"""
-        key_len = {
-            'aes-128-cfb': 16, 'aes-192-cfb': 24, 'aes-256-cfb': 32,
-            'aes-128-ctr': 16, 'aes-192-ctr': 24, 'aes-256-ctr': 32,
-            'chacha20': 32, 'chacha20-ietf': 32,
-            'rc4-md5': 16
-        }.get(method, 32)
-
-        # 使用MD5派生密钥
-        d = d_i = b''
-        while len(d) < key_len:
-            d_i = hashlib.md5(d_i + password.encode()).digest()
-            d += d_i
-        return d[:key_len]
+        """从密码派生密钥，同一节点的连接共用缓存的结果"""
+        return derive_key(password, method)
 
     def _create_cipher(self, key, iv, encrypt=True):
         """创建加密器"""
-        if not CRYPTO_AVAILABLE:
-            logger.warning("加密库不可用，返回空加密器")
+        if self._new_cipher is None:
+            logger.warning(f"加密方式 {self.method} 不可用，返回空加密器")
             return None
 
         try:
-            if self.method.startswith('aes-'):
-                if 'cfb' in self.method:
-                    cipher = AES.new(key, AES.MODE_CFB, iv)
-                elif 'ctr' in self.method:
-                    cipher = AES.new(key, AES.MODE_CTR, nonce=iv[:8], initial_value=iv[8:])
-                else:
-                    cipher = AES.new(key, AES.MODE_CFB, iv)
-                return cipher
-            elif self.method.startswith('chacha20'):
-                cipher = ChaCha20.new(key=key, nonce=iv[:12] if self.method == 'chacha20-ietf' else iv[:8])
-                return cipher
-            else:
-                # 简单的RC4实现或其他
-                return None
+            return self._new_cipher(key, iv, encrypt)
         except Exception as e:
             logger.error(f"创建加密器失败: {str(e)}")
             return None
@@ -100,164 +137,339 @@ class SSRClient:
             return cipher.decrypt(data)
         return data
 
-    def _apply_protocol(self, data, is_first_packet=False):
-        """应用协议层"""
-        if self.protocol == "origin":
-            return data
-        elif self.protocol == "auth_aes128_md5":
-            # 简化的auth_aes128_md5实现
-            if is_first_packet:
-                # 添加认证头
-                utc_time = int(time.time()) & 0xFFFFFFFF
-                client_id = random.randint(0, 0xFFFFFFFF)
-                connection_id = random.randint(0, 0xFFFFFFFF)
-
-                auth_data = struct.pack('<III', utc_time, client_id, connection_id)
-                auth_data += data
-
-                # 计算HMAC
-                key = self.key + self.protocol_param.encode()
-                hmac_key = hashlib.md5(key).digest()
-                auth_hmac = hmac.new(hmac_key, auth_data, hashlib.md5).digest()[:4]
-
-                return auth_data + auth_hmac
-            return data
-        else:
-            logger.warning(f"不支持的协议: {self.protocol}")
-            return data
+    def _decrypt_into(self, view, size, cipher):
+        """原地解密view开头的size字节，返回明文字节数(放在view开头)"""
+        if self.aead:
+            return cipher.decrypt_into(view, size)
+        cipher.decrypt(view[:size], output=view[:size])
+        return size
 
-    def _apply_obfs(self, data, is_first_packet=False):
-        """应用混淆层"""
-        if self.obfs == "plain":
-            return data
-        elif self.obfs == "tls1.2_ticket_auth":
-            # 简化的TLS混淆实现
-            if is_first_packet:
-                # 构造假的TLS Client Hello
-                tls_header = b'\x16\x03\x01'  # TLS Handshake, version 1.2
-                tls_length = struct.pack('>H', len(data) + 32)  # 长度
-                tls_hello = b'\x01\x00\x00\x1c'  # Client Hello
-                tls_random = get_random_bytes(28)  # 随机数
-
-                return tls_header + tls_length + tls_hello + tls_random + data
-            return data
-        else:
-            logger.warning(f"不支持的混淆: {self.obfs}")
-            return data
+    def _new_protocol(self, iv):
+        """创建连接的协议层状态，origin协议返回None"""
+        if self.protocol_state is None:
+            return None
+        return AuthAes128(self.protocol, self.key, iv, self.protocol_state)
 
-    def connect(self, target_host, target_port):
-        """连接到目标服务器"""
-        try:
-            # 如果加密库不可用，SSR连接无法工作
-            if not CRYPTO_AVAILABLE:
-                logger.error(f"加密库不可用，SSR连接无法建立到: {self.server}:{self.port}")
-                return None, None
+    def _new_obfs(self):
+        """创建连接的混淆层状态，plain混淆返回None"""
+        if self.obfs_state is None:
+            return None
+        return TlsTicketAuth(self.key, self.obfs_param, self.server, self.obfs_state)
 
-            # 连接到SSR服务器
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(15)
-            sock.connect((self.server, self.port))
+    def _build_address(self, target_host, target_port):
+        """构造SOCKS5风格的目标地址头(地址类型 + 地址 + 端口)，支持IPv4/IPv6/域名"""
+        return encode_address(target_host, target_port)
 
-            # 生成IV
-            iv_len = 16 if self.method.startswith('aes-') else 12 if self.method == 'chacha20-ietf' else 8
-            try:
-                iv = get_random_bytes(iv_len)
-            except:
-                iv = bytes([random.randint(0, 255) for _ in range(iv_len)])
+    def _iv_length(self):
+        """加密方式对应的IV长度"""
+        return self.iv_len
+
+    def _random_iv(self):
+        return os.urandom(self._iv_length())
 
-            # 创建加密器
-            encrypt_cipher = self._create_cipher(self.key, iv, encrypt=True)
+    @property
+    def udp_supported(self):
+        """是否支持UDP转发，目前只支持origin协议"""
+        return self.cipher_supported and self.protocol == "origin"
+
+    def encode_udp(self, data):
+        """编码发往服务器的UDP数据报(地址头 + 数据)，每个数据报使用新的IV单独加密"""
+        iv = self._random_iv()
+        cipher = self._create_cipher(self.key, iv, encrypt=True)
+        if not cipher:
+            return None
+        if self.aead:
+            return iv + cipher.seal(data)
+        return iv + self._encrypt(data, cipher)
+
+    def decode_udp(self, packet):
+        """解码来自服务器的UDP数据报，返回地址头 + 数据，无法解码时返回None"""
+        iv_len = self._iv_length()
+        if len(packet) <= iv_len:
+            return None
+        cipher = self._create_cipher(self.key, packet[:iv_len], encrypt=False)
+        if not cipher:
+            return None
+        if self.aead:
+            try:
+                return cipher.open(packet[iv_len:])
+            except ValueError:
+                return None
+        return self._decrypt(packet[iv_len:], cipher)
 
-            # 如果加密器创建失败，使用普通连接
-            if not encrypt_cipher:
-                logger.warning("加密器创建失败，使用普通TCP连接")
-                return sock, None
+    def new_session(self):
+        """创建一个新的连接会话"""
+        return SSRSession(self)
 
-            # 构造SOCKS5连接请求
-            # 地址类型 + 地址 + 端口
-            if target_host.replace('.', '').isdigit():  # IPv4
-                addr_type = b'\x01'
-                addr = socket.inet_aton(target_host)
-            else:  # 域名
-                addr_type = b'\x03'
-                addr = bytes([len(target_host)]) + target_host.encode()
+    def connect(self, target_host, target_port, sock=None, early_data=b""):
+        """连接到目标服务器
 
-            port_bytes = struct.pack('>H', target_port)
-            request_data = addr_type + addr + port_bytes
+        sock: 已连接到SSR服务器的socket（例如来自连接池），为None时新建连接
+        early_data: 客户端已经发送的数据，随首包一起发出
+        """
+        try:
+            # 加密方式不可用时SSR连接无法工作，不能以明文发送
+            if not self.cipher_supported:
+                logger.error(f"加密方式 {self.method} 不可用，SSR连接无法建立到: {self.server}:{self.port}")
+                return None, None
+            if not self.protocol_supported:
+                logger.error(f"协议 {self.protocol} 不受支持，SSR连接无法建立到: {self.server}:{self.port}")
+                return None, None
+            if not self.obfs_supported:
+                logger.error(f"混淆 {self.obfs} 不受支持，SSR连接无法建立到: {self.server}:{self.port}")
+                return None, None
 
-            # 应用协议层
-            request_data = self._apply_protocol(request_data, is_first_packet=True)
+            # 连接到SSR服务器
+            if sock is None:
+                # 启用TFO时握手随首包一起进行
+                sock = sockopts.create_connection((self.server, self.port), 15)
 
-            # 加密
-            encrypted_data = self._encrypt(request_data, encrypt_cipher)
+            session = self.new_session()
+            final_data = session.handshake(target_host, target_port, early_data)
 
-            # 应用混淆层
-            final_data = self._apply_obfs(iv + encrypted_data, is_first_packet=True)
+            # 加密器创建失败时不能以明文发送
+            if final_data is None:
+                logger.error("加密器创建失败，放弃连接")
+                sock.close()
+                return None, None
 
             # 发送到服务器
-            sock.send(final_data)
+            sock.sendall(final_data)
 
-            logger.info(f"SSR连接已建立: {self.server}:{self.port} -> {target_host}:{target_port}")
+            logger.debug("SSR连接已建立: %s:%d -> %s:%d", self.server, self.port, target_host, target_port)
 
-            return sock, encrypt_cipher
+            return sock, session
 
         except Exception as e:
             logger.error(f"SSR连接失败: {str(e)}")
             return None, None
 
-    def create_connection(self, target_host, target_port):
+    def create_connection(self, target_host, target_port, sock=None, early_data=b""):
         """创建SSR连接的简化接口"""
-        sock, cipher = self.connect(target_host, target_port)
+        sock, session = self.connect(target_host, target_port, sock, early_data)
         if sock:
-            return SSRConnection(sock, cipher, self)
+            return SSRConnection(sock, session)
         return None
 
+class SSRSession:
+    """单个SSR连接的编解码状态
+
+    只负责数据的加密、协议和混淆处理，不涉及socket读写，
+    线程模式和asyncio模式共用同一套实现。
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.iv = None
+        self.cipher = None
+        self.decipher = None  # 收到服务器的IV后创建
+        self.protocol = None  # auth_aes128协议状态，origin协议为None
+        self.obfs = None  # tls1.2_ticket_auth混淆状态，plain混淆为None
+        self._server_iv = bytearray()  # 服务器IV可能分多次到达
+
+    def handshake(self, target_host, target_port, early_data=b""):
+        """生成发往服务器的首包，加密器不可用时返回None
+
+        early_data: 客户端已经发送的数据，跟在目标地址之后放入首包，
+        目标服务器的握手可以省去一次往返
+        """
+        client = self.client
+
+        # 生成IV
+        iv = client._random_iv()
+
+        # 创建加密器
+        self.cipher = client._create_cipher(client.key, iv, encrypt=True)
+        if not self.cipher:
+            return None
+        self.iv = iv
+        self.protocol = client._new_protocol(iv)
+
+        request_data = client._build_address(target_host, target_port) + early_data
+
+        # 应用协议层
+        if self.protocol:
+            request_data = self.protocol.pack(request_data, first=True)
+
+        # 加密
+        first_packet = iv + client._encrypt(request_data, self.cipher)
+
+        # 应用混淆层：TLS混淆先只发送ClientHello，首包在服务器应答后发出
+        self.obfs = client._new_obfs()
+        if self.obfs:
+            self.obfs.encode_segments(first_packet)
+            return self.obfs.client_hello()
+        return first_packet
+
+    def encode(self, data):
+        """编码发往服务器的数据"""
+        return b"".join(self.encode_segments(data))
+
+    def encode_segments(self, data):
+        """编码发往服务器的数据，返回依次发送的缓冲区列表
+
+        AEAD加密的各数据块(长度、数据和tag)以及TLS混淆的记录头和数据分别返回，
+        调用方用一次sendmsg发出，不需要拼接。
+        """
+        if self.protocol:
+            data = self.protocol.pack(data)
+        if self.client.aead and self.cipher is not None and self.obfs is None:
+            return self.cipher.encrypt_segments(data)
+        encrypted_data = self.client._encrypt(data, self.cipher)
+        if self.obfs:
+            return self.obfs.encode_segments(encrypted_data)
+        return [encrypted_data]
+
+    def drain_sendback(self):
+        """取出混淆层在接收过程中产生、需要发给服务器的数据(TLS混淆握手的Finished和缓存的数据)"""
+        if self.obfs:
+            return self.obfs.drain_sendback()
+        return b""
+
+    def recv_size(self, length):
+        """长度为length的接收缓冲区一次最多可以读取的字节数
+
+        AEAD、协议层和混淆层已缓存的不完整数据可能和新数据一起解出，为明文留出空间。
+        """
+        if self.client.aead and self.decipher is not None:
+            length -= self.decipher.pending
+        if self.protocol:
+            length -= self.protocol.pending
+        if self.obfs:
+            length -= self.obfs.pending
+        return length
+
+    def _take_iv(self, data):
+        """从服务器数据开头读取IV，IV完整后创建解密器，返回IV占用的字节数"""
+        client = self.client
+        taken = min(client.iv_len - len(self._server_iv), len(data))
+        self._server_iv += data[:taken]
+        if len(self._server_iv) == client.iv_len:
+            self.decipher = client._create_cipher(client.key, bytes(self._server_iv), encrypt=False)
+            if not self.decipher:
+                raise ValueError("创建解密器失败")
+        return taken
+
+    def decode(self, data):
+        """解码来自服务器的数据，只收到IV时返回空数据"""
+        if self.cipher is None:
+            # 首包未加密(加密器不可用)，服务器数据同样原样返回
+            return data
+        if self.obfs:
+            data = self.obfs.decode(data)
+        if self.decipher is None:
+            data = data[self._take_iv(data):]
+            if not data or self.decipher is None:
+                return b""
+        data = self.client._decrypt(data, self.decipher)
+        if self.protocol:
+            # 协议数据包可能跨越多次读取，不完整的部分由协议层缓存
+            data = self.protocol.unpack(data)
+        return data
+
+    def decode_into(self, view, size):
+        """原地解码缓冲区中的size字节，返回解码后的字节数(放在缓冲区开头)"""
+        if self.cipher is None:
+            return size
+        if self.obfs:
+            size = self.obfs.decode_into(view, size)
+            if not size:
+                return 0
+        if self.decipher is None:
+            taken = self._take_iv(view[:size])
+            size -= taken
+            if not size or self.decipher is None:
+                return 0
+            # 每个连接只发生一次：把IV之后的数据移到缓冲区开头
+            view[:size] = view[taken:taken + size]
+        size = self.client._decrypt_into(view, size, self.decipher)
+        if self.protocol:
+            size = self.protocol.unpack_into(view, size)
+        return size
+
 class SSRConnection:
     """SSR连接包装器"""
 
-    def __init__(self, sock, cipher, client):
+    def __init__(self, sock, session):
         self.sock = sock
-        self.cipher = cipher
-        self.client = client
+        self.session = session
+        self.cipher = session.cipher
+        self.client = session.client
         self.closed = False
+        # 发送线程和接收线程(TLS混淆握手的sendback)都会写socket，按顺序写出
+        self._send_lock = threading.Lock()
 
     def fileno(self):
         """返回socket文件描述符，用于select操作"""
         return self.sock.fileno()
 
     def send(self, data):
-        """发送数据"""
+        """发送数据，编码后的数据会全部写出"""
         if self.closed:
             raise ConnectionError("连接已关闭")
 
         try:
-            # 加密数据
-            encrypted_data = self.client._encrypt(data, self.cipher)
-            # 应用混淆
-            final_data = self.client._apply_obfs(encrypted_data)
-            # 发送
-            return self.sock.send(final_data)
+            with self._send_lock:
+                # 加密并混淆
+                final_data = self.session.encode_segments(data)
+                # 发送，避免部分写入时丢失数据
+                sockopts.sendmsg_all(self.sock, final_data)
+            return len(data)
         except Exception as e:
             logger.error(f"发送数据失败: {str(e)}")
             self.close()
             raise
 
+    def sendall(self, data):
+        """发送全部数据"""
+        self.send(data)
+
+    def _send_back(self):
+        """发出混淆层在接收时产生的数据"""
+        with self._send_lock:
+            data = self.session.drain_sendback()
+            if data:
+                self.sock.sendall(data)
+
     def recv(self, size):
         """接收数据"""
         if self.closed:
             raise ConnectionError("连接已关闭")
 
         try:
-            # 接收数据
-            data = self.sock.recv(size)
-            if not data:
-                self.close()
-                return b''
-
-            # 简化处理：对于SSR连接，我们需要解密数据
-            # 但为了保持兼容性，这里先直接返回
-            # 实际使用中，SSR服务器会处理加密/解密
-            return data
+            # 开头只收到服务器IV时没有可返回的数据，继续接收
+            while True:
+                data = self.sock.recv(size)
+                if not data:
+                    self.close()
+                    return b''
+                data = self.session.decode(data)
+                if self.session.obfs:
+                    self._send_back()
+                if data:
+                    return data
+        except Exception as e:
+            logger.error(f"接收数据失败: {str(e)}")
+            self.close()
+            raise
+
+    def recv_into(self, buffer):
+        """接收数据到缓冲区，返回解码后的字节数"""
+        if self.closed:
+            raise ConnectionError("连接已关闭")
+
+        view = memoryview(buffer)
+        try:
+            while True:
+                n = self.sock.recv_into(view, self.session.recv_size(len(view)))
+                if not n:
+                    self.close()
+                    return 0
+                n = self.session.decode_into(view, n)
+                if self.session.obfs:
+                    self._send_back()
+                if n:
+                    return n
         except Exception as e:
             logger.error(f"接收数据失败: {str(e)}")
             self.close()
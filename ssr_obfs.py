@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSR混淆层: tls1.2_ticket_auth
+连接开始时客户端只发送伪装的TLS ClientHello(SNI取混淆参数)，
+收到服务器的ServerHello、ChangeCipherSpec和Finished并校验后，
+再发送ChangeCipherSpec和Finished，之前缓存的数据随之以TLS应用数据记录发出。
+之后两个方向的数据都封装为应用数据记录(类型0x17)。
+
+发送的数据按最大记录长度封装，记录头和数据作为独立的缓冲区返回，由调用方用一次sendmsg发出；
+接收的记录头在缓冲区中原地去掉，记录可以跨越任意次读取。
+
+握手完成时需要发给服务器的数据(sendback)由接收方向产生，
+连接的发送方通过drain_sendback取出，或者在下一次发送时自动排在数据之前。
+"""
+
+import os
+import hmac
+import time
+import random
+import struct
+import threading
+
+OBFS_PROTOCOLS = ("tls1.2_ticket_auth",)
+
+TLS_VERSION = b"\x03\x03"
+# 应用数据记录的最大长度(TLS明文记录的上限)
+MAX_RECORD = 16384
+RECORD_HEADER = 5
+# 服务器握手应答的长度上限，超过时视为数据错误
+MAX_HANDSHAKE = 16384
+
+# ClientHello中固定的密码套件和扩展
+_CIPHER_SUITES = bytes.fromhex("001cc02bc02fcca9cca8cc14cc13c00ac014c009c013009c0035002f000a0100")
+_EXT_RENEGOTIATION = bytes.fromhex("ff01000100")
+_EXT_EXTENDED_MASTER_SECRET = bytes.fromhex("00170000")
+_EXT_TAIL = bytes.fromhex("000d001600140601060305010503040104030301030302010203"
+                          "000500050100000000"
+                          "00120000"
+                          "75500000"
+                          "000b00020100"
+                          "000a0006000400170018")
+
+
+class TlsClientState:
+    """同一节点所有连接共用的客户端ID和各域名的会话票据"""
+
+    def __init__(self):
+        self.client_id = os.urandom(32)
+        self.tickets = {}  # SNI -> 伪造的会话票据
+
+    def ticket(self, host):
+        ticket = self.tickets.get(host)
+        if ticket is None:
+            ticket = self.tickets.setdefault(host, os.urandom((random.getrandbits(16) % 17 + 8) * 16))
+        return ticket
+
+
+def _sni_hosts(obfs_param, server):
+    """混淆参数中以逗号分隔的域名，未设置时使用服务器域名；IP地址不发送SNI"""
+    host = obfs_param or server or ""
+    if host and host[-1].isdigit():
+        host = ""
+    return host.split(",")
+
+
+def _sni(host):
+    name = host.encode()
+    entry = b"\x00" + struct.pack(">H", len(name)) + name
+    return b"\x00\x00" + struct.pack(">HH", len(entry) + 2, len(entry)) + entry
+
+
+class TlsTicketAuth:
+    """一个连接的tls1.2_ticket_auth混淆状态"""
+
+    def __init__(self, key, obfs_param, server, shared):
+        """
+        参数:
+            key: 加密密钥，与客户端ID一起作为握手HMAC的密钥
+            obfs_param: 混淆参数(SNI域名，可用逗号分隔多个)
+            server: 服务器地址，混淆参数为空时作为SNI
+            shared: 节点的TlsClientState
+        """
+        self.shared = shared
+        self.mac_key = key + shared.client_id
+        self.host = random.choice(_sni_hosts(obfs_param, server))
+        self.established = False
+        self._send_buffer = bytearray()  # 握手完成前缓存的数据
+        self._sendback = b""  # 握手完成后需要发给服务器的数据
+        self._handshake = bytearray()  # 还不完整的服务器握手应答
+        self._header = bytearray()  # 还不完整的记录头
+        self._remaining = 0  # 当前记录还没有收到的数据字节数
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        """已收到但还没有解出的字节数"""
+        return len(self._handshake) + len(self._header)
+
+    def _mac(self, data):
+        return hmac.digest(self.mac_key, data, "sha1")[:10]
+
+    def client_hello(self):
+        """连接开始时发送的ClientHello"""
+        shared = self.shared
+        auth = struct.pack(">I", int(time.time()) & 0xFFFFFFFF) + os.urandom(18)
+        auth += self._mac(auth)
+        body = TLS_VERSION + auth + b"\x20" + shared.client_id + _CIPHER_SUITES
+
+        ext = _EXT_RENEGOTIATION
+        if self.host:
+            ext += _sni(self.host)
+        ext += _EXT_EXTENDED_MASTER_SECRET
+        ticket = shared.ticket(self.host)
+        ext += b"\x00\x23" + struct.pack(">H", len(ticket)) + ticket
+        ext += _EXT_TAIL
+        body += struct.pack(">H", len(ext)) + ext
+
+        body = b"\x01\x00" + struct.pack(">H", len(body)) + body
+        return b"\x16\x03\x01" + struct.pack(">H", len(body)) + body
+
+    @staticmethod
+    def _records(data):
+        """把数据封装为尽量少的应用数据记录，返回记录头和数据交替的缓冲区列表"""
+        segments = []
+        view = memoryview(data)
+        for start in range(0, len(view), MAX_RECORD):
+            payload = view[start:start + MAX_RECORD]
+            segments.append(b"\x17" + TLS_VERSION + struct.pack(">H", len(payload)))
+            segments.append(payload)
+        return segments
+
+    def encode_segments(self, data):
+        """封装发往服务器的数据，握手完成前缓存并返回空列表"""
+        with self._lock:
+            if not self.established:
+                self._send_buffer += data
+                return []
+            if self._sendback:
+                segments = [self._sendback]
+                self._sendback = b""
+            else:
+                segments = []
+        return segments + self._records(data)
+
+    def drain_sendback(self):
+        """取出握手完成后需要发给服务器的数据，没有时返回空数据"""
+        with self._lock:
+            data, self._sendback = self._sendback, b""
+        return data
+
+    def _finish_handshake(self):
+        """检查服务器握手应答，完成时返回之后多收到的数据，握手应答不完整时返回None"""
+        buffer = self._handshake
+        pos = 0
+        change_cipher_spec = False
+        while True:
+            if len(buffer) - pos < RECORD_HEADER:
+                break
+            content_type = buffer[pos]
+            end = pos + RECORD_HEADER + struct.unpack_from(">H", buffer, pos + 3)[0]
+            if content_type not in (0x14, 0x16):
+                raise ValueError(f"TLS混淆握手应答的记录类型错误: {content_type}")
+            if len(buffer) < end:
+                break
+            if content_type == 0x14:
+                change_cipher_spec = True
+            elif change_cipher_spec:
+                # ChangeCipherSpec之后的Finished是握手应答的最后一条记录
+                return self._verify_handshake(end)
+            pos = end
+        if len(buffer) > MAX_HANDSHAKE:
+            raise ValueError("TLS混淆握手应答过长")
+        return None
+
+    def _verify_handshake(self, end):
+        hello = bytes(self._handshake[:end])
+        leftover = bytes(self._handshake[end:])
+        self._handshake = bytearray()
+        if len(hello) < 11 + 32 + 1 + 32 or self._mac(hello[11:33]) != hello[33:43]:
+            raise ValueError("TLS混淆ServerHello校验失败")
+        if self._mac(hello[:-10]) != hello[-10:]:
+            raise ValueError("TLS混淆Finished校验失败")
+
+        finished = b"\x14" + TLS_VERSION + b"\x00\x01\x01"
+        finished += b"\x16" + TLS_VERSION + b"\x00\x20" + os.urandom(22)
+        finished += self._mac(finished)
+        with self._lock:
+            self._sendback = b"".join([finished] + self._records(self._send_buffer))
+            self._send_buffer = bytearray()
+            self.established = True
+        return leftover
+
+    def _strip(self, view, size):
+        """原地去掉view开头size字节中的记录头，数据移到view开头，返回数据字节数"""
+        pos = 0
+        out = 0
+        header = self._header
+        while pos < size:
+            if self._remaining:
+                n = min(self._remaining, size - pos)
+                if out != pos:
+                    view[out:out + n] = view[pos:pos + n]
+                out += n
+                pos += n
+                self._remaining -= n
+                continue
+            n = min(RECORD_HEADER - len(header), size - pos)
+            header += view[pos:pos + n]
+            pos += n
+            if len(header) == RECORD_HEADER:
+                if header[0] != 0x17:
+                    raise ValueError(f"TLS混淆应用数据记录类型错误: {header[0]}")
+                self._remaining = struct.unpack_from(">H", header, 3)[0]
+                header.clear()
+        return out
+
+    def decode_into(self, view, size):
+        """原地解出view开头size字节中的数据，返回数据字节数
+
+        握手应答中缓存的数据可能和新数据一起解出，调用方读取时需保证 pending + size <= len(view)。
+        """
+        if not self.established:
+            self._handshake += view[:size]
+            leftover = self._finish_handshake()
+            if not leftover:
+                return 0
+            size = len(leftover)
+            view[:size] = leftover
+        return self._strip(view, size)
+
+    def decode(self, data):
+        """解出服务器返回的数据"""
+        buffer = bytearray(data)
+        buffer.extend(bytes(self.pending))
+        with memoryview(buffer) as view:
+            size = self.decode_into(view, len(data))
+        del buffer[size:]
+        return bytes(buffer)
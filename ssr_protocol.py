@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SSR协议层: auth_aes128_md5 / auth_aes128_sha1
+协议层处理加密之前的明文：首包带认证头(客户端ID、连接ID、时间戳，AES加密)，
+之后的数据按包发送，每包为 长度(2) + 长度MAC(2) + 随机填充 + 数据 + 包MAC(4)，
+MAC的密钥包含包序号；服务器返回的数据使用相同的格式，按接收序号校验。
+
+协议状态按连接保存在AuthAes128中，同一节点的用户密钥、认证头加密器和客户端ID、连接ID计数器由AuthClientState共用。
+"""
+
+import os
+import hmac
+import time
+import base64
+import random
+import struct
+import hashlib
+import threading
+
+import cipher_backends
+
+# 认证头需要AES加密
+PROTOCOL_AVAILABLE = bool(cipher_backends.BACKENDS)
+
+# 协议名 -> 哈希算法
+AUTH_PROTOCOLS = {
+    "auth_aes128_md5": "md5",
+    "auth_aes128_sha1": "sha1",
+}
+
+# 每包数据的最大长度
+UNIT_LEN = 8100
+# 包长度的上限(不含)，服务器返回的包超过时视为数据错误
+MAX_PACKET = 8192
+# 计算随机填充长度时假定的TCP MSS
+TCP_MSS = 1460
+# 一次写入的数据超过此长度时不再填充
+NO_PADDING_ABOVE = 32 * 1024
+# 连接ID超过此值时更换客户端ID
+MAX_CONNECTION_ID = 0xFF000000
+
+
+class AuthClientState:
+    """同一节点所有连接共用的用户密钥、认证头加密器和客户端ID、连接ID"""
+
+    def __init__(self, key, protocol, protocol_param):
+        self.user_key, self.uid, self._header_key = user_key(key, protocol, protocol_param)
+        self._encrypt_header = None
+        self.client_id = b""
+        self.connection_id = 0
+        self._lock = threading.Lock()
+
+    def encrypt_header(self, block):
+        """AES加密认证块，加密器在第一次使用时创建，之后所有连接共用"""
+        if self._encrypt_header is None:
+            self._encrypt_header = cipher_backends.ecb_encryptor(self._header_key)
+        return self._encrypt_header(block)
+
+    def next(self):
+        """为新连接分配(客户端ID, 连接ID)"""
+        with self._lock:
+            if not self.client_id or self.connection_id > MAX_CONNECTION_ID:
+                self.client_id = os.urandom(4)
+                self.connection_id = struct.unpack("<I", os.urandom(4))[0] & 0xFFFFFF
+            self.connection_id += 1
+            return self.client_id, self.connection_id
+
+
+def user_key(key, protocol, protocol_param):
+    """返回(用户密钥, 用户ID, 认证头的AES密钥)，每个节点计算一次(AuthClientState)
+
+    协议参数为 "用户ID:密码" 时使用多用户认证，否则用户密钥即加密密钥，用户ID在每个连接随机生成。
+    """
+    hash_name = AUTH_PROTOCOLS[protocol]
+    key_for_user = key
+    uid = None
+    if ":" in protocol_param:
+        uid_text, _, password = protocol_param.partition(":")
+        try:
+            uid = struct.pack("<I", int(uid_text))
+            key_for_user = hashlib.new(hash_name, password.encode()).digest()
+        except (ValueError, struct.error):
+            uid = None
+    salt = protocol.encode()
+    header_key = hashlib.md5(base64.b64encode(key_for_user) + salt).digest()
+    return key_for_user, uid, header_key
+
+
+def _head_size(data, default=30):
+    """首包开头目标地址头的长度"""
+    if len(data) < 2:
+        return default
+    atyp = data[0] & 0x07
+    if atyp == 1:
+        return 7
+    if atyp == 4:
+        return 19
+    if atyp == 3:
+        return 4 + data[1]
+    return default
+
+
+def _padding_length(size, full_size):
+    """随机填充长度：小包填充到接近一个MSS，大块数据不填充"""
+    if full_size >= NO_PADDING_ABOVE:
+        return 0
+    remaining = TCP_MSS - size - 9
+    if remaining == 0:
+        return 0
+    if remaining < 0:
+        if remaining > -TCP_MSS:
+            return _trapezoid(remaining + TCP_MSS)
+        return random.getrandbits(5)
+    if size > 900:
+        return random.randrange(remaining)
+    return _trapezoid(remaining)
+
+
+def _trapezoid(max_value, d=-0.3):
+    """[0, max_value)内偏向小值的随机数"""
+    s = random.random()
+    a = 1 - d
+    return int((((a * a + 4 * d * s) ** 0.5) - a) / (2 * d) * max_value)
+
+
+def _padding(length):
+    """随机填充，第一个字节(或之后的两个字节)记录填充的总长度"""
+    if length < 128:
+        return bytes([length + 1]) + os.urandom(length)
+    return b"\xff" + struct.pack("<H", length + 1) + os.urandom(length - 2)
+
+
+class AuthAes128:
+    """一个连接的auth_aes128协议状态"""
+
+    def __init__(self, protocol, key, iv, shared):
+        """
+        参数:
+            protocol: auth_aes128_md5 或 auth_aes128_sha1
+            key: 加密密钥
+            iv: 本连接发送方向的IV
+            shared: 节点的AuthClientState
+        """
+        self.protocol = protocol
+        self.hash_name = AUTH_PROTOCOLS[protocol]
+        self.key = key
+        self.iv = iv
+        self.user_key, self.uid = shared.user_key, shared.uid
+        self.shared = shared
+        self.pack_id = 1
+        self.recv_id = 1
+        self._buffer = bytearray()  # 服务器返回的、还不完整的包
+
+    @property
+    def pending(self):
+        """已收到但还没有解出的字节数"""
+        return len(self._buffer)
+
+    def _mac(self, key, data, size):
+        return hmac.digest(key, data, self.hash_name)[:size]
+
+    def _pack_auth(self, data):
+        """首包：认证头 + 随机填充 + 数据"""
+        if len(data) > 400:
+            padding = random.getrandbits(16) % 512
+        else:
+            padding = random.getrandbits(16) % 1024
+        client_id, connection_id = self.shared.next()
+        length = 7 + 4 + 16 + 4 + len(data) + padding + 4
+        block = (struct.pack("<I", int(time.time()) & 0xFFFFFFFF) + client_id +
+                 struct.pack("<IHH", connection_id, length, padding))
+        # 认证块只有16字节，零IV的AES-128-CBC等同于ECB
+        encrypted = self.shared.encrypt_header(block)
+        mac_key = self.iv + self.key
+        head = (self.uid or os.urandom(4)) + encrypted
+        head += self._mac(mac_key, head, 4)
+        check = os.urandom(1)
+        check += self._mac(mac_key, check, 6)
+        packet = check + head + os.urandom(padding) + data
+        return packet + self._mac(self.user_key, packet, 4)
+
+    def _pack(self, data, full_size):
+        """数据包：长度 + 长度MAC + 随机填充 + 数据 + 包MAC"""
+        body = _padding(_padding_length(len(data), full_size)) + data
+        length = struct.pack("<H", len(body) + 8)
+        mac_key = self.user_key + struct.pack("<I", self.pack_id)
+        packet = length + self._mac(mac_key, length, 2) + body
+        self.pack_id = (self.pack_id + 1) & 0xFFFFFFFF
+        return packet + self._mac(mac_key, packet, 4)
+
+    def pack(self, data, first=False):
+        """把发往服务器的数据打包，first为首包(包含目标地址)"""
+        full_size = len(data)
+        view = memoryview(data)
+        packets = []
+        if first:
+            size = min(len(view), random.randint(0, 31) + _head_size(view))
+            packets.append(self._pack_auth(bytes(view[:size])))
+            view = view[size:]
+        while len(view) > UNIT_LEN:
+            packets.append(self._pack(bytes(view[:UNIT_LEN]), full_size))
+            view = view[UNIT_LEN:]
+        if view or not first:
+            packets.append(self._pack(bytes(view), full_size))
+        return b"".join(packets)
+
+    def _unpack(self, write):
+        """解出缓冲区中所有完整的包，数据交给write，返回数据总字节数"""
+        buffer = self._buffer
+        view = memoryview(buffer)
+        pos = 0
+        total = 0
+        try:
+            while len(buffer) - pos > 4:
+                mac_key = self.user_key + struct.pack("<I", self.recv_id)
+                if self._mac(mac_key, view[pos:pos + 2], 2) != view[pos + 2:pos + 4]:
+                    raise ValueError("协议数据包长度校验失败")
+                length = struct.unpack_from("<H", buffer, pos)[0]
+                if length >= MAX_PACKET or length < 7:
+                    raise ValueError(f"协议数据包长度错误: {length}")
+                if len(buffer) - pos < length:
+                    break
+                end = pos + length
+                if self._mac(mac_key, view[pos:end - 4], 4) != view[end - 4:end]:
+                    raise ValueError("协议数据包校验失败")
+                self.recv_id = (self.recv_id + 1) & 0xFFFFFFFF
+                padding = buffer[pos + 4]
+                if padding == 255:
+                    padding = struct.unpack_from("<H", buffer, pos + 5)[0]
+                start = pos + 4 + padding
+                if start < end - 4:
+                    write(view[start:end - 4], total)
+                    total += end - 4 - start
+                pos = end
+        finally:
+            view.release()
+            del buffer[:pos]
+        return total
+
+    def unpack(self, data):
+        """解出服务器返回的数据，包不完整时返回已完整部分"""
+        self._buffer += data
+        out = []
+        self._unpack(lambda payload, _: out.append(bytes(payload)))
+        return b"".join(out)
+
+    def unpack_into(self, view, size):
+        """解出view开头size字节中的数据，写回view开头，返回数据字节数
+
+        数据不会超过 pending + size，调用方读取时需保证 pending + size <= len(view)。
+        """
+        self._buffer += view[:size]
+
+        def write(payload, offset):
+            view[offset:offset + len(payload)] = payload
+        return self._unpack(write)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流量统计
+每个线程写自己的计数分片，读取时再汇总，转发热路径上不需要任何共享锁
+"""
+
+import threading
+
+# 分片数超过该数量时把已退出线程的分片合并到基础计数中；
+# 合并后阈值提高到存活分片数的两倍，注册新分片的均摊开销为O(1)
+MAX_DEAD_SHARDS = 256
+
+
+class TrafficStats:
+    """按线程分片的连接/流量计数器"""
+
+    FIELDS = ("total_connections", "active_connections", "total_traffic")
+
+    def __init__(self):
+        self._local = threading.local()
+        self._registry_lock = threading.Lock()  # 只在注册新分片和汇总时使用
+        self._shards = []  # [(线程, 分片)]
+        self._base = [0, 0, 0]  # 已退出线程的计数
+        self._fold_at = MAX_DEAD_SHARDS  # 分片数超过该值时合并
+
+    def _new_shard(self):
+        """为当前线程注册新分片"""
+        shard = [0, 0, 0]
+        self._local.shard = shard
+        with self._registry_lock:
+            self._shards.append((threading.current_thread(), shard))
+            if len(self._shards) > self._fold_at:
+                self._fold_dead_shards()
+        return shard
+
+    def _fold_dead_shards(self):
+        """把已退出线程的分片合并到基础计数（调用方持有注册锁）"""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                for i in range(3):
+                    self._base[i] += shard[i]
+        self._shards = alive
+        self._fold_at = max(MAX_DEAD_SHARDS, 2 * len(alive))
+
+    def add(self, connection_change=0, traffic=0):
+        """更新当前线程的计数"""
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+        if connection_change > 0:
+            shard[0] += connection_change
+        shard[1] += connection_change
+        shard[2] += traffic
+
+    def snapshot(self):
+        """汇总所有分片，返回统计字典"""
+        with self._registry_lock:
+            self._fold_dead_shards()
+            totals = list(self._base)
+            for _, shard in self._shards:
+                for i in range(3):
+                    totals[i] += shard[i]
+        return dict(zip(self.FIELDS, totals))
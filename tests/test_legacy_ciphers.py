@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+旧式加密方式的测试：各RC4实现的RFC 6229已知答案，rc4-md5的密钥派生和table加密。
+
+运行: python3 -m pytest tests  或  python3 -m unittest discover tests
+"""
+
+import os
+import hashlib
+import unittest
+from unittest import mock
+
+import legacy_ciphers
+from legacy_ciphers import RC4_BACKENDS, TableCipher, new_rc4, new_rc4_md5, rc4_usable
+
+# RFC 6229 RC4已知答案: (密钥, {偏移: 16字节密钥流})
+# cryptography只接受40~256位的标准密钥长度，因此只使用40位和128位密钥的向量
+RC4_VECTORS = (
+    (bytes.fromhex("0102030405"), {
+        0: bytes.fromhex("b2396305f03dc027ccc3524a0a1118a8"),
+        16: bytes.fromhex("6982944f18fc82d589c403a47a0d0919"),
+        240: bytes.fromhex("28cb1132c96ce286421dcaadb8b69eae"),
+        256: bytes.fromhex("1cfcf62b03eddb641d77dfcf7f8d8c93"),
+    }),
+    (bytes.fromhex("0102030405060708090a0b0c0d0e0f10"), {
+        0: bytes.fromhex("9ac7cc9a609d1ef7b2932899cde41b97"),
+        16: bytes.fromhex("5248c4959014126a6e8a84f11d1a9e1c"),
+        240: bytes.fromhex("065902e4b620f6cc36c8589f66432f2b"),
+        256: bytes.fromhex("d39d566bc6bce3010768151549f3873f"),
+    }),
+)
+
+
+class Rc4KnownAnswerTest(unittest.TestCase):
+
+    def test_vectors(self):
+        for name, new in RC4_BACKENDS:
+            # 未安装的实现不检查，纯Python实现总是可用
+            if not rc4_usable(new):
+                continue
+            with self.subTest(backend=name):
+                for key, expected in RC4_VECTORS:
+                    update = new(key)
+                    # 分多次加密，检查实现能正确保持状态
+                    stream = b"".join(update(bytes(size)) for size in (7, 9, 16, 240))
+                    for offset, block in expected.items():
+                        self.assertEqual(stream[offset:offset + 16], block, f"{name} 偏移{offset}")
+
+    def test_backends_agree(self):
+        key = hashlib.md5(b"password" + bytes(16)).digest()
+        data = os.urandom(5000)
+        expected = None
+        for name, new in RC4_BACKENDS:
+            if not rc4_usable(new):
+                continue
+            cipher = new_rc4(key, name)
+            result = cipher.encrypt(data[:1000]) + cipher.encrypt(data[1000:])
+            if expected is None:
+                expected = result
+            self.assertEqual(result, expected, name)
+
+    def test_rc4_md5(self):
+        key, iv = b"k" * 16, b"i" * 16
+        data = b"hello rc4-md5"
+        ciphertext = new_rc4_md5(key, iv).encrypt(data)
+        self.assertEqual(ciphertext, new_rc4(hashlib.md5(key + iv).digest()).encrypt(data))
+        output = bytearray(len(data))
+        new_rc4_md5(key, iv).decrypt(ciphertext, output)
+        self.assertEqual(bytes(output), data)
+
+    def test_fastest_backend_selected(self):
+        name, _ = legacy_ciphers.rc4_backend()
+        usable = [backend for backend, new in RC4_BACKENDS if rc4_usable(new)]
+        self.assertEqual(name, usable[0])
+
+    def test_python_fallback_warns(self):
+        legacy_ciphers.rc4_backend.cache_clear()
+        try:
+            with mock.patch.object(legacy_ciphers, "RC4_BACKENDS", RC4_BACKENDS[-1:]):
+                with self.assertLogs("legacy_ciphers", "WARNING"):
+                    self.assertEqual(legacy_ciphers.rc4_backend()[0], "python")
+        finally:
+            legacy_ciphers.rc4_backend.cache_clear()
+
+
+class TableCipherTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        cipher = TableCipher(b"password")
+        self.assertEqual(sorted(cipher.encrypt_table), list(range(256)))
+        data = bytes(range(256)) * 4
+        ciphertext = cipher.encrypt(data)
+        self.assertNotEqual(ciphertext, data)
+        self.assertEqual(cipher.decrypt(ciphertext), data)
+
+    def test_self_test(self):
+        self.assertTrue(legacy_ciphers.self_test()["table"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多路复用流的测试：通过mux_server.py在本机打开流，检查目标连接成功/失败的应答和流量控制窗口。
+
+运行: python3 -m pytest tests  或  python3 -m unittest discover tests
+"""
+
+import socket
+import threading
+import unittest
+from unittest import mock
+
+import mux
+from mux import MuxPool, INITIAL_WINDOW
+from mux_server import MuxServer
+from ssr_client import SSRClient
+
+METHOD = "aes-256-gcm"
+PASSWORD = "test-password"
+
+
+def _serve(listener, handler):
+    def accept():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=handler, args=(conn,), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+
+
+def _target(conn):
+    """目标服务器：E开头时回显，B开头时发送4MB后关闭"""
+    with conn:
+        command = conn.recv(1)
+        if command == b"E":
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                conn.sendall(data)
+        elif command == b"B":
+            try:
+                conn.sendall(b"x" * (4 * 1024 * 1024))
+            except OSError:
+                pass
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(65536, size - len(data)))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+class MuxStreamTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.target = socket.create_server(("127.0.0.1", 0))
+        cls.target_port = cls.target.getsockname()[1]
+        _serve(cls.target, _target)
+        cls.server = MuxServer("127.0.0.1", 0, PASSWORD, METHOD)
+        cls.server.start()
+        cls.client = SSRClient("127.0.0.1", cls.server.address[1], PASSWORD, METHOD)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        cls.target.close()
+
+    def setUp(self):
+        self.pool = MuxPool(connections=1, max_streams=8)
+
+    def wait_streams(self, count):
+        """等待流结束后MuxPool的流计数回落"""
+        with self.pool._cond:
+            self.pool._cond.wait_for(lambda: self.pool.get_stats()["streams"] == count, 5)
+        self.assertEqual(self.pool.get_stats()["streams"], count)
+
+    def test_open_stream(self):
+        sock = self.pool.open_stream(self.client, "127.0.0.1", self.target_port, b"E")
+        self.assertIsNotNone(sock)
+        with sock:
+            sock.settimeout(5)
+            sock.sendall(b"hello")
+            self.assertEqual(_recv_exactly(sock, 5), b"hello")
+        self.assertEqual(self.pool.get_stats()["connections"], 1)
+
+    def test_open_stream_target_refused(self):
+        # 服务端连接目标失败时不返回socket
+        refused = socket.create_server(("127.0.0.1", 0))
+        port = refused.getsockname()[1]
+        refused.close()
+        with self.assertRaises(ConnectionError):
+            self.pool.open_stream(self.client, "127.0.0.1", port)
+        self.wait_streams(0)
+        # 连接本身不受影响
+        sock = self.pool.open_stream(self.client, "127.0.0.1", self.target_port, b"E")
+        with sock:
+            sock.settimeout(5)
+            sock.sendall(b"again")
+            self.assertEqual(_recv_exactly(sock, 5), b"again")
+
+    def test_open_stream_timeout(self):
+        # 节点接受连接但从不应答流请求
+        silent = socket.create_server(("127.0.0.1", 0))
+        accepted = []
+        _serve(silent, accepted.append)
+        client = SSRClient("127.0.0.1", silent.getsockname()[1], PASSWORD, METHOD)
+        try:
+            with mock.patch.object(mux, "OPEN_TIMEOUT", 0.5):
+                with self.assertRaises(ConnectionError):
+                    self.pool.open_stream(client, "127.0.0.1", self.target_port)
+            self.wait_streams(0)
+        finally:
+            silent.close()
+            for conn in accepted:
+                conn.close()
+
+    def test_window_update(self):
+        # 下载超过初始窗口的数据，需要客户端不断增加窗口
+        sock = self.pool.open_stream(self.client, "127.0.0.1", self.target_port, b"B")
+        with sock:
+            sock.settimeout(5)
+            data = _recv_exactly(sock, 4 * 1024 * 1024)
+        self.assertEqual(len(data), 4 * 1024 * 1024)
+        self.assertGreater(len(data), INITIAL_WINDOW)
+
+    def test_stalled_stream_does_not_block_others(self):
+        # 本地端不读取的流最多占用一个窗口，同一连接上的其他流照常传输
+        stalled = self.pool.open_stream(self.client, "127.0.0.1", self.target_port, b"B")
+        echo = self.pool.open_stream(self.client, "127.0.0.1", self.target_port, b"E")
+        with stalled, echo:
+            echo.settimeout(5)
+            payload = bytes(range(256)) * 4096
+            writer = threading.Thread(target=echo.sendall, args=(payload,))
+            writer.start()
+            self.assertEqual(_recv_exactly(echo, len(payload)), payload)
+            writer.join()
+        self.assertEqual(self.pool.get_stats()["connections"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游连接池
+为当前节点预先建立若干空闲TCP连接，新隧道直接取用已完成握手的socket，
+省去到远端节点的TCP握手往返。空闲连接按存活时间和可用性淘汰，并在后台补充。
+"""
+
+import socket
+import threading
+import time
+import logging
+from collections import deque
+
+import sockopts
+
+logger = logging.getLogger("upstream_pool")
+
+# 预连接失败后的重试间隔(秒)
+RETRY_DELAY = 10
+
+
+class UpstreamPool:
+    """按节点(address, port)分组的预连接池"""
+
+    def __init__(self, targets, size=2, max_age=20, connect_timeout=15, interval=1.0):
+        """
+        参数:
+            targets: 返回需要保持预连接的节点列表的函数
+            size: 每个节点保持的空闲连接数，0表示禁用
+            max_age: 空闲连接的最长存活时间(秒)，超过后丢弃
+        """
+        self.targets = targets
+        self.size = size
+        self.max_age = max_age
+        self.connect_timeout = connect_timeout
+        self.interval = interval
+        self._idle = {}  # (address, port) -> deque[(socket, 创建时间)]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._retry_at = {}  # 预连接失败的节点在此时间之前不再重试
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def start(self):
+        """启动后台补充线程"""
+        if not self.enabled or self._thread:
+            return
+        self._thread = threading.Thread(target=self._refill_loop, daemon=True)
+        self._thread.start()
+        logger.info(f"上游连接池已启动，每个节点保持 {self.size} 个空闲连接，最长存活 {self.max_age} 秒")
+
+    def acquire(self, node):
+        """取出一个可用的空闲连接，没有时返回None"""
+        if not self.enabled:
+            return None
+
+        key = (node.address, node.port)
+        now = time.time()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                entry = idle.pop() if idle else None
+            if entry is None:
+                self.misses += 1
+                self._wakeup.set()
+                return None
+
+            sock, created = entry
+            if now - created <= self.max_age and self._is_alive(sock):
+                self.hits += 1
+                self._wakeup.set()
+                return sock
+            self._discard(sock)
+
+    def get_stats(self):
+        """获取连接池统计信息"""
+        with self._lock:
+            idle = sum(len(q) for q in self._idle.values())
+        return {
+            "idle": idle,
+            "hits": self.hits,
+            "misses": self.misses,
+            "discarded": self.discarded,
+        }
+
+    def _is_alive(self, sock):
+        """检查空闲连接是否仍然可用：应当没有任何可读数据，也没有被关闭"""
+        try:
+            sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        # 收到数据或对端已关闭，都不能再作为新隧道使用
+        return False
+
+    def _discard(self, sock):
+        self.discarded += 1
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def _purge(self, live_keys):
+        """丢弃过期连接以及已不再需要预热的节点的连接"""
+        now = time.time()
+        expired = []
+        with self._lock:
+            for key in list(self._idle):
+                idle = self._idle[key]
+                if key not in live_keys:
+                    expired.extend(sock for sock, _ in idle)
+                    del self._idle[key]
+                    continue
+                while idle and now - idle[0][1] > self.max_age:
+                    expired.append(idle.popleft()[0])
+        for sock in expired:
+            self._discard(sock)
+
+    def _connect(self, address, port):
+        # 预连接需要真正完成握手，不使用TFO
+        sock = sockopts.create_connection((address, port), self.connect_timeout, fastopen=False)
+        sock.settimeout(None)
+        return sock
+
+    def _refill_loop(self):
+        """后台补充空闲连接"""
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                nodes = [node for node in self.targets() if node]
+                keys = {(node.address, node.port) for node in nodes}
+                self._purge(keys)
+
+                for address, port in keys:
+                    if self._retry_at.get((address, port), 0) > time.time():
+                        continue
+                    with self._lock:
+                        missing = self.size - len(self._idle.get((address, port), ()))
+                    for _ in range(missing):
+                        try:
+                            sock = self._connect(address, port)
+                        except Exception as e:
+                            logger.warning(f"预连接节点 {address}:{port} 失败: {str(e)}")
+                            self._retry_at[(address, port)] = time.time() + RETRY_DELAY
+                            break
+                        with self._lock:
+                            self._idle.setdefault((address, port), deque()).append((sock, time.time()))
+            except Exception as e:
+                logger.error(f"上游连接池补充失败: {str(e)}")
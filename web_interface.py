@@ -8,6 +8,8 @@ from datetime import datetime
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 
+import cipher_backends
+
 # 全局变量
 proxy_manager = None
 
@@ -151,6 +153,12 @@ class WebInterfaceHandler(BaseHTTPRequestHandler):
             self.wfile.write(json.dumps(proxy_manager.get_stats()).encode())
             return
 
+        # 加密实现的选择结果和吞吐量
+        if path == "/api/ciphers":
+            self._set_headers("application/json")
+            self.wfile.write(json.dumps(cipher_backends.get_report()).encode())
+            return
+
         # 404 API
         self._set_headers("application/json", 404)
         self.wfile.write(json.dumps({"error": "API不存在"}).encode())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程工作模式
+主进程负责订阅更新、节点检查和Web界面，N个工作进程各自以SO_REUSEPORT绑定
+同一个代理端口并运行自己的转发循环，由内核在进程之间分配新连接，
+SSR加密和数据转发不再受单个GIL限制。
+
+节点表和检查结果由主进程通过管道下发，各工作进程的统计计数写入共享内存，
+主进程读取统计时汇总。
+"""
+
+import socket
+import threading
+import time
+import logging
+import multiprocessing
+
+logger = logging.getLogger("workers")
+
+# 共享内存中每个工作进程的计数个数：总连接数、活动连接数、总流量
+STATS_FIELDS = 3
+# 工作进程写入统计的间隔(秒)
+STATS_FLUSH_INTERVAL = 1.0
+# 工作进程异常退出后重启的等待时间(秒)
+RESTART_DELAY = 3
+
+# 使用spawn启动工作进程，避免在已有多个线程的主进程中fork
+_mp = multiprocessing.get_context("spawn")
+
+REUSE_PORT_AVAILABLE = hasattr(socket, "SO_REUSEPORT")
+
+
+def worker_main(index, options, snapshot, conn, stats_array):
+    """工作进程入口"""
+    from proxy_manager import ProxyManager
+    from logging_setup import setup_logging, configure_logging
+
+    setup_logging()
+    configure_logging(options)
+    manager = ProxyManager(options, worker=True)
+    manager.apply_node_snapshot(snapshot)
+
+    def flush_stats():
+        base = index * STATS_FIELDS
+        while True:
+            time.sleep(STATS_FLUSH_INTERVAL)
+            stats = manager.stats.snapshot()
+            stats_array[base] = stats["total_connections"]
+            stats_array[base + 1] = stats["active_connections"]
+            stats_array[base + 2] = stats["total_traffic"]
+
+    threading.Thread(target=flush_stats, daemon=True).start()
+    manager.start_proxy_server()
+    logger.info(f"工作进程 #{index} 已启动")
+
+    # 接收主进程下发的节点表，主进程退出时管道关闭，工作进程随之退出
+    while True:
+        try:
+            snapshot = conn.recv()
+        except (EOFError, OSError):
+            logger.info(f"主进程已退出，工作进程 #{index} 结束")
+            return
+        manager.apply_node_snapshot(snapshot)
+
+
+class WorkerSupervisor:
+    """在主进程中管理工作进程"""
+
+    def __init__(self, manager, count):
+        self.manager = manager
+        self.count = count
+        self.stats_array = _mp.Array("q", count * STATS_FIELDS, lock=False)
+        self.base = [0] * STATS_FIELDS  # 已退出的工作进程的计数
+        self.processes = [None] * count
+        self.pipes = [None] * count
+        self.send_lock = threading.Lock()
+
+    def start(self):
+        """启动所有工作进程和监控线程"""
+        for index in range(self.count):
+            self._spawn(index)
+
+        self.manager.worker_stats = self
+        self.manager.add_node_listener(self.broadcast)
+        threading.Thread(target=self._monitor, daemon=True).start()
+        logger.info(f"已启动 {self.count} 个工作进程，共享监听端口 {self.manager.options.get('local_port', 7088)}")
+
+    def _spawn(self, index):
+        parent_conn, child_conn = _mp.Pipe(duplex=False)
+        process = _mp.Process(
+            target=worker_main,
+            args=(index, self.manager.options, self.manager.get_node_snapshot(), parent_conn, self.stats_array),
+            name=f"symi-proxy-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        parent_conn.close()
+        self.processes[index] = process
+        self.pipes[index] = child_conn
+
+    def _monitor(self):
+        """工作进程异常退出时重启"""
+        while True:
+            time.sleep(RESTART_DELAY)
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                logger.warning(f"工作进程 #{index} 已退出(退出码 {process.exitcode})，正在重启")
+                # 把旧进程的计数并入基础计数，新进程从0开始写
+                row = index * STATS_FIELDS
+                with self.send_lock:
+                    for i in range(STATS_FIELDS):
+                        if i != 1:  # 活动连接随进程退出而结束
+                            self.base[i] += self.stats_array[row + i]
+                        self.stats_array[row + i] = 0
+                    self.pipes[index].close()
+                    self._spawn(index)
+
+    def broadcast(self):
+        """把最新的节点表下发给所有工作进程"""
+        snapshot = self.manager.get_node_snapshot()
+        with self.send_lock:
+            for index, pipe in enumerate(self.pipes):
+                try:
+                    pipe.send(snapshot)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"向工作进程 #{index} 下发节点表失败: {str(e)}")
+
+    def totals(self):
+        """汇总所有工作进程的统计"""
+        totals = list(self.base)
+        values = self.stats_array[:]
+        for row in range(self.count):
+            for i in range(STATS_FIELDS):
+                totals[i] += values[row * STATS_FIELDS + i]
+        return dict(zip(("total_connections", "active_connections", "total_traffic"), totals))